@@ -0,0 +1,185 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+"""
+startup benchmark of the eMail service, how long the imports take and how long `email-service-worker` takes until its
+workers serve their channels (subscribed & joined the stream consumer group), against a local SMTP sink and fakeredis
+(unless `--redis host:port` is given).
+
+    python benchmarks/bench_startup.py --repeat 10 --workers 1,2 --start-methods fork,spawn -o startup.json
+
+- every import is timed in a fresh interpreter, net of the interpreter start up (`python -c pass`)
+- the worker runs with the converters of the tests (`--converter`), on a pub/sub & a stream channel
+- results are written as JSON (stdout or `--output`), median & min seconds of `--repeat` runs, worker RSS once ready
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Optional
+
+from aiosmtpd.controller import Controller
+from redis import Redis
+from redis.exceptions import ResponseError
+
+# pylint: disable=wrong-import-position
+from bench_email import RelaySink, SmtpSink, _auth, _rss
+
+from email_service_nicegui.__about__ import __version__
+
+IMPORTS = {
+    'package': 'import email_service_nicegui',
+    'client': 'from email_service_nicegui import EmailClient',
+    'worker': 'import email_service_nicegui.email_service',
+    'worker_cli': 'import email_service_nicegui.worker',
+}
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+
+def _env() -> dict[str, str]:
+    # the converters of the tests, after whatever is on the path already
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (os.getenv('PYTHONPATH'), TESTS_DIR))))
+
+def _summary(values: list[float]) -> dict[str, float]:
+    return {'median': round(statistics.median(values), 4), 'min': round(min(values), 4)}
+
+def time_import(statement: str, repeat: int) -> list[float]:
+    rtn = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True, env=_env())
+        rtn.append(time.perf_counter() - started)
+    return rtn
+
+def time_worker(args: argparse.Namespace, workers: int, start_method: Optional[str]) -> tuple[float, int]:
+    """seconds until all the `workers` serve both channels, along with their total RSS by then"""
+    redis = Redis(host=args.redis_host, port=args.redis_port)
+    run_id = uuid.uuid4().hex[:8]
+    pubsub, stream = f'bench.{run_id}.pubsub', f'bench.{run_id}.stream'
+    cmd = [sys.executable, '-m', 'email_service_nicegui.worker', '--redis', f'{args.redis_host}:{args.redis_port}',
+           '--workers', str(workers), '--log-level', 'WARNING', '--channel', f'{pubsub}={args.converter}',
+           '--channel', f'{stream}={args.converter}?transport=stream']
+    if start_method:
+        cmd += ['--start-method', start_method]
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=_env())
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f'worker exited with {proc.returncode}')
+            try:
+                if (redis.pubsub_numsub(pubsub)[0][1] >= workers and
+                    len(redis.xinfo_consumers(stream, os.getenv('SMTP_STREAM_GROUP', 'email-service'))) >= workers):
+                    break
+            except ResponseError:
+                pass
+            if time.perf_counter() - started > args.timeout:
+                raise TimeoutError(f'worker not ready after {args.timeout}s')
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - started
+        pids = [proc.pid]
+        if workers > 1:
+            children = subprocess.run(['pgrep', '-P', str(proc.pid)], capture_output=True, text=True, check=False)
+            pids += [int(x) for x in children.stdout.split()]
+        return elapsed, sum(_rss(pid) for pid in pids)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        redis.delete(stream, f'email:stats:{pubsub}', f'email:stats:{stream}')
+        redis.close()
+
+def run_bench(args: argparse.Namespace) -> dict[str, Any]:
+    baseline = time_import('pass', args.repeat)
+    imports = {}
+    for name, statement in IMPORTS.items():
+        values = time_import(statement, args.repeat)
+        imports[name] = _summary([max(0.0, x - statistics.median(baseline)) for x in values])
+        print(f'import {name}: {imports[name]["median"]}s', file=sys.stderr)
+
+    workers = []
+    for count in args.workers:
+        for start_method in (args.start_methods if count > 1 else [None]):
+            runs = [time_worker(args, count, start_method) for _ in range(args.repeat)]
+            workers.append({'workers': count, 'start_method': start_method or 'in process',
+                            'ready_seconds': _summary([x for x, _ in runs]),
+                            'rss_bytes': int(statistics.median([x for _, x in runs]))})
+            print(f'{count} worker(s), {start_method or "in process"}: ready after {workers[-1]["ready_seconds"]["median"]}s',
+                  file=sys.stderr)
+
+    return {
+        'version': __version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scenario': {'repeat': args.repeat, 'converter': args.converter,
+                     'redis': 'fakeredis' if args.fakeredis else f'{args.redis_host}:{args.redis_port}'},
+        'interpreter_seconds': _summary(baseline),
+        'import_seconds': imports,
+        'worker': workers,
+    }
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement (default: 5)')
+    parser.add_argument('--workers', type=lambda x: [int(r) for r in x.split(',')], default=[1, 2],
+                        help='comma separated worker counts, 1 runs in the worker CLI process (default: 1,2)')
+    parser.add_argument('--start-methods', type=lambda x: x.split(','), default=['fork', 'spawn'],
+                        help='multiprocessing start methods of more than one worker (default: fork,spawn)')
+    parser.add_argument('--converter', default='test_email_redis_common:gen_email_welcome')
+    parser.add_argument('--smtp-port', type=int, default=30135)
+    parser.add_argument('--redis', default=None, help='host:port of a Redis server to use instead of fakeredis')
+    parser.add_argument('--timeout', type=float, default=60, help='give up on a worker not ready after so many seconds')
+    parser.add_argument('-o', '--output', default=None, help='write the JSON result to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    os.environ.update(SMTP_HOST='127.0.0.1', SMTP_PORT=str(args.smtp_port), SMTP_STARTTLS='False',
+                      SMTP_FROM_EMAIL=os.getenv('SMTP_FROM_EMAIL', 'bench@bench.test'),
+                      SMTP_USERNAME='bench', SMTP_PASSWORD='bench', SMTP_DEBUG='False', SMTP_RELAYS='')
+    controller = Controller(RelaySink(SmtpSink({}, None), f'127.0.0.1:{args.smtp_port}', 0), hostname='127.0.0.1',
+                            port=args.smtp_port, authenticator=_auth, auth_require_tls=False)
+    controller.start()
+
+    fake_server = None
+    args.fakeredis = args.redis is None
+    if args.redis:
+        args.redis_host, _, port = args.redis.partition(':')
+        args.redis_port = int(port or 6379)
+    else:
+        from fakeredis import TcpFakeServer # pylint: disable=import-outside-toplevel
+        fake_server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        fake_server.daemon_threads = True
+        threading.Thread(target=fake_server.serve_forever, daemon=True).start()
+        args.redis_host, args.redis_port = fake_server.server_address[:2]
+
+    try:
+        result = run_bench(args)
+    finally:
+        controller.stop()
+        if fake_server:
+            fake_server.shutdown()
+            fake_server.server_close()
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,8 +2,51 @@
 #
 # SPDX-License-Identifier: MIT
 
-from . import email_service
+import importlib
+from typing import TYPE_CHECKING, Any
 
-SrvcEmail = email_service.SrvcEmail
+if TYPE_CHECKING:
+    from .admission import AdmissionPolicy, AdmissionRejected, EAdmission
+    from .client import EmailClient
+    from .codec import decode_model, decode_payload, encode_payload
+    from .email_service import SrvcEmail
+    from .fanout import FanoutRecipient
+    from .metrics import mount_metrics, render_prometheus
+    from .streams import ETransport
+    from .templates import MailTemplate, TemplateConverter, template_registry
 
-__all__ = ["SrvcEmail"]
+# public names & their modules, imported on first use. a web app only sending eMails never loads the worker side
+# (confz/pydantic config, SMTP delivery, ...) and a headless worker never loads the client.
+_LAZY = {
+    'SrvcEmail': 'email_service',
+    'ETransport': 'streams',
+    'EmailClient': 'client',
+    'AdmissionPolicy': 'admission',
+    'AdmissionRejected': 'admission',
+    'EAdmission': 'admission',
+    'FanoutRecipient': 'fanout',
+    'encode_payload': 'codec',
+    'decode_payload': 'codec',
+    'decode_model': 'codec',
+    'render_prometheus': 'metrics',
+    'mount_metrics': 'metrics',
+    'MailTemplate': 'templates',
+    'TemplateConverter': 'templates',
+    'template_registry': 'templates',
+}
+
+__all__ = [
+    "SrvcEmail", "ETransport", "EmailClient", "AdmissionPolicy", "AdmissionRejected", "EAdmission", "FanoutRecipient",
+    "encode_payload", "decode_payload", "decode_model", "render_prometheus", "mount_metrics", "MailTemplate",
+    "TemplateConverter", "template_registry",
+]
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_LAZY[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), *_LAZY])
@@ -0,0 +1,66 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+from enum import Enum
+from typing import NamedTuple, Optional
+
+from .backlog import Backlog
+
+
+class EAdmission(str, Enum):
+    # enqueued right away
+    ACCEPT = 'accept'
+    # not enqueued at all, `EmailClient.send` raises `AdmissionRejected`
+    REJECT = 'reject'
+    # enqueued into the retry queue of the channel, due once the backlog is estimated to be drained
+    DEFER = 'defer'
+    # enqueued to the channel `AdmissionPolicy.downgrade_to` instead (e.g. a digest or a low priority channel)
+    DOWNGRADE = 'downgrade'
+
+class AdmissionPolicy(NamedTuple):
+    """
+    admission of the requests of a channel by `EmailClient`, `action` is taken once the backlog of its workers reaches
+    `max_depth` requests or its estimated wait `max_wait` seconds (either one, None for no limit).
+    the depth of a pub/sub channel is what its workers hold, at most `ConfigSMTP.convert_queue_size +
+    ConfigSMTP.queue_size` per worker without a spool (`ConfigSMTP.spool_dir`), a `max_depth` beyond is never reached.
+    """
+    max_depth: Optional[int] = None
+    max_wait: Optional[float] = None
+    action: EAdmission = EAdmission.REJECT
+    downgrade_to: Optional[str] = None
+    # a deferred request is due after the estimated wait, at most `max_defer` seconds (also when the wait is not known)
+    max_defer: float = 300
+
+    def over(self, backlog: Backlog) -> bool:
+        return ((self.max_depth is not None and backlog.depth >= self.max_depth) or
+                (self.max_wait is not None and backlog.wait >= self.max_wait))
+
+    def decide(self, channel: str, backlog: Backlog) -> 'Admission':
+        if not self.over(backlog):
+            return Admission(EAdmission.ACCEPT, channel, 0, backlog)
+        if self.action == EAdmission.DEFER:
+            delay = min(self.max_defer, max(1.0, backlog.wait or self.max_defer))
+            return Admission(self.action, channel, delay, backlog)
+        if self.action == EAdmission.DOWNGRADE and self.downgrade_to:
+            return Admission(self.action, self.downgrade_to, 0, backlog)
+        return Admission(EAdmission.REJECT, channel, 0, backlog)
+
+class Admission(NamedTuple):
+    action: EAdmission
+    # channel to enqueue to
+    channel: str
+    # seconds a deferred request waits in the retry queue
+    delay: float
+    backlog: Backlog
+
+class AdmissionRejected(Exception):
+    """the workers of `channel` are too far behind, as per its `AdmissionPolicy`"""
+
+    channel: str
+    backlog: Backlog
+
+    def __init__(self, channel: str, backlog: Backlog) -> None:
+        super().__init__(f'{channel} is behind by {backlog.depth} request(s), about {backlog.wait:.1f}s')
+        self.channel = channel
+        self.backlog = backlog
@@ -0,0 +1,131 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import json
+import time
+from typing import Callable, NamedTuple, NoReturn
+
+from redis.asyncio import Redis
+
+from .utils import ILogger
+
+KEY_BACKLOG = 'email:backlog:{}'
+
+class Backlog(NamedTuple):
+    # requests & eMails waiting in the workers (of a stream channel, the entries of its stream)
+    depth: int = 0
+    # eMails done per second by the workers while they had a backlog, 0 when not known yet
+    rate: float = 0
+    # workers reporting
+    workers: int = 0
+
+    @property
+    def wait(self) -> float:
+        """estimated seconds until the backlog is drained, 0 while the drain rate is not known"""
+        return self.depth / self.rate if self.rate > 0 else 0.0
+
+class BacklogReporter():
+    """
+    backlog of a worker per channel, published for the producers, see `read_backlog` & `EmailClient.admit`.
+    - every `interval` seconds, the depth of every channel (as per `depth`, requests waiting for the conversion & eMails
+      waiting for a sender or parked in the spool) and its drain rate go into the hash `email:backlog:<channel>`,
+      field `<worker>`, as JSON along with the time of the report.
+    - the drain rate is the number of eMails `done` per second, averaged (EWMA) over the intervals the channel started
+      with a backlog, so an idle channel keeps the rate it was last drained at instead of its arrival rate.
+    - the hash expires unless refreshed, the report of a worker gone for good is skipped by the readers once stale.
+      `close` removes the report of this worker.
+    """
+
+    logger: ILogger
+    _m_redis: Redis
+    _m_worker: str
+    _m_channels: list[str]
+    _m_depth: Callable[[str], int]
+    _m_interval: float
+    _m_alpha: float
+    _m_done: dict[str, int]
+    _m_last: dict[str, int]
+    _m_rate: dict[str, float]
+    _m_reported: float
+
+    __slots__ = ['logger', '_m_redis', '_m_worker', '_m_channels', '_m_depth', '_m_interval', '_m_alpha', '_m_done',
+                 '_m_last', '_m_rate', '_m_reported']
+
+    def __init__(self, redis: Redis, worker: str, channels: list[str], depth: Callable[[str], int], logger: ILogger,
+                 interval: float = 1, alpha: float = 0.3) -> None:
+        self.logger = logger
+        self._m_redis = redis
+        self._m_worker = worker
+        self._m_channels = channels
+        self._m_depth = depth
+        self._m_interval = interval
+        self._m_alpha = alpha
+        self._m_done = {}
+        # depth of the last report
+        self._m_last = {}
+        self._m_rate = {}
+        self._m_reported = time.monotonic()
+
+    def __repr__(self) -> str:
+        return f'BacklogReporter({self._m_worker}, depth={self._m_last}, rate={self._m_rate})'
+
+    def done(self, channel: str, count: int = 1):
+        self._m_done[channel] = self._m_done.get(channel, 0) + count
+
+    async def flush(self):
+        now = time.monotonic()
+        elapsed, self._m_reported = max(now - self._m_reported, 1e-3), now
+        done, self._m_done = self._m_done, {}
+        ttl = max(30, int(self._m_interval * 10))
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for channel in self._m_channels:
+                if self._m_last.get(channel, 0) > 0 and channel in done:
+                    rate = done[channel] / elapsed
+                    prev = self._m_rate.get(channel)
+                    self._m_rate[channel] = rate if prev is None else self._m_alpha * rate + (1 - self._m_alpha) * prev
+                depth = self._m_last[channel] = self._m_depth(channel)
+                report = {'depth': depth, 'rate': round(self._m_rate.get(channel, 0), 3), 'ts': time.time(),
+                          'interval': self._m_interval}
+                pipe.hset(KEY_BACKLOG.format(channel), self._m_worker, json.dumps(report))
+                pipe.expire(KEY_BACKLOG.format(channel), ttl)
+            await pipe.execute()
+
+    async def run(self) -> NoReturn:
+        while True:
+            await asyncio.sleep(self._m_interval)
+            try:
+                await self.flush()
+            except Exception as excp:
+                self.logger.warning('unable to report the backlog: %r', excp)
+
+    async def close(self):
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for channel in self._m_channels:
+                pipe.hdel(KEY_BACKLOG.format(channel), self._m_worker)
+            await pipe.execute()
+
+async def read_backlog(redis: Redis, channel: str, stream: bool = False) -> Backlog:
+    """
+    backlog of `channel` over all its workers, the reports older than 3 of their intervals are skipped.
+    `stream`, the channel is an `ETransport.STREAM` one, its depth is (at least) the length of its stream.
+    """
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hgetall(KEY_BACKLOG.format(channel))
+        if stream:
+            pipe.xlen(channel)
+        rslt = await pipe.execute()
+    now = time.time()
+    depth, rate, workers = 0, 0.0, 0
+    for value in rslt[0].values():
+        report = json.loads(value)
+        if now - report['ts'] > 3 * report['interval'] + 1:
+            continue
+        depth += report['depth']
+        rate += report['rate']
+        workers += 1
+    if stream:
+        # the entries not read yet by any worker along with the ones they hold
+        depth = max(depth, rslt[1])
+    return Backlog(depth, rate, workers)
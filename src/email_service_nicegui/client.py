@@ -0,0 +1,153 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import time
+from typing import Any, Iterable, Mapping, Optional
+
+from redis.asyncio import ConnectionPool, Redis
+
+from .admission import Admission, AdmissionPolicy, AdmissionRejected, EAdmission
+from .backlog import Backlog, read_backlog
+from .codec import encode_payload
+from .fanout import FanoutRecipient, FanoutRequest
+from .retry import RetryEntry, RetryQueue
+
+
+class EmailClient():
+    """
+    producer side of the eMail service, to be created once per web app process and shared by all the handlers.
+    - all the requests go over one Redis connection pool, no connection setup per eMail
+    - `send` publishes one request, `send_many` pipelines a whole batch in a single round trip
+    - channels registered with `ETransport.STREAM` by the workers have to be listed in `streams`, their requests are
+      `XADD`ed instead of `PUBLISH`ed. workers delete the entries once done, `stream_maxlen` only caps a runaway
+      backlog (the oldest requests are dropped beyond it).
+    - `send_fanout` sends one eMail to many recipients over a channel registered with `fanout=True`
+    - `binary` encodes pydantic models & python objects with msgpack instead of JSON, see `codec.decode_model`
+    - `admission`, `AdmissionPolicy` per channel, its requests are rejected (`AdmissionRejected`), deferred or
+      downgraded to an other channel once its workers are too far behind (as per `backlog`). the backlog reported by
+      the workers is read once per `admission_ttl` seconds, the requests sent meanwhile are added to it.
+    """
+
+    _m_redis: Redis
+    _m_streams: frozenset[str]
+    _m_binary: bool
+    _m_stream_maxlen: Optional[int]
+    _m_admission: dict[str, AdmissionPolicy]
+    _m_admission_ttl: float
+    # backlog of the channels with a policy, when it was read & the requests admitted since
+    _m_backlog: dict[str, tuple[float, Backlog, int]]
+
+    __slots__ = ['_m_redis', '_m_streams', '_m_binary', '_m_stream_maxlen', '_m_admission', '_m_admission_ttl',
+                 '_m_backlog']
+
+    def __init__(self, memdb_host: str = 'localhost', port: int = 6379, *, streams: Iterable[str] = (),
+                 binary: bool = False, max_connections: int = 32, stream_maxlen: Optional[int] = None,
+                 redis: Optional[Redis] = None, admission: Optional[Mapping[str, AdmissionPolicy]] = None,
+                 admission_ttl: float = 0.5) -> None:
+        self._m_redis = redis or Redis.from_pool(
+            ConnectionPool(host=memdb_host, port=port, max_connections=max_connections))
+        self._m_streams = frozenset(str(x) for x in streams)
+        self._m_binary = binary
+        self._m_stream_maxlen = stream_maxlen
+        self._m_admission = {str(k): v for k, v in (admission or {}).items()}
+        self._m_admission_ttl = admission_ttl
+        self._m_backlog = {}
+
+    def __repr__(self) -> str:
+        return f'EmailClient({self._m_redis}, streams={set(self._m_streams)}, binary={self._m_binary})'
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.aclose()
+
+    def _push(self, client: Redis, channel: str, data: bytes, delay: float = 0):
+        if delay > 0:
+            # picked up by the retry queue poller of the workers, not counted as an attempt
+            now = time.time()
+            return client.zadd(RetryQueue.KEY_RETRY.format(channel),
+                               {RetryEntry(channel, data, 0, None, now).encode(): now + delay})
+        if channel in self._m_streams:
+            return client.xadd(channel, {'data': data}, maxlen=self._m_stream_maxlen, approximate=True)
+        return client.publish(channel, data)
+
+    async def backlog(self, channel: str) -> Backlog:
+        """backlog of the workers of `channel`, as reported by them right now"""
+        channel = str(channel)
+        return await read_backlog(self._m_redis, channel, channel in self._m_streams)
+
+    async def admit(self, channel: str) -> Admission:
+        """
+        admission of one more request of `channel` as per its `AdmissionPolicy`, always `EAdmission.ACCEPT` without one.
+        every request `send` enqueues is admitted like this, call it to know beforehand (e.g. to tell the user).
+        """
+        channel = str(channel)
+        if (policy := self._m_admission.get(channel)) is None:
+            return Admission(EAdmission.ACCEPT, channel, 0, Backlog())
+        now = time.monotonic()
+        read, backlog, admitted = self._m_backlog.get(channel, (0.0, Backlog(), 0))
+        if now - read >= self._m_admission_ttl:
+            read, backlog, admitted = now, await self.backlog(channel), 0
+            self._m_backlog[channel] = (read, backlog, admitted)
+        return policy.decide(channel, backlog._replace(depth=backlog.depth + admitted))
+
+    async def _route(self, channel: str) -> Admission:
+        rtn = await self.admit(channel)
+        if rtn.action == EAdmission.REJECT:
+            raise AdmissionRejected(channel, rtn.backlog)
+        if rtn.action == EAdmission.ACCEPT and channel in self._m_backlog:
+            read, backlog, admitted = self._m_backlog[channel]
+            self._m_backlog[channel] = (read, backlog, admitted + 1)
+        return rtn
+
+    async def send(self, channel: str, payload: Any) -> int | bytes:
+        """
+        Returns: number of subscribed workers for a published request (0, nobody got it, also when deferred), the entry
+        id for a stream.
+        Raises: AdmissionRejected, as per the `AdmissionPolicy` of the channel
+        """
+        route = await self._route(str(channel))
+        rtn = await self._push(self._m_redis, route.channel, encode_payload(payload, self._m_binary), route.delay)
+        return 0 if route.delay else rtn
+
+    async def send_many(self, requests: Iterable[tuple[str, Any]]) -> list[int | bytes | AdmissionRejected]:
+        """
+        send a batch of `(channel, payload)` requests in one round trip, results are as per `send`. a rejected request
+        is not sent, its result is the `AdmissionRejected` error.
+        """
+        rtn: list[int | bytes | AdmissionRejected] = []
+        sent: list[tuple[int, float]] = []
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for channel, payload in requests:
+                try:
+                    route = await self._route(str(channel))
+                except AdmissionRejected as excp:
+                    rtn.append(excp)
+                    continue
+                self._push(pipe, route.channel, encode_payload(payload, self._m_binary), route.delay)
+                sent.append((len(rtn), route.delay))
+                rtn.append(0)
+            for (idx, delay), value in zip(sent, await pipe.execute()):
+                rtn[idx] = 0 if delay else value
+        return rtn
+
+    async def send_fanout(self, channel: str, payload: Any, recipients: Iterable[Any] = (),
+                          recipients_key: Optional[str] = None, trusted: Iterable[str] = ()) -> int | bytes:
+        """
+        one request for all the `recipients`, the worker converts `payload` once and sends its eMail to them in
+        multi recipient SMTP transactions. a recipient is an address or a `FanoutRecipient` (or its dict) with `subs`
+        for the `$name` placeholders of the Subject & text parts and/or `headers` of its own.
+        `recipients_key`, (also) the recipients held by this Redis set, sorted set, list or stream, read by the worker
+        in chunks, see `fanout.iter_recipients`. the `subs` are HTML escaped in the HTML parts, but the `trusted` ones
+        (markup of your own, never user input). results are as per `send`.
+        """
+        route = await self._route(str(channel))
+        request = FanoutRequest(encode_payload(payload, self._m_binary),
+                                tuple(FanoutRecipient.load(x) for x in recipients), recipients_key, tuple(trusted))
+        rtn = await self._push(self._m_redis, route.channel, request.encode(), route.delay)
+        return 0 if route.delay else rtn
+
+    async def aclose(self):
+        await self._m_redis.aclose()
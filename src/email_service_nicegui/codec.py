@@ -0,0 +1,51 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import json
+from typing import TYPE_CHECKING, Any, TypeVar
+
+if TYPE_CHECKING:
+    from pydantic import BaseModel
+
+# 0xc1 is never used by msgpack and no JSON document starts with it, so it tells the binary encoding apart
+BINARY_MAGIC = b'\xc1'
+
+TModel = TypeVar('TModel', bound='BaseModel')
+
+def _msgpack():
+    try:
+        import msgpack # pylint: disable=import-outside-toplevel
+    except ImportError as excp:
+        raise ImportError('binary encoding needs msgpack, install "email-service-nicegui[binary]"') from excp
+    return msgpack
+
+def encode_payload(payload: Any, binary: bool = False) -> bytes:
+    """
+    encode an eMail request, `bytes`/`str` are sent as is, pydantic models and plain python objects are encoded
+    as compact JSON, or as msgpack (prefixed with `BINARY_MAGIC`) when `binary` is set.
+    """
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode()
+    if binary:
+        if hasattr(payload, 'model_dump'):
+            payload = payload.model_dump(mode='json')
+        return BINARY_MAGIC + _msgpack().packb(payload)
+    if hasattr(payload, 'model_dump_json'):
+        return payload.model_dump_json().encode()
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+def decode_payload(data: bytes | bytearray) -> Any:
+    """decode an eMail request encoded by `encode_payload`, either JSON or binary."""
+    if data[:1] == BINARY_MAGIC:
+        return _msgpack().unpackb(data[1:])
+    return json.loads(data)
+
+def decode_model(model: type[TModel], data: bytes | bytearray) -> TModel:
+    """validate an eMail request into the pydantic `model`, to be used by the channel converters."""
+    if data[:1] == BINARY_MAGIC:
+        return model.model_validate(_msgpack().unpackb(data[1:]))
+    # JSON is parsed & validated by pydantic in one go
+    return model.model_validate_json(data)
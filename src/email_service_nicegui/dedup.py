@@ -0,0 +1,183 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import hashlib
+import time
+from email.message import EmailMessage
+from typing import Iterable, NoReturn
+
+from redis.asyncio import Redis
+
+from .config import ConfigSMTP
+from .utils import ILogger
+
+BLOOM_HASHES = 7
+
+def idempotency_key(channel: str, data: bytes | bytearray, email: EmailMessage) -> str:
+    """the Message-ID set by the converter (taken from the request), else a hash of the request itself"""
+    if msg_id := email.get('Message-ID'):
+        return str(msg_id).strip()
+    return hashlib.blake2b(channel.encode() + b'\0' + bytes(data), digest_size=16).hexdigest()
+
+class BloomFilter():
+    """fixed size Bloom filter, bits laid out as per Redis `SETBIT` (MSB first), so it mirrors a Redis bitmap as is."""
+
+    bits: int
+    data: bytearray
+
+    __slots__ = ['bits', 'data']
+
+    def __init__(self, bits: int, data: bytes = b'') -> None:
+        self.bits = bits
+        self.data = bytearray(bits // 8)
+        self.data[:len(data)] = data[:len(self.data)]
+
+    def positions(self, key: str) -> list[int]:
+        # double hashing, k positions out of one 128 bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(BLOOM_HASHES)]
+
+    def add(self, key: str):
+        for pos in self.positions(key):
+            self.data[pos >> 3] |= 0x80 >> (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.data[pos >> 3] & (0x80 >> (pos & 7)) for pos in self.positions(key))
+
+class IdempotencyGuard():
+    """
+    duplicate suppression, an eMail with the same idempotency key is sent once per `ConfigSMTP.dedup_ttl` seconds.
+    - the key of an accepted eMail is recorded as `email:idem:<channel>:<key>` (with TTL), only once SMTP accepted it
+    - pub/sub channels (`claim_channels`) hand the same request to all their subscribers at once, so their requests
+      are claimed (`SET NX`) before sending, a claim of a failed attempt is released for its retry
+    - for the other channels the keys are also set in a Redis Bloom bitmap per channel & TTL generation, every worker
+      mirrors it (every `dedup_sync_interval` seconds), a key not in it was never sent and needs no lookup at all
+    - the mirror is synced incrementally, the bitmap (`dedup_bloom_bits / 8` bytes) is fetched once per channel &
+      generation, after that only the keys recorded since, from a Redis list along with the bitmap. so a sync costs as
+      much as the eMails sent meanwhile, the list as much Redis memory as the `email:idem` keys.
+    - recording is batched, `run` flushes it along with the mirror sync
+    """
+
+    logger: ILogger
+    _m_redis: Redis
+    _m_config: ConfigSMTP
+    _m_claim_channels: frozenset[str]
+    _m_blooms: dict[tuple[str, int], BloomFilter]
+    _m_pending: list[tuple[str, str]]
+    # per bitmap mirrored, the length of its list of keys as of the last sync
+    _m_synced: dict[tuple[str, int], int]
+
+    __slots__ = ['logger', '_m_redis', '_m_config', '_m_claim_channels', '_m_blooms', '_m_pending', '_m_synced']
+
+    KEY_SENT = 'email:idem:{}:{}'
+    KEY_BLOOM = 'email:idem:bloom:{}:{}'
+    KEY_LOG = 'email:idem:log:{}:{}'
+
+    def __init__(self, redis: Redis, config: ConfigSMTP, logger: ILogger, claim_channels: Iterable[str] = ()) -> None:
+        self.logger = logger
+        self._m_redis = redis
+        self._m_config = config
+        self._m_claim_channels = frozenset(claim_channels)
+        self._m_blooms = {}
+        self._m_pending = []
+        self._m_synced = {}
+
+    def __repr__(self) -> str:
+        return f'IdempotencyGuard(ttl={self._m_config.dedup_ttl}s, claim={set(self._m_claim_channels)})'
+
+    def _generation(self) -> int:
+        # a key stays in the current & the next generation, so for at least `dedup_ttl` seconds
+        return int(time.time() // self._m_config.dedup_ttl)
+
+    def _bloom(self, channel: str, gen: int) -> BloomFilter:
+        if (bloom := self._m_blooms.get((channel, gen))) is None:
+            bloom = self._m_blooms[(channel, gen)] = BloomFilter(self._m_config.dedup_bloom_bits)
+        return bloom
+
+    async def seen(self, channel: str, key: str) -> bool:
+        """True, when the eMail of `key` was sent (or is being sent by an other worker) already."""
+        sent_key = self.KEY_SENT.format(channel, key)
+        if channel in self._m_claim_channels:
+            # the claim outlives the batched recording, it is overwritten once the eMail is accepted
+            claim_ttl = max(60, int(self._m_config.dedup_sync_interval * 10))
+            return not await self._m_redis.set(sent_key, 'claimed', nx=True, ex=claim_ttl)
+        gen = self._generation()
+        if key not in self._bloom(channel, gen) and key not in self._bloom(channel, gen - 1):
+            return False
+        return bool(await self._m_redis.exists(sent_key))
+
+    def record(self, channel: str, key: str):
+        self._bloom(channel, self._generation()).add(key)
+        self._m_pending.append((channel, key))
+
+    async def release(self, channel: str, key: str):
+        """the eMail of a claimed `key` was not sent, let its retry (or an other worker) claim it again"""
+        if channel in self._m_claim_channels:
+            await self._m_redis.delete(self.KEY_SENT.format(channel, key))
+
+    async def flush(self):
+        if not self._m_pending:
+            return
+        pending, self._m_pending = self._m_pending, []
+        ttl = self._m_config.dedup_ttl
+        gen = self._generation()
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for channel, key in pending:
+                pipe.set(self.KEY_SENT.format(channel, key), 'sent', ex=ttl)
+                if channel not in self._m_claim_channels:
+                    bloom_key, log_key = self.KEY_BLOOM.format(channel, gen), self.KEY_LOG.format(channel, gen)
+                    for pos in self._bloom(channel, gen).positions(key):
+                        pipe.setbit(bloom_key, pos, 1)
+                    # after the bits, a key in the list is in the bitmap already
+                    pipe.rpush(log_key, key)
+                    pipe.expire(bloom_key, 2 * ttl)
+                    pipe.expire(log_key, 2 * ttl)
+            await pipe.execute()
+
+    async def sync(self, channels: Iterable[str]):
+        """mirror the Bloom bitmaps of the current & the previous generation of `channels`"""
+        gen = self._generation()
+        keys = [(ch, g) for ch in channels if ch not in self._m_claim_channels for g in (gen, gen - 1)]
+        if not keys:
+            return
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for ch, g in keys:
+                log_key = self.KEY_LOG.format(ch, g)
+                # the length first, the keys listed up to it are in the bitmap fetched after
+                pipe.llen(log_key)
+                if (ch, g) in self._m_synced:
+                    pipe.lrange(log_key, self._m_synced[(ch, g)], -1)
+                else:
+                    pipe.get(self.KEY_BLOOM.format(ch, g))
+            rslt = await pipe.execute()
+        blooms, synced = {}, {}
+        for (ch, g), length, data in zip(keys, rslt[::2], rslt[1::2]):
+            if (ch, g) not in self._m_synced:
+                blooms[(ch, g)] = BloomFilter(self._m_config.dedup_bloom_bits, data or b'')
+            elif length < self._m_synced[(ch, g)]:
+                # the list is gone (expired, evicted, flushed), the whole bitmap again next time
+                blooms[(ch, g)] = self._bloom(ch, g)
+                continue
+            else:
+                blooms[(ch, g)] = bloom = self._bloom(ch, g)
+                for key in data:
+                    bloom.add(key.decode())
+            synced[(ch, g)] = length
+        # recorded locally meanwhile, not flushed yet
+        for ch, key in self._m_pending:
+            if (ch, gen) in blooms:
+                blooms[(ch, gen)].add(key)
+        self._m_blooms, self._m_synced = blooms, synced
+
+    async def run(self, channels: Iterable[str]) -> NoReturn:
+        channels = list(channels)
+        while True:
+            try:
+                await self.flush()
+                await self.sync(channels)
+            except Exception as excp:
+                self.logger.warning('unable to sync the idempotency keys: %r', excp)
+            await asyncio.sleep(self._m_config.dedup_sync_interval)
@@ -0,0 +1,273 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import smtplib
+import time
+from collections import Counter
+from email.message import EmailMessage
+from email.utils import getaddresses
+from typing import Awaitable, Callable, Iterable, NamedTuple, Optional
+
+from .config import ConfigSMTP
+from .dedup import IdempotencyGuard
+from .ratelimit import THROTTLE_CODES, RateLimiter
+from .relays import RelayBalancer, SmtpRelay
+from .scheduler import ChannelScheduler
+from .smtp_pool import PooledSmtp
+from .utils import ILogger
+
+
+class DeliveryJob(NamedTuple):
+    channel: str
+    data: bytes | bytearray
+    email: EmailMessage
+    # stream entry id, when the request came in via `ETransport.STREAM`
+    msg_id: Optional[bytes] = None
+    # number of delivery attempts made before this one
+    attempt: int = 0
+    # when the request was enqueued by the producer (epoch seconds)
+    enqueued: float = 0
+    # idempotency key, None when the channel does not suppress duplicates
+    key: Optional[str] = None
+    # sequence number in the write-ahead spool of the worker, None when not journaled
+    spooled: Optional[int] = None
+    # envelope recipients, empty as per the To, Cc & Bcc of `email`
+    rcpts: tuple[str, ...] = ()
+    # member of the retry queue leased to this worker, when the request came back from there
+    leased: Optional[bytes] = None
+
+class DeliveryOutcome(NamedTuple):
+    # None, the SMTP server is done with the eMail (accepted or rejected for good),
+    # else retry after these many seconds (-1, as per the retry backoff).
+    # without an `error`, the eMail was not tried at all (deferred by the rate limits)
+    retry_after: Optional[float] = None
+    # SMTP error, None when the eMail is accepted
+    error: Optional[str] = None
+    # SMTP reply code of the error, if any
+    code: Optional[int] = None
+    # SMTP transaction time in seconds
+    elapsed: float = 0
+    # not sent, the eMail of the same idempotency key was sent already
+    duplicate: bool = False
+    # `host:port` of the SMTP relay of the (last) attempt
+    relay: str = ''
+    # the recipients SMTP refused while it accepted the eMail for the others, `(address, reply code)`
+    refused: tuple[tuple[str, int], ...] = ()
+
+class SmtpDelivery():
+    """
+    asyncio delivery engine, keeps up to `ConfigSMTP.concurrency` SMTP transactions in flight.
+    - the subscription side only converts the request and `submit`s the job, it never talks to the SMTP server.
+    - the jobs wait in a queue per channel, the senders serve them by channel priority & weight (`add_channel`).
+    - each job ends up in the `on_finished` callback exactly once, along with its `DeliveryOutcome`.
+    - every sender task picks a relay (`RelayBalancer`), borrows an authenticated session from its `SmtpPool` and runs
+      the blocking smtplib calls on a worker thread, so a slow relay never stalls the event loop (subscription & the
+      other senders keep running). a relay we can not get a session from is failed over to the next one right away.
+    - with a `RateLimiter`, a sender takes a token of the relay & of the recipient domains before the transaction and
+      reports the throttle replies back to it.
+    - with an `IdempotencyGuard`, a job with a `key` is skipped if its eMail was sent already, and recorded once accepted.
+    """
+
+    logger: ILogger
+    _m_config: ConfigSMTP
+    _m_queue: ChannelScheduler[DeliveryJob]
+    _m_relays: RelayBalancer
+    _m_senders: list[asyncio.Task[None]]
+    _m_on_finished: Callable[[DeliveryJob, DeliveryOutcome], Awaitable[None]]
+    _m_limiter: Optional[RateLimiter]
+    _m_dedup: Optional[IdempotencyGuard]
+
+    __slots__ = ['logger', '_m_config', '_m_queue', '_m_relays', '_m_senders', '_m_on_finished', '_m_limiter',
+                 '_m_dedup']
+
+    def __init__(self, config: ConfigSMTP, logger: ILogger,
+                 on_finished: Callable[[DeliveryJob, DeliveryOutcome], Awaitable[None]],
+                 limiter: Optional[RateLimiter] = None, dedup: Optional[IdempotencyGuard] = None) -> None:
+        self.logger = logger
+        self._m_config = config
+        self._m_queue = ChannelScheduler(config.queue_size)
+        self._m_relays = RelayBalancer(config, logger)
+        self._m_senders = []
+        self._m_on_finished = on_finished
+        self._m_limiter = limiter
+        self._m_dedup = dedup
+
+    def __repr__(self) -> str:
+        return f'SmtpDelivery(senders={len(self._m_senders)}, queued={self._m_queue.qsize()}, {self._m_relays})'
+
+    async def start(self):
+        await self._m_relays.start()
+        self._m_senders = [asyncio.create_task(self._sender()) for _ in range(max(1, self._m_config.concurrency))]
+        self._m_senders += [asyncio.create_task(relay.pool.health_check()) for relay in self._m_relays.relays]
+
+    def add_channel(self, name: str, priority: int = 0, weight: int = 1):
+        """higher `priority` channels are always served first, the ones of the same priority as per their `weight`."""
+        self._m_queue.add_channel(name, priority, weight)
+
+    def full(self, channel: str) -> bool:
+        return self._m_queue.full(channel)
+
+    def max_rcpts(self) -> int:
+        """recipients per SMTP transaction the rate limits let through at once (0, no limit), see `RateLimiter.max_cost`"""
+        return self._m_limiter.max_cost() if self._m_limiter is not None else 0
+
+    def qsize(self, channel: str) -> int:
+        return self._m_queue.qsize(channel)
+
+    async def submit(self, job: DeliveryJob):
+        # waits while all the senders are busy and the queue of the channel is full, this throttles the readers of that channel
+        await self._m_queue.put(job)
+
+    async def stop(self, timeout: float = 20):
+        if not self._m_senders:
+            return
+        try:
+            await asyncio.wait_for(self._m_queue.join(), timeout)
+        except (asyncio.TimeoutError, RuntimeError):
+            self.logger.warning('%d eMail(s) not delivered before shutdown', self._m_queue.qsize())
+        for task in self._m_senders: task.cancel()
+        await asyncio.gather(*self._m_senders, return_exceptions=True)
+        self._m_senders = []
+        await self._m_relays.close()
+
+    @staticmethod
+    def _send(conn: PooledSmtp, job: DeliveryJob) -> dict[str, tuple[int, bytes]]:
+        # runs on a worker thread, the borrowed session is used by no one else until it is released back to the pool.
+        # NOTE: no logging in here, picologging handlers may deadlock when called from a worker thread.
+        conn.sent += 1
+        return conn.smtp.send_message(job.email, to_addrs=job.rcpts or None, mail_options=['SMTPUTF8'])
+
+    async def _deliver(self, job: DeliveryJob) -> DeliveryOutcome:
+        if job.key is None or self._m_dedup is None:
+            return await self._attempt(job)
+        try:
+            if await self._m_dedup.seen(job.channel, job.key):
+                return DeliveryOutcome(duplicate=True)
+        except Exception as excp:
+            # better a duplicate than a lost eMail
+            self.logger.warning('idempotency keys not available: %r', excp)
+            return await self._attempt(job)
+        outcome = await self._attempt(job)
+        try:
+            if outcome.error is None and outcome.retry_after is None:
+                self._m_dedup.record(job.channel, job.key)
+            else:
+                await self._m_dedup.release(job.channel, job.key)
+        except Exception as excp:
+            self.logger.warning('idempotency keys not available: %r', excp)
+        return outcome
+
+    async def _attempt(self, job: DeliveryJob) -> DeliveryOutcome:
+        tried: list[SmtpRelay] = []
+        outcome = DeliveryOutcome()
+        while (relay := self._m_relays.pick(tried)) is not None:
+            tried.append(relay)
+            if self._m_limiter is not None:
+                try:
+                    domains = _domains(job.rcpts) if job.rcpts else _rcpt_domains(job.email)
+                    if wait := await self._m_limiter.acquire(relay.name, domains):
+                        return DeliveryOutcome(wait, relay=relay.name)
+                except Exception as excp:
+                    # the limits are shared through Redis, without it we send at the pace of the relay
+                    self.logger.warning('rate limiter not available: %r', excp)
+            try:
+                conn = await relay.pool.acquire()
+            except (smtplib.SMTPException, OSError) as excp:
+                self.logger.warning('SMTP session to %s not available: %r', relay.name, excp)
+                self._m_relays.report(relay, False)
+                if getattr(excp, 'smtp_code', None) in THROTTLE_CODES:
+                    await self._throttled(relay.name)
+                # nothing was sent yet, on to the next relay
+                outcome = DeliveryOutcome(-1, repr(excp), getattr(excp, 'smtp_code', None), relay=relay.name)
+                continue
+            started = time.perf_counter()
+            relay.in_flight += 1
+            try:
+                outcome = await self._transact(relay, conn, job)
+            finally:
+                relay.in_flight -= 1
+            return outcome._replace(elapsed=time.perf_counter() - started, relay=relay.name)
+        if not tried:
+            # all the relays are out of rotation, wait for the next probe without counting it as an attempt
+            return DeliveryOutcome(max(1.0, self._m_relays.retry_in()))
+        return outcome
+
+    async def _transact(self, relay: SmtpRelay, conn: PooledSmtp, job: DeliveryJob) -> DeliveryOutcome:
+        # the relay is to blame for every failure but the recipients or the content it refused
+        relay_ok = False
+        started = time.perf_counter()
+        try:
+            refused = await asyncio.to_thread(self._send, conn, job)
+            relay_ok = True
+        except smtplib.SMTPSenderRefused as excp:
+            if excp.smtp_code >= 500 and excp.smtp_code <= 599:
+                # session is no more authenticated, drop it and let the retry login again
+                self.logger.debug('Re-trying authentication: (%d) %s', excp.smtp_code, excp.smtp_error)
+                conn.healthy = False
+                return DeliveryOutcome(0, repr(excp), excp.smtp_code)
+            self.logger.warning('SMTP Server Refused with (%d) %s by %s', *excp.args)
+            if excp.smtp_code in THROTTLE_CODES:
+                await self._throttled(relay.name)
+            return DeliveryOutcome(-1, repr(excp), excp.smtp_code)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as excp:
+            codes = [x[0] for x in excp.recipients.values()] if isinstance(excp, smtplib.SMTPRecipientsRefused) else [excp.smtp_code]
+            if all(400 <= code <= 499 for code in codes):
+                # temporary failure (mailbox busy, greylisting, ...)
+                self.logger.warning('SMTP temporarily rejected with %s, will retry', codes)
+                if isinstance(excp, smtplib.SMTPRecipientsRefused):
+                    # refused at RCPT, it is the recipient's domain throttling us
+                    relay_ok = True
+                    await self._throttled(
+                        domains=_domains(rcpt for rcpt, (code, _) in excp.recipients.items() if code in THROTTLE_CODES))
+                elif excp.smtp_code in THROTTLE_CODES:
+                    await self._throttled(relay.name)
+                return DeliveryOutcome(-1, repr(excp), codes[0])
+            relay_ok = True
+            self.logger.error('SMTP rejected due to invalid recipient(s) or Data error, we will not retry this email.')
+            self.logger.error('Subject: %s, To: %s', job.email.get('Subject'), job.email.get('To'))
+            return DeliveryOutcome(None, repr(excp), max(codes))
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError) as excp:
+            self.logger.warning('SMTPServerDisconnected, reconnecting')
+            conn.healthy = False
+            return DeliveryOutcome(-1, repr(excp))
+        except Exception as excp:
+            # not a matter of the relay (e.g. an eMail smtplib can not encode)
+            relay_ok = True
+            conn.healthy = False
+            self.logger.exception(repr(excp))
+            return DeliveryOutcome(None, repr(excp))
+        finally:
+            relay.pool.release(conn)
+            self._m_relays.report(relay, relay_ok, time.perf_counter() - started)
+        if refused:
+            # accepted for the other recipients, those refused at RCPT are up to the caller
+            await self._throttled(domains=_domains(rcpt for rcpt, (code, _) in refused.items() if code in THROTTLE_CODES))
+        return DeliveryOutcome(refused=tuple((rcpt, code) for rcpt, (code, _) in refused.items()))
+
+    async def _throttled(self, relay: str = '', domains: Iterable[str] = ()):
+        if self._m_limiter is None:
+            return
+        try:
+            await self._m_limiter.throttled(relay, domains)
+        except Exception as excp:
+            self.logger.warning('rate limiter not available: %r', excp)
+
+    async def _sender(self):
+        while True:
+            job = await self._m_queue.get()
+            try:
+                await self._m_on_finished(job, await self._deliver(job))
+            except Exception as excp:
+                self.logger.exception(repr(excp))
+            finally:
+                self._m_queue.task_done()
+
+def _domains(addresses: Iterable[str]) -> Counter[str]:
+    # recipients per domain
+    return Counter(addr.rpartition('@')[2].lower() for addr in addresses if '@' in addr)
+
+def _rcpt_domains(email: EmailMessage) -> Counter[str]:
+    # recipients as per `send_message`, To, Cc & Bcc
+    return _domains(addr for _, addr in getaddresses([str(x) for f in ('To', 'Cc', 'Bcc') for x in email.get_all(f, [])]))
@@ -3,48 +3,95 @@
 # SPDX-License-Identifier: MIT
 
 import asyncio
-import multiprocessing
+import os
 import queue
-import random
+import re
 import signal
 import smtplib
+import socket
 import sys
+import time
+from concurrent.futures import BrokenExecutor
 from email.message import EmailMessage
-from typing import Any, Callable, ClassVar, Dict, NoReturn, Optional
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, ClassVar, Dict, NamedTuple, Optional
 
-from confz import BaseConfig, EnvSource
-from nicegui import run
+from confz import EnvSource
 from pydantic import ValidationError
 from redis.asyncio import Redis
 from redis.asyncio.client import PubSub
 
-from .utils import IQueueListener, logging, utils_get_logger
+from .backlog import BacklogReporter
+from .config import ConfigSMTP
+from .dedup import IdempotencyGuard, idempotency_key
+from .delivery import DeliveryJob, DeliveryOutcome, SmtpDelivery
+from .fanout import FanoutConverter, FanoutRecipient, FanoutRenderer, FanoutRequest, group_key, iter_recipients
+from .metrics import Metrics, read_stats
+from .pipeline import ConvertJob, ConvertStage
+from .ratelimit import RateLimiter
+from .retry import RetryEntry, RetryQueue
+from .spool import SpoolEntry, WriteAheadSpool
+from .streams import ETransport, StreamConsumer
+from .utils import LOG_QUEUE_SIZE, IQueueListener, logging, utils_get_logger
+
+if TYPE_CHECKING:
+    from .supervisor import WorkerSupervisor
 
 log_listener: IQueueListener
-mail_process_tasks: list[asyncio.Task[None]] = []
-
-class ConfigSMTP(BaseConfig):
-    host: str
-    port: int = 25
-    starttls: bool = False
-    from_email: str
-    username: str
-    password: str
-    keep_alive_interval: int = 120
-    debug: bool = False
+supervisor: Optional['WorkerSupervisor'] = None
+supervisor_task: Optional[asyncio.Task[None]] = None
+
+# seconds a worker takes beyond `ConfigSMTP.drain_timeout` to close down (flushes to Redis & the spool)
+CLOSURE_GRACE = 10
+
+def stop_timeout() -> float:
+    """seconds to wait for the workers to close down on SIGTERM before they are killed, as per their settings"""
+    try:
+        drain = ConfigSMTP(config_sources=EnvSource(allow_all=True, prefix='SMTP_')).drain_timeout
+    except ValidationError:
+        # the workers do not even start
+        drain = ConfigSMTP.model_fields['drain_timeout'].default
+    return drain + CLOSURE_GRACE
+
+class ChannelConfig(NamedTuple):
+    transport: ETransport = ETransport.PUBSUB
+    # None, as per `ConfigSMTP.retry_max_attempts`
+    max_attempts: Optional[int] = None
+    # scheduling of the delivery engine, higher priority first, share of the senders by weight within a priority
+    priority: int = 0
+    weight: int = 1
+    # suppress duplicates by idempotency key
+    dedup: bool = False
+    # requests are `FanoutRequest`s, one eMail to many recipients
+    fanout: bool = False
 
 class SrvcEmail():
 
     self_objects:ClassVar[dict[int, 'SrvcEmail']] = {}
     logger: logging.Logger
     _m_memdb_host: str
+    _m_memdb_port: int
+    _m_workers: int
     _m_config: ConfigSMTP
-    m_smtp: smtplib.SMTP
-    m_subscription: PubSub
+    m_delivery: SmtpDelivery
+    m_convert: ConvertStage
+    m_redis: Redis
+    # a subscription (connection & reader) per pub/sub channel, a channel waiting for room in its queues holds up no other
+    m_subscriptions: Dict[str, PubSub]
+    m_streams: StreamConsumer
+    m_retry: RetryQueue
+    m_metrics: Metrics
+    m_backlog: BacklogReporter
+    m_dedup: IdempotencyGuard
+    m_spool: WriteAheadSpool
+    m_worker: str
     m_channel_map: Dict[str, Callable[[bytes | bytearray], EmailMessage]]
-    m_task_keep_alive: asyncio.Task[NoReturn]
+    m_channel_cfg: Dict[str, ChannelConfig]
+    # transactions in flight of the fan-out stream requests (+1 while they are being fanned out), by channel & entry id
+    m_fanout: Dict[tuple[str, bytes], int]
 
-    __slots__ = ['_m_memdb_host', '_m_config', 'm_smtp', 'm_subscription', 'm_channel_map', 'm_task_keep_alive']
+    __slots__ = ['_m_memdb_host', '_m_memdb_port', '_m_workers', '_m_config', 'm_delivery', 'm_convert', 'm_redis',
+                 'm_subscriptions', 'm_streams', 'm_retry', 'm_metrics', 'm_backlog', 'm_dedup', 'm_spool', 'm_worker', 'm_channel_map',
+                 'm_channel_cfg', 'm_fanout']
 
     def __new__(cls, *args, **kwargs):
         rtn = super().__new__(cls)
@@ -54,15 +101,29 @@ class SrvcEmail():
     def __del__(self):
         del self.self_objects[id(self)]
 
-    def __init__(self, memdb_host: str) -> None:
+    def __init__(self, memdb_host: str, workers: int = 1, memdb_port: int = 6379) -> None:
+        """
+        `workers`, number of processes serving the channels of this object. more than one only pays off for the
+        `ETransport.STREAM` channels, every process subscribed to a `ETransport.PUBSUB` channel sends its own copy.
+        """
         self._m_memdb_host = memdb_host
+        self._m_memdb_port = memdb_port
+        self._m_workers = workers
         self.m_channel_map = {}
+        self.m_channel_cfg = {}
+        self.m_fanout = {}
 
     def __repr__(self) -> str:
-        rtn = f'0x{id(self):x} ->\n'
+        rtn = f'0x{id(self):x} -> workers: {self._m_workers}\n'
+        if hasattr(self, 'm_worker'): rtn += f'\tWorker: {self.m_worker}\n'
         if hasattr(self, '_m_config'): rtn += f'\tSMTP Config: {self._m_config}\n'
         if hasattr(self, 'm_channel_map'): rtn += f'\t{self.m_channel_map}\n'
-        if hasattr(self, 'm_subscription'): rtn += f'\t{self.m_subscription}'
+        if hasattr(self, 'm_subscriptions'): rtn += f'\t{self.m_subscriptions}\n'
+        if hasattr(self, 'm_streams'): rtn += f'\t{self.m_streams}\n'
+        if hasattr(self, 'm_retry'): rtn += f'\t{self.m_retry}\n'
+        if hasattr(self, 'm_convert'): rtn += f'\t{self.m_convert}\n'
+        if hasattr(self, 'm_spool'): rtn += f'\t{self.m_spool}\n'
+        if hasattr(self, 'm_delivery'): rtn += f'\t{self.m_delivery}'
         return rtn
 
     def __enter__(self):
@@ -71,143 +132,463 @@ class SrvcEmail():
     def __exit__(self, exc_type, exc_value, exc_traceback):
         pass
 
-    def _message_handler_(self, message: Dict[str, Any]):
-        async def _republish(wait_time:float):
-            await asyncio.sleep(wait_time)
-            await Redis(host=self._m_memdb_host).publish(message['channel'], message['data'])
-
-        def republish(wait_time:float = -1):
-            wait_time = random.randrange(5, 30, 5) if wait_time < 0 else wait_time
-            asyncio.run_coroutine_threadsafe(_republish(wait_time), asyncio.get_event_loop())
+    def _record(self, job: DeliveryJob, outcome: DeliveryOutcome):
+        metrics = self.m_metrics
+        if outcome.elapsed:
+            metrics.observe(job.channel, 'smtp_seconds', outcome.elapsed)
+        if outcome.duplicate:
+            metrics.incr(job.channel, 'duplicates')
+        elif outcome.error is None and outcome.retry_after is not None:
+            metrics.incr(job.channel, 'deferred')
+        elif outcome.error is None:
+            metrics.incr(job.channel, 'sent')
+            if outcome.relay:
+                metrics.incr(job.channel, f'relay:{outcome.relay}')
+            if job.enqueued:
+                metrics.observe(job.channel, 'e2e_seconds', time.time() - job.enqueued)
+        elif outcome.code is not None:
+            metrics.incr(job.channel, f'refused:{outcome.code}')
+
+    async def _retry(self, entry: RetryEntry, retry_after: float):
+        max_attempts = self.m_channel_cfg[entry.channel].max_attempts or self._m_config.retry_max_attempts
+        if entry.attempt < max_attempts:
+            self.m_metrics.incr(entry.channel, 'retries')
+            await self.m_retry.schedule(entry, retry_after)
+        else:
+            self.m_metrics.incr(entry.channel, 'dead_letters')
+            await self.m_retry.dead_letter(entry)
+
+    async def _refused(self, job: DeliveryJob, refused: tuple[tuple[str, int], ...]):
+        # SMTP accepted the eMail for the other recipients of the transaction
+        for _, code in refused:
+            self.m_metrics.incr(job.channel, f'refused:{code}')
+        if not self.m_channel_cfg[job.channel].fanout:
+            self.logger.warning('SMTP refused recipient(s) %s, Subject: %s', refused, job.email.get('Subject'))
+            return
+        request = FanoutRequest.decode(job.data)
+        for temporary in (True, False):
+            addresses = {rcpt for rcpt, code in refused if (400 <= code <= 499) == temporary}
+            if not addresses:
+                continue
+            entry = RetryEntry(job.channel, FanoutRequest(request.data, tuple(
+                x for x in request.recipients if x.to in addresses), None, request.trusted).encode(), job.attempt + 1,
+                f'recipient(s) refused: {[x for x in refused if x[0] in addresses]}', job.enqueued)
+            if temporary:
+                # the refused recipients only, in a transaction of their own
+                await self._retry(entry, -1)
+            else:
+                self.m_metrics.incr(job.channel, 'dead_letters')
+                await self.m_retry.dead_letter(entry)
 
-        # self.logger.debug('from _message_handler_: %s', message)
-        email_msg:Optional[EmailMessage] = None
+    async def _delivered(self, job: DeliveryJob, outcome: DeliveryOutcome):
+        self._record(job, outcome)
+        self.m_backlog.done(job.channel)
         try:
-            registered_handler = self.m_channel_map[message['channel'].decode()]
-            if registered_handler:
-                email_msg = registered_handler(message['data'])
-                self.m_smtp.send_message(email_msg, mail_options=['SMTPUTF8'])
-            else:
-                self.logger.warning('No eMail handler found for channel: %s', message['channel'])
-        except smtplib.SMTPSenderRefused as excp:
-            if excp.smtp_code >= 500 and excp.smtp_code <= 599:
-                if self._m_config.starttls: self.m_smtp.starttls()
-                rslt = self.m_smtp.login(self._m_config.username, self._m_config.password)
-                self.logger.debug('Re-trying authentication: %s', rslt)
-                republish(0)
-            else:
-                self.logger.warning('SMTP Server Refused with (%d) %s by %s', *excp.args)
-        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
-            self.logger.error('SMTP rejected due to invalid recipient(s) or Data error, we will not retry this email.')
-            if email_msg: self.logger.error('Subject: %s, To: %s', email_msg.get('Subject'), email_msg.get('To'))
-        except smtplib.SMTPServerDisconnected:
-            self.logger.warning('SMTPServerDisconnected, reconnecting')
-            self._reconnect_smtp()
-            republish()
+            if outcome.refused:
+                await self._refused(job, outcome.refused)
+            if outcome.retry_after is not None and outcome.error is None:
+                # over the rate limits, back to the retry queue without counting it as an attempt
+                await self.m_retry.schedule(RetryEntry(job.channel, job.data, job.attempt, None, job.enqueued),
+                                            outcome.retry_after)
+            elif outcome.retry_after is not None:
+                await self._retry(RetryEntry(job.channel, job.data, job.attempt + 1, outcome.error, job.enqueued),
+                                  outcome.retry_after)
+            elif outcome.error is not None:
+                self.m_metrics.incr(job.channel, 'dead_letters')
+                await self.m_retry.dead_letter(
+                    RetryEntry(job.channel, job.data, job.attempt + 1, outcome.error, job.enqueued))
         except Exception as excp:
+            # stream request stays pending, it is claimed back (XAUTOCLAIM) once idle for `stream_claim_idle_ms`,
+            # a spooled one stays in the spool until the next start
             self.logger.exception(repr(excp))
+            # & a leased retry is due again once its lease is over
+            if job.msg_id is not None:
+                self.m_streams.release(job.channel, job.msg_id)
+            if job.leased is not None:
+                self.m_retry.release(job.channel, job.leased)
+            return
+        await self._handed_over(job.channel, job.msg_id, job.leased)
+        if job.spooled is not None:
+            self.m_spool.done(job.spooled)
+
+    def _backlog_depth(self, ch_name: str) -> int:
+        # requests waiting for their conversion, eMails for a sender & the ones parked on disk
+        rtn = self.m_convert.qsize(ch_name) + self.m_delivery.qsize(ch_name)
+        if hasattr(self, 'm_spool'):
+            rtn += self.m_spool.parked(ch_name)
+        return rtn
 
-    def register_email_channel(self, ch_name:str, ch_mssg_conv: Callable[[bytes | bytearray], EmailMessage]):
-        self.m_channel_map[ch_name] = ch_mssg_conv
-
-    async def _keep_alive_smtp(self, interval:int = 60):
-        while True:
-            await asyncio.sleep(interval)
-            try:
-                self.m_smtp.noop()
-            except smtplib.SMTPServerDisconnected:
-                self.logger.debug('SMTPServerDisconnected, reconnecting')
-                self._reconnect_smtp()
-            except Exception as excp:
-                self.logger.exception(repr(excp))
-
-    def _terminate_smtp(self):
+    async def _handle_request(self, ch_name: str, data: bytes | bytearray, msg_id: Optional[bytes] = None,
+                              attempt: int = 0, enqueued: float = 0, leased: Optional[bytes] = None):
+        if not enqueued:
+            # stream entry ids start with the enqueue time in ms, pub/sub messages are delivered right away
+            enqueued = int(msg_id.split(b'-', 1)[0]) / 1000 if msg_id else time.time()
+        if not self.m_channel_map.get(ch_name):
+            self.logger.warning('No eMail handler found for channel: %s', ch_name)
+            if msg_id is not None:
+                self.m_streams.release(ch_name, msg_id)
+            if leased is not None:
+                self.m_retry.release(ch_name, leased)
+            return
+        self.m_metrics.incr(ch_name, 'received')
+        # the request is converted off the event loop by the conversion stage and then handed over to the delivery
+        # engine, neither the conversion nor the SMTP I/O runs on the subscription
+        await self.m_convert.submit(ConvertJob(ch_name, data, msg_id, attempt, enqueued, leased))
+
+    async def _converted(self, job: ConvertJob, email_msg: EmailMessage, elapsed: float):
+        self.m_metrics.observe(job.channel, 'convert_seconds', elapsed)
+        if self.m_channel_cfg[job.channel].fanout:
+            await self._fan_out(job, email_msg)
+            return
+        key = idempotency_key(job.channel, job.data, email_msg) if self.m_channel_cfg[job.channel].dedup else None
+        await self._submit(DeliveryJob(job.channel, job.data, email_msg, job.msg_id, job.attempt, job.enqueued, key,
+                                       leased=job.leased))
+
+    async def _submit(self, job: DeliveryJob, raw: Optional[bytes] = None):
+        """`raw`, the eMail as serialized by `EmailMessage.as_bytes` if at hand"""
+        if job.msg_id is None and hasattr(self, 'm_spool'):
+            # journaled before it is sent, a stream request is kept in its stream until acknowledged anyway
+            spooled = await self.m_spool.append(SpoolEntry(job.channel, bytes(job.data), raw or job.email.as_bytes(),
+                                                           job.attempt, job.enqueued, job.key))
+            if job.leased is not None:
+                # the spool has it now, not the retry queue
+                await self._handed_over(job.channel, None, job.leased)
+                job = job._replace(leased=None)
+            if self.m_spool.parked(job.channel) or self.m_delivery.full(job.channel):
+                # on disk only, until its channel has room. the receiving side goes on meanwhile
+                self.m_spool.park(job.channel, spooled)
+                self.m_metrics.incr(job.channel, 'parked')
+                return
+            job = job._replace(spooled=spooled)
+        await self.m_delivery.submit(job)
+
+    async def _spool_submit(self, seq: int, entry: SpoolEntry):
+        rcpts = FanoutRequest.decode(entry.data).addresses() if self.m_channel_cfg[entry.channel].fanout else ()
+        await self.m_delivery.submit(DeliveryJob(entry.channel, entry.data, entry.message(), None, entry.attempt,
+                                                 entry.enqueued, entry.key, seq, rcpts))
+
+    async def _fan_out(self, job: ConvertJob, email_msg: EmailMessage):
+        """
+        the eMail converted once goes to all the recipients of the request, `ConfigSMTP.fanout_batch` of them per SMTP
+        transaction (the personal ones one by one). every transaction is a delivery job of its own, with the request of
+        its recipients only, so that a retry (or the spool) sends to those only.
+        - a recipient whose personal copy fails to render (e.g. a line break in a header of its own) is dead-lettered,
+          a transaction failing to be submitted is retried, both on their own while the others go on
+        - the recipients key failing to be read, the recipients not read yet are retried (`FanoutRequest.offset`)
+        """
+        request = FanoutRequest.decode(job.data)
+        # the same keys for every subscriber, retry & claim of the request, by transaction
+        key = idempotency_key(job.channel, request.data, email_msg) if self.m_channel_cfg[job.channel].dedup else None
+        renderer = FanoutRenderer(email_msg, request.trusted)
+        # a transaction takes a rate limit token per recipient, never more than the burst of a limit
+        batch = max(1, self._m_config.fanout_batch)
+        if limit := self.m_delivery.max_rcpts():
+            batch = min(batch, limit)
+        # acknowledged (or done with in the retry queue) once the last transaction is done, not before all of them are
+        # submitted
+        token = job.msg_id if job.msg_id is not None else job.leased
+        if token is not None:
+            self.m_fanout[(job.channel, token)] = 1
+        # members of the recipients key read so far
+        read = 0
+
+        async def recipients() -> AsyncIterator[FanoutRecipient]:
+            nonlocal read
+            for rcpt in request.recipients:
+                yield rcpt
+            if request.key:
+                async for rcpt in iter_recipients(self.m_redis, request.key, request.offset):
+                    read += 1
+                    yield rcpt
+
+        count = 0
         try:
-            self.m_smtp.quit()
-        except smtplib.SMTPServerDisconnected:
-            pass
-
-    def _reconnect_smtp(self):
+            async for rcpts, personal in renderer.groups(recipients(), batch):
+                if not await self._fan_out_group(job, request, renderer, rcpts, personal, key, token):
+                    # the request stays pending (or leased), as per `_delivered`
+                    return
+                count += len(rcpts)
+        except Exception as excp:
+            # the recipients key is not readable (any more), those read are on their way
+            self.logger.warning('fan-out of %s stopped after %d recipient(s): %r', job.channel, count, excp)
+            rest = FanoutRequest(request.data, (), request.key, request.trusted, request.offset + read)
+            await self._delivered(DeliveryJob(job.channel, rest.encode(), EmailMessage(), job.msg_id, job.attempt,
+                                              job.enqueued, leased=job.leased), DeliveryOutcome(-1, repr(excp)))
+        else:
+            await self._handed_over(job.channel, job.msg_id, job.leased)
+        finally:
+            self.m_metrics.incr(job.channel, 'fanout_recipients', count)
+
+    async def _fan_out_group(self, job: ConvertJob, request: FanoutRequest, renderer: FanoutRenderer,
+                             rcpts: tuple[FanoutRecipient, ...], personal: bool, key: Optional[str],
+                             token: Optional[bytes]) -> bool:
+        """a transaction of `_fan_out` on its way. False, neither sent, nor retried, nor dead-lettered"""
+        data = FanoutRequest(request.data, rcpts, None, request.trusted).encode()
+        addresses = tuple(x.to for x in rcpts)
         try:
-            # try:
-            #     self._terminate_smtp()
-            # except Exception:
-            #     pass
-            rslt = self.m_smtp.connect(self._m_config.host, self._m_config.port)
-            self.logger.debug('connect: %s', rslt)
-            # if self._m_config.starttls: self.m_smtp.starttls()
-            rslt = self.m_smtp.login(self._m_config.username, self._m_config.password)
-            self.logger.debug('authentication: %s', rslt)
-        except (smtplib.SMTPAuthenticationError, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as excp:
-            self.logger.warning('SMTPException: %r', excp)
+            try:
+                email = renderer.personal(rcpts[0]) if personal else renderer.shared
+            except Exception as excp:
+                # never rendered any better by a retry
+                self.logger.warning('fan-out of %s to %s: %r', job.channel, addresses[0], excp)
+                self.m_metrics.incr(job.channel, 'dead_letters')
+                await self.m_retry.dead_letter(RetryEntry(job.channel, data, job.attempt + 1, repr(excp), job.enqueued))
+                return True
+            if token is not None:
+                self.m_fanout[(job.channel, token)] += 1
+            try:
+                await self._submit(DeliveryJob(job.channel, data, email, job.msg_id, job.attempt, job.enqueued,
+                                               key and group_key(key, addresses), rcpts=addresses, leased=job.leased),
+                                   None if personal else renderer.raw)
+            except Exception as excp:
+                # e.g. the spool not writable
+                self.logger.warning('fan-out of %s to %d recipient(s): %r', job.channel, len(addresses), excp)
+                if token is not None:
+                    self.m_fanout[(job.channel, token)] -= 1
+                await self._retry(RetryEntry(job.channel, data, job.attempt + 1, repr(excp), job.enqueued), -1)
         except Exception as excp:
             self.logger.exception(repr(excp))
+            if job.msg_id is not None:
+                self.m_streams.release(job.channel, job.msg_id)
+            if job.leased is not None:
+                self.m_retry.release(job.channel, job.leased)
+            return False
+        return True
+
+    async def _handed_over(self, channel: str, msg_id: Optional[bytes], leased: Optional[bytes]):
+        # SMTP, the dead-letter list, the retry queue (as a new entry) or the spool has the request now
+        if msg_id is not None and self._settled(channel, msg_id):
+            self.m_streams.ack(channel, msg_id)
+        if leased is not None and self._settled(channel, leased):
+            await self.m_retry.done(channel, leased)
+
+    def _settled(self, channel: str, token: bytes) -> bool:
+        """True, the stream request (or leased retry) is done with (the last transaction of a fan-out one)"""
+        key = (channel, token)
+        if key not in self.m_fanout:
+            return True
+        self.m_fanout[key] -= 1
+        if self.m_fanout[key] > 0:
+            return False
+        del self.m_fanout[key]
+        return True
+
+    async def _convert_failed(self, job: ConvertJob, excp: Exception):
+        self.logger.exception(repr(excp))
+        # a request we can not convert will never be sent. the conversion pool broken twice while converting it
+        # (e.g. by an other request), it is retried though, its attempts bound the ones breaking the pool every time
+        retry_after = -1 if isinstance(excp, BrokenExecutor) else None
+        await self._delivered(DeliveryJob(job.channel, job.data, EmailMessage(), job.msg_id, job.attempt, job.enqueued,
+                                          leased=job.leased), DeliveryOutcome(retry_after, repr(excp)))
+
+    async def _handle_retry(self, entry: RetryEntry, member: bytes):
+        await self._handle_request(entry.channel, entry.data, attempt=entry.attempt, enqueued=entry.enqueued,
+                                   leased=member)
+
+    async def _message_handler_(self, message: Dict[str, Any]):
+        # self.logger.debug('from _message_handler_: %s', message)
+        await self._handle_request(message['channel'].decode(), message['data'])
+
+    def register_email_channel(self, ch_name:str, ch_mssg_conv: Callable[[bytes | bytearray], EmailMessage],
+                               transport: ETransport = ETransport.PUBSUB, max_attempts: Optional[int] = None,
+                               priority: int = 0, weight: int = 1, dedup: bool = False, fanout: bool = False):
+        """
+        map the channel `ch_name` to its request to `EmailMessage` converter `ch_mssg_conv`.
+        - `ETransport.PUBSUB`, requests are `PUBLISH`ed, every object registering the channel sends its own copy
+        - `ETransport.STREAM`, requests are `XADD`ed to the stream `ch_name` (field `data`), each one is sent by one
+          worker only and acknowledged after SMTP accepted it, so a channel can be scaled over many processes/hosts
+        - `max_attempts`, SMTP delivery attempts before the request is moved to the dead-letter list
+          `email:dead:<ch_name>`, defaults to `ConfigSMTP.retry_max_attempts`
+        - `priority` & `weight`, the requests of every channel wait in a queue of their own within the process, the ones
+          of a higher `priority` channel are always sent first, the channels of the same priority share the SMTP
+          senders as per their `weight`. e.g. login notifications at priority 1 never wait behind a bulk channel.
+        - `dedup`, an eMail is sent only once per `ConfigSMTP.dedup_ttl` seconds whatever retries, restarts or
+          subscribers there are. its idempotency key is the Message-ID set by `ch_mssg_conv` (e.g. out of a request id
+          of the payload), else a hash of the request.
+        - `fanout`, one eMail to many recipients, the requests are sent with `EmailClient.send_fanout`. `ch_mssg_conv`
+          builds the eMail once per request, the recipients get it in SMTP transactions of up to
+          `ConfigSMTP.fanout_batch` recipients each (To: undisclosed-recipients). a recipient with substitutions
+          (`$name` of the Subject & text parts) or headers of its own gets a personal copy, in a transaction of its own.
+        """
+        self.m_channel_map[ch_name] = FanoutConverter(ch_mssg_conv) if fanout else ch_mssg_conv
+        self.m_channel_cfg[ch_name] = ChannelConfig(ETransport(transport), max_attempts, priority, weight, dedup,
+                                                    fanout)
 
     async def _do_work(self):
         """
         This method performs the main work of watching for incoming mail request and sends it out via SMTP.
         - set up a global signal handlers for CTRL+C(SIGINT) & Process Kill(SIGTERM) so that we can terminate our process
-        - subscribes to list of channel as requested by user via `register_email_channel`
+        - starts the conversion stage, the user supplied message converters run on a thread/process pool
+          (`ConfigSMTP.convert_executor`) fed by a bounded queue per channel.
+        - starts the SMTP delivery engine, which keeps up to `ConfigSMTP.concurrency` mails in flight over the relays
+          of `ConfigSMTP.relay_list()` (balanced by latency & error rate, failing ones taken out of rotation),
+          within the send rate limits shared by all the workers (if configured).
+          the requests wait in a queue per channel, served by channel priority & weight.
+        - starts the retry queue pollers (one per channel), failed mails are retried with exponential backoff and
+          dead-lettered at the end.
+        - reports the backlog (depth & drain rate) per channel to Redis every `ConfigSMTP.backlog_interval` seconds, for
+          the admission control of the producers (`EmailClient(admission=...)`).
+        - with `ConfigSMTP.spool_dir`, opens the write-ahead spool of this worker, the converted mails not sent by the
+          last run (& by the workers gone for good, see `WriteAheadSpool.adopt`) are sent first. mails beyond the
+          delivery queue wait in the spool, fed to the delivery engine in order.
+        - fan-out channels, the eMail converted once per request is submitted once per group of recipients.
+        - subscribes to list of channel as requested by user via `register_email_channel`, each one on a connection of
+          its own, the `ETransport.STREAM` channels are read via a Redis Streams consumer group instead (a loop per stream).
         - listens for mail request messages on the channels endlessly.
-            - upon receiving a message, call the `_message_handler_`, process it using the user supplied message converter and send out the mail.
-            - if parent process request us stop via SIGINT or SIGTERM, we raise `asyncio.CancelledError` and wait for closure.
-        - Finally, the subscription is closed.
+            - upon receiving a message, call the `_message_handler_`, which queues it for the conversion stage, the
+              converted mail is submitted to the delivery engine which sends it out.
+            - if parent process request us stop via SIGINT or SIGTERM, we get `asyncio.CancelledError` and wait for closure.
+        - Finally, the subscription is closed, also when the setup or a listener fails.
 
-        Raises: None
+        Raises: the failure of the setup (e.g. SMTP relay unreachable) or of a listener (e.g. Redis gone), once closed
         """
         def raise_cancel(sig, frame):
             raise asyncio.CancelledError()
 
-        signal.signal(signal.SIGINT, raise_cancel)
-        signal.signal(signal.SIGTERM, raise_cancel)
-
-        # prepare the channel, allows us to listen for the messages under this subscription
-        # WRKARND: we wait for each subscription to complete before moving to the next one.
-        for ch_name in self.m_channel_map.keys():
-            await self.m_subscription.subscribe(ch_name, **{ch_name: self._message_handler_})
-
-        # BUG: gathering coroutines in a list and then awaiting them is not working as expected.
-        # async with asyncio.TaskGroup() as tg:
-        #     for ch_name in self.m_channel_map.keys():
-        #         tg.create_task(self.m_subscription.subscribe(ch_name, **{ch_name: self._message_handler_}))
-
-        # rslt = map(lambda ch_name: self.m_subscription.subscribe(ch_name, **{ch_name: self._message_handler_}), self.m_channel_map.keys())
-        # rslt = await asyncio.gather(*rslt)
-        # self.logger.debug('subscribed:', rslt)
-
-        # now listen for the messages endlessly and do SMTP connection maintenance
-        self.m_task_keep_alive = asyncio.create_task(self._keep_alive_smtp(self._m_config.keep_alive_interval))
         try:
-            await self.m_subscription.run()
+            # cancel our own task from within the loop, so that the closure runs at a well defined await point
+            main_task = asyncio.current_task()
+            assert main_task is not None
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                asyncio.get_running_loop().add_signal_handler(sig, main_task.cancel)
+        except NotImplementedError:
+            # no loop signal handlers on Windows
+            signal.signal(signal.SIGINT, raise_cancel)
+            signal.signal(signal.SIGTERM, raise_cancel)
+
+        tasks: list[asyncio.Future] = []
+        try:
+            self.m_metrics = Metrics(self.m_redis, self.m_worker, self.logger, self._m_config.metrics_interval)
+            self.m_backlog = BacklogReporter(self.m_redis, self.m_worker, list(self.m_channel_map), self._backlog_depth,
+                                             self.logger, self._m_config.backlog_interval)
+            limiter = None
+            if self._m_config.rate_limit > 0 or self._m_config.rate_limit_domains:
+                limiter = RateLimiter(self.m_redis, self._m_config, self.logger)
+            dedup_channels = [ch for ch, cfg in self.m_channel_cfg.items() if cfg.dedup]
+            self.m_dedup = IdempotencyGuard(
+                self.m_redis, self._m_config, self.logger,
+                claim_channels=[ch for ch in dedup_channels if self.m_channel_cfg[ch].transport == ETransport.PUBSUB])
+            self.m_delivery = SmtpDelivery(self._m_config, self.logger, self._delivered, limiter,
+                                           self.m_dedup if dedup_channels else None)
+            for ch_name, cfg in self.m_channel_cfg.items():
+                self.m_delivery.add_channel(ch_name, cfg.priority, cfg.weight)
+            await self.m_delivery.start()
+            self.m_convert = ConvertStage(self._m_config, self.logger, self.m_channel_map, self._converted,
+                                          self._convert_failed)
+            await self.m_convert.start()
+            if self._m_config.spool_dir:
+                self.m_spool = WriteAheadSpool(os.path.join(self._m_config.spool_dir, re.sub(r'[^\w.-]+', '_', self.m_worker)),
+                                               self._m_config, self.logger)
+                self.m_spool.open()
+                await self.m_spool.adopt(list(self.m_channel_map))
+
+            # failed eMails come back through a batched poller of the retry queue per channel
+            self.m_retry = RetryQueue(
+                self.m_redis, list(self.m_channel_map.keys()), self._handle_retry, self.logger,
+                self._m_config.retry_base_delay, self._m_config.retry_max_delay, self._m_config.retry_poll_interval,
+                dead_letter_max=self._m_config.dead_letter_max, lease=self._m_config.retry_lease)
+            listeners = [self.m_retry.run(), self.m_metrics.run(), self.m_backlog.run()]
+            if dedup_channels:
+                listeners.append(self.m_dedup.run(dedup_channels))
+            if hasattr(self, 'm_spool'):
+                listeners.append(self.m_spool.run())
+                listeners += [self.m_spool.feed(ch_name, self._spool_submit) for ch_name in self.m_channel_map]
+            pubsub_channels = [ch for ch, cfg in self.m_channel_cfg.items() if cfg.transport == ETransport.PUBSUB]
+            stream_channels = [ch for ch, cfg in self.m_channel_cfg.items() if cfg.transport == ETransport.STREAM]
+
+            # prepare the channel, allows us to listen for the messages under this subscription
+            # WRKARND: we wait for each subscription to complete before moving to the next one.
+            for ch_name in pubsub_channels:
+                subscription = self.m_subscriptions[ch_name] = self.m_redis.pubsub()
+                await subscription.subscribe(ch_name, **{ch_name: self._message_handler_})
+                listeners.append(subscription.run())
+
+            if stream_channels:
+                self.m_streams = StreamConsumer(
+                    self.m_redis, stream_channels, self._handle_request, self.logger, self._m_config.stream_group,
+                    consumer=self.m_worker, count=self._m_config.stream_count, block_ms=self._m_config.stream_block_ms,
+                    claim_idle_ms=self._m_config.stream_claim_idle_ms)
+                await self.m_streams.start()
+                listeners.append(self.m_streams.run())
+
+            # BUG: gathering coroutines in a list and then awaiting them is not working as expected.
+            # async with asyncio.TaskGroup() as tg:
+            #     for ch_name in self.m_channel_map.keys():
+            #         tg.create_task(self.m_subscription.subscribe(ch_name, **{ch_name: self._message_handler_}))
+
+            # rslt = map(lambda ch_name: self.m_subscription.subscribe(ch_name, **{ch_name: self._message_handler_}), self.m_channel_map.keys())
+            # rslt = await asyncio.gather(*rslt)
+            # self.logger.debug('subscribed:', rslt)
+
+            # now listen for the messages endlessly, SMTP connection maintenance is done by the delivery engine
+            tasks += [asyncio.ensure_future(x) for x in listeners]
+            await asyncio.gather(*tasks)
         except asyncio.CancelledError:
             self.logger.debug('closing subscription')
-            await self.do_force_closure()
-        except Exception as excp:
-            self.logger.exception(repr(excp))
+            await self._shutdown(tasks)
+        except Exception:
+            # e.g. the SMTP relay or Redis unreachable, closed down on this loop (its objects are bound to it) and
+            # raised on to `entry`, the worker exits non-zero to be restarted
+            try:
+                await self._shutdown(tasks)
+            except Exception as excp:
+                self.logger.debug('closure: %r', excp)
+            raise
         finally:
             self.logger.debug('_do_work, finally')
 
-    async def do_force_closure(self):
-        if hasattr(self, 'm_task_keep_alive.cancel'):
-            self.m_task_keep_alive.cancel()
-        if hasattr(self, 'm_subscription.aclose'):
-            await self.m_subscription.aclose()
+    async def _shutdown(self, tasks: list[asyncio.Future]):
+        # the listeners are done with their Redis commands before the closure flushes what they left behind
+        if hasattr(self, 'm_streams'):
+            self.m_streams.stop()
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.do_force_closure()
 
-    def entry(self, que: queue.Queue, log_level:int = logging.DEBUG):
+    async def do_force_closure(self):
+        # both stages drain within `drain_timeout`, the supervisor kills the worker not much later
+        deadline = time.monotonic() + self._m_config.drain_timeout
+        if hasattr(self, 'm_convert'):
+            await self.m_convert.stop(self._m_config.drain_timeout)
+        if hasattr(self, 'm_delivery'):
+            await self.m_delivery.stop(max(0.0, deadline - time.monotonic()))
+        if hasattr(self, 'm_spool'):
+            await self.m_spool.close()
+        if hasattr(self, 'm_streams'):
+            await self.m_streams.flush()
+        if hasattr(self, 'm_dedup'):
+            await self.m_dedup.flush()
+        if hasattr(self, 'm_metrics'):
+            await self.m_metrics.flush()
+        if hasattr(self, 'm_backlog'):
+            await self.m_backlog.close()
+        if hasattr(self, 'm_subscriptions'):
+            for subscription in self.m_subscriptions.values():
+                await subscription.aclose()
+        if hasattr(self, 'm_redis'):
+            await self.m_redis.aclose()
+
+    def entry(self, que: Optional[queue.Queue], log_level:int = logging.DEBUG, worker: Optional[str] = None):
+        """
+        `worker`, name of this worker process, used as Redis Streams consumer name and in the metrics.
+        a name stable over restarts lets the restarted worker pick its pending stream requests right away.
+        `que`, log queue of the parent process, None logs to stderr right away (a worker of its own, see `worker.main`).
+        the process exits with 1 (`sys.exit`) once the worker failed (e.g. SMTP relay or Redis unreachable), so that
+        `WorkerSupervisor` restarts it. it returns on SIGINT/SIGTERM and on invalid settings or SMTP credentials.
+        """
+        self.m_worker = worker or f'{socket.gethostname()}:{os.getpid()}'
         SrvcEmail.logger = utils_get_logger(self.__class__.__name__, que, log_level, '%(levelname)s:%(name)s:%(process)d => %(message)s')
 
+        # non-zero, the worker failed & is restarted by the supervisor. a configuration error is not fixed by a restart
+        exitcode = 1
         try:
             self._m_config = ConfigSMTP(config_sources=EnvSource(allow_all=True, prefix='SMTP_'))
-            self.m_subscription = Redis(host=self._m_memdb_host).pubsub()
-            self.m_smtp = smtplib.SMTP(self._m_config.host, self._m_config.port, timeout=30)
-            self.m_smtp.set_debuglevel(1 if self._m_config.debug else 0)
+            self.m_redis = Redis(host=self._m_memdb_host, port=self._m_memdb_port)
+            self.m_subscriptions = {}
             self.logger.debug('self %r', self)
-            if self._m_config.starttls:
-                self.m_smtp.starttls()
-            rslt = self.m_smtp.login(self._m_config.username, self._m_config.password)
-            self.logger.info('login: %s', rslt)
 
             asyncio.run(self._do_work())
+            exitcode = 0
         except ValidationError as excp:
             # catch missing or invalid environment variables
             for error in excp.errors():
@@ -216,10 +597,12 @@ class SrvcEmail():
                 else:
                     self.logger.critical('you have set %s="%s" but %s', str(error["loc"][0]).upper(), error["input"], error["msg"])
             self.logger.critical('eMail service is not available! fix the environment variables and restart the service.')
+            exitcode = 0
         except smtplib.SMTPAuthenticationError as excp:
             self.logger.info('SMTP Error Details: %r', excp)
             self.logger.critical('SMTP Authentication failed, please check SMTP credentials')
             self.logger.critical('eMail service is not available! fix the SMTP credentials and restart the service.')
+            exitcode = 0
         except (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected) as excp:
             self.logger.info('SMTP Error Details: %r', excp)
             self.logger.critical('Unable to connect to SMTP server, please check SMTP server details and network connection')
@@ -231,53 +614,81 @@ class SrvcEmail():
         except Exception as excp:
             self.logger.exception(repr(excp))
         finally:
+            # closed down by `_do_work` on its own loop already
             self.logger.info('Closing SMTP session')
-            asyncio.run(self.do_force_closure())
             # in case if we skipped _do_work due to critical failures then the interrupt & termination signal handlers
             # are mapped to sys.exit(0) which will terminate the process.
             signal.signal(signal.SIGINT, lambda _s, _f: sys.exit(0))
             signal.signal(signal.SIGTERM, lambda _s, _f: sys.exit(0))
+            # the log records still batched up in this process
+            for handler in self.logger.handlers: handler.flush()
+        if exitcode:
+            sys.exit(exitcode)
 
     @staticmethod
-    async def run(log_level:int = logging.DEBUG):
-        global log_listener # pylint: disable=global-statement
+    async def run(log_level:int = logging.DEBUG, start_method: Optional[str] = None):
+        """
+        start the worker processes of all the `SrvcEmail` objects, under a `WorkerSupervisor` of our own.
+        `start_method`, multiprocessing start method of the workers, platform default if not given.
+        """
+        global log_listener, supervisor, supervisor_task # pylint: disable=global-statement
+        # multiprocessing is only needed here, a worker run by `entry` right away (see `worker.main`) never loads it
+        from .supervisor import WorkerSupervisor # pylint: disable=import-outside-toplevel
 
-        _que = multiprocessing.Manager().Queue(-1) # unlimited size
-        log_listener = IQueueListener(_que, logging.StreamHandler(), respect_handler_level=True)
-        log_listener.start()
         srvmail_logger = utils_get_logger(
             __name__,
             level=log_level,
             fmt='%(levelname)s:%(process)d:%(name)s:%(funcName)s, line %(lineno)d => %(message)s')
+        supervisor = WorkerSupervisor(srvmail_logger, start_method)
+        # workers send their log records in batches over a bounded pipe, no manager process in between
+        _que = supervisor.context.Queue(LOG_QUEUE_SIZE)
+        log_listener = IQueueListener(_que, logging.StreamHandler(), respect_handler_level=True)
+        log_listener.start()
         try:
             assert len(SrvcEmail.self_objects.values()) > 0, 'No email service object found'
 
-            for obj in SrvcEmail.self_objects.values():
-                mail_process_tasks.append(asyncio.create_task(run.cpu_bound(obj.entry, _que, log_level)))
-
-            srvmail_logger.debug('mail_process_tasks: {mail_process_tasks}')
-            # await asyncio.wait(mail_process_tasks, timeout=1, return_when=asyncio.FIRST_EXCEPTION)
-            # await asyncio.gather(*mail_process_tasks)
+            for obj_idx, obj in enumerate(SrvcEmail.self_objects.values()):
+                if obj._m_workers > 1 and any(x.transport == ETransport.PUBSUB for x in obj.m_channel_cfg.values()):
+                    srvmail_logger.warning('%d workers on pub/sub channels will send duplicate eMails: %s',
+                                           obj._m_workers, list(obj.m_channel_map.keys()))
+                for idx in range(obj._m_workers):
+                    supervisor.add(f'SrvcEmail-0x{id(obj):x}-{idx}', obj.entry, _que, log_level,
+                                   f'{socket.gethostname()}/{obj_idx}.{idx}')
+            supervisor.start()
+            supervisor_task = asyncio.create_task(supervisor.watch())
+
+            srvmail_logger.debug('supervisor: %r', supervisor)
         except Exception as excp:
             srvmail_logger.exception(repr(excp))
             # traceback.print_exc()
-        # finally:
-        #     log_listener.stop()
         srvmail_logger.debug('finished')
 
+    @staticmethod
+    async def stats(memdb_host: Optional[str] = None, memdb_port: int = 6379) -> dict[str, dict[str, dict[str, Any]]]:
+        """
+        delivery metrics of all the workers (of every host) sharing the Redis server, see `metrics.read_stats`.
+        use `metrics.render_prometheus` for a Prometheus text page or `metrics.mount_metrics` to serve it.
+        """
+        if memdb_host is None:
+            obj = next(iter(SrvcEmail.self_objects.values()))
+            memdb_host, memdb_port = obj._m_memdb_host, obj._m_memdb_port
+        redis = Redis(host=memdb_host, port=memdb_port)
+        try:
+            return await read_stats(redis)
+        finally:
+            await redis.aclose()
+
     @staticmethod
     async def stop():
         global log_listener # pylint: disable=global-variable-not-assigned
 
         srvmail_logger = utils_get_logger(__name__)
         try:
-            for obj in SrvcEmail.self_objects.values():
-                await obj.do_force_closure()
+            if supervisor_task: supervisor_task.cancel()
+            # workers close their subscription & drain the delivery engine on SIGTERM
+            if supervisor: await supervisor.stop(stop_timeout())
         except Exception as excp:
             srvmail_logger.exception(repr(excp))
 
-        # cancel all the process wrapped under asyncio.Task
-        for x in mail_process_tasks: x.cancel()
-
         log_listener.stop()
         srvmail_logger.debug('done')
@@ -0,0 +1,212 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import copy
+import hashlib
+import html
+import json
+from email.message import EmailMessage
+from string import Template
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Iterable, NamedTuple, Optional
+
+from redis.asyncio import Redis
+
+# members read per round trip out of a recipients key
+_SCAN_COUNT = 500
+
+class FanoutRecipient(NamedTuple):
+    to: str
+    # `$name` placeholders of the Subject & the text parts, substituted for this recipient only
+    subs: Optional[dict[str, str]] = None
+    # headers set (replaced) for this recipient only
+    headers: Optional[dict[str, str]] = None
+
+    @property
+    def personal(self) -> bool:
+        return bool(self.subs or self.headers)
+
+    def dump(self) -> str | dict[str, Any]:
+        if not self.personal:
+            return self.to
+        return {k: v for k, v in (('to', self.to), ('subs', self.subs), ('headers', self.headers)) if v}
+
+    @classmethod
+    def load(cls, value: Any) -> 'FanoutRecipient':
+        """an address, a `FanoutRecipient` or its dict `{"to": .., "subs": {..}, "headers": {..}}` (also as JSON)"""
+        if isinstance(value, FanoutRecipient):
+            return value
+        if isinstance(value, (bytes, bytearray)):
+            value = value.decode()
+        if isinstance(value, str) and value.startswith('{'):
+            value = json.loads(value)
+        if isinstance(value, dict):
+            return cls(str(value['to']), value.get('subs') or None, value.get('headers') or None)
+        return cls(str(value))
+
+class FanoutRequest(NamedTuple):
+    """
+    request of a fan-out channel, the request of its converter (`data`) along with the recipients to send its eMail to,
+    listed and/or held by the Redis key `key` (set, sorted set, list or stream, see `iter_recipients`).
+    the substitutions are HTML escaped in the HTML parts, but the `trusted` ones (markup of the producer).
+    """
+    data: bytes
+    recipients: tuple[FanoutRecipient, ...] = ()
+    key: Optional[str] = None
+    trusted: tuple[str, ...] = ()
+    # members of `key` done with already, the retry of a request whose key failed to be read goes on from there
+    offset: int = 0
+
+    def encode(self) -> bytes:
+        # the request of the converter is stored as is after a newline
+        hdr: dict[str, Any] = {'recipients': [x.dump() for x in self.recipients], 'key': self.key}
+        if self.trusted:
+            hdr['trusted'] = list(self.trusted)
+        if self.offset:
+            hdr['offset'] = self.offset
+        return json.dumps(hdr).encode() + b'\n' + bytes(self.data)
+
+    @classmethod
+    def decode(cls, raw: bytes | bytearray) -> 'FanoutRequest':
+        hdr, _, data = bytes(raw).partition(b'\n')
+        hdr = json.loads(hdr)
+        return cls(data, tuple(FanoutRecipient.load(x) for x in hdr['recipients']), hdr.get('key'),
+                   tuple(hdr.get('trusted', ())), hdr.get('offset', 0))
+
+    def addresses(self) -> tuple[str, ...]:
+        return tuple(x.to for x in self.recipients)
+
+class FanoutConverter():
+    """converter of a fan-out channel, hands the request of the channel converter over to it (picklable as `conv` is)"""
+
+    conv: Callable[[bytes | bytearray], EmailMessage]
+
+    __slots__ = ['conv']
+
+    def __init__(self, conv: Callable[[bytes | bytearray], EmailMessage]) -> None:
+        self.conv = conv
+
+    def __repr__(self) -> str:
+        return f'FanoutConverter({self.conv!r})'
+
+    def __call__(self, data: bytes | bytearray) -> EmailMessage:
+        return self.conv(bytes(data).partition(b'\n')[2])
+
+class FanoutRenderer():
+    """
+    eMails of a fan-out request out of the one eMail its converter built.
+    - the shared copy has no To/Cc/Bcc (`undisclosed-recipients:;`), the recipients are the envelope ones only.
+      it is flattened once here, so the senders of its transactions (threads) never alter it.
+    - a personal recipient gets a copy of it with its substitutions & headers applied, in a transaction of its own.
+      the substitutions are HTML escaped in the HTML parts, but the `trusted` ones.
+    """
+
+    shared: EmailMessage
+    # the shared eMail as serialized by `EmailMessage.as_bytes`
+    raw: bytes
+    trusted: frozenset[str]
+
+    __slots__ = ['shared', 'raw', 'trusted']
+
+    def __init__(self, email: EmailMessage, trusted: Iterable[str] = ()) -> None:
+        for name in ('To', 'Cc', 'Bcc'):
+            del email[name]
+        email['To'] = 'undisclosed-recipients:;'
+        # sets the MIME boundaries
+        self.raw = email.as_bytes()
+        self.shared = email
+        self.trusted = frozenset(trusted)
+
+    def personal(self, rcpt: FanoutRecipient) -> EmailMessage:
+        email = copy.deepcopy(self.shared)
+        if rcpt.subs:
+            subs = {k: str(v) for k, v in rcpt.subs.items()}
+            escaped = {k: v if k in self.trusted else html.escape(v) for k, v in subs.items()}
+            if (subject := email.get('Subject')) is not None:
+                email.replace_header('Subject', Template(str(subject)).safe_substitute(subs))
+            for part in email.walk():
+                if part.is_multipart() or part.get_content_maintype() != 'text' or part.is_attachment():
+                    continue
+                subtype = part.get_content_subtype()
+                part.set_content(Template(part.get_content()).safe_substitute(escaped if subtype == 'html' else subs),
+                                 subtype=subtype)
+        for name, value in (rcpt.headers or {}).items():
+            del email[name]
+            email[name] = value
+        email.replace_header('To', rcpt.to)
+        return email
+
+    async def groups(self, recipients: AsyncIterable[FanoutRecipient],
+                     batch: int) -> AsyncIterator[tuple[tuple[FanoutRecipient, ...], bool]]:
+        """
+        the recipients by transaction, True for a personal one (see `personal`). up to `batch` recipients of the shared
+        eMail per transaction, each personal one on its own. the same address is sent to once only.
+        `recipients` failing, the ones read up to then are yielded before the error is raised on.
+        """
+        seen: set[str] = set()
+        pending: list[FanoutRecipient] = []
+        try:
+            async for rcpt in recipients:
+                if rcpt.to in seen:
+                    continue
+                seen.add(rcpt.to)
+                if rcpt.personal:
+                    yield (rcpt,), True
+                    continue
+                pending.append(rcpt)
+                if len(pending) >= batch:
+                    yield tuple(pending), False
+                    pending = []
+        except Exception:
+            if pending:
+                yield tuple(pending), False
+            raise
+        if pending:
+            yield tuple(pending), False
+
+def group_key(key: str, recipients: Iterable[str]) -> str:
+    """idempotency key of the transaction of `recipients`, out of the key of the whole request"""
+    digest = hashlib.blake2b('\0'.join(sorted(recipients)).encode(), digest_size=8)
+    return f'{key}:{digest.hexdigest()}'
+
+def _text(value: Optional[bytes | str]) -> str:
+    # a reply of the client, as per its `decode_responses`
+    return value.decode() if isinstance(value, bytes) else value or ''
+
+async def iter_recipients(redis: Redis, key: str, offset: int = 0) -> AsyncIterator[FanoutRecipient]:
+    """
+    recipients held by a Redis key, a set, sorted set (by score) or list of addresses or JSON `FanoutRecipient` dicts,
+    or a stream whose entries have the address in the field `to` & the substitutions in the other ones.
+    it is read in chunks of a few hundred members, the key is never loaded at once. the first `offset` members are
+    skipped (a set, as per the order of `SSCAN`, the same as long as the set is not changed meanwhile).
+    """
+    kind = _text(await redis.type(key))
+    if kind == 'set':
+        skip = offset
+        async for member in redis.sscan_iter(key, count=_SCAN_COUNT):
+            if skip:
+                skip -= 1
+                continue
+            yield FanoutRecipient.load(member)
+    elif kind == 'zset':
+        start = offset
+        while members := await redis.zrange(key, start, start + _SCAN_COUNT - 1):
+            for member in members:
+                yield FanoutRecipient.load(member)
+            start += len(members)
+    elif kind == 'list':
+        start = offset
+        while members := await redis.lrange(key, start, start + _SCAN_COUNT - 1):
+            for member in members:
+                yield FanoutRecipient.load(member)
+            start += len(members)
+    elif kind == 'stream':
+        last, skip = '-', offset
+        while entries := await redis.xrange(key, last, '+', count=_SCAN_COUNT):
+            for _, fields in entries[skip:]:
+                subs = {_text(k): _text(v) for k, v in (fields or {}).items()}
+                yield FanoutRecipient(subs.pop('to'), subs or None)
+            skip = max(0, skip - len(entries))
+            last = '(' + _text(entries[-1][0])
+    elif kind != 'none':
+        raise TypeError(f'recipients key {key!r} is a {kind}, not a set, zset, list or stream')
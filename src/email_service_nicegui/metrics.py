@@ -0,0 +1,178 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Any, NoReturn
+
+from redis.asyncio import Redis
+
+from .utils import ILogger
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+_BUCKET_LABELS = tuple(str(x) for x in LATENCY_BUCKETS) + ('+Inf',)
+
+KEY_STATS = 'email:stats:{}'
+
+# label of the counters with a value in their name (`<counter>:<value>`), `code` if not listed
+_COUNTER_LABELS = {'relay': 'relay'}
+# field `<worker>|seen`, when the worker flushed last (epoch seconds)
+_SEEN = 'seen'
+
+class Metrics():
+    """
+    per worker delivery metrics, counters & fixed bucket latency histograms per channel.
+    - recording only updates a local dict (no I/O, no locks), so it is cheap enough to be always on
+    - `run` flushes the deltas every `interval` seconds into the Redis hash `email:stats:<channel>` with one pipeline,
+      fields are `<worker>|<counter>` and `<worker>|<histogram>|<le>/sum/count`, see `read_stats`
+    - every flush stamps `<worker>|seen` of the channels of the worker, the fields of a worker not seen for `stale`
+      seconds (gone for good, e.g. a standalone one named after its pid) are removed by the workers of the channel.
+    """
+
+    logger: ILogger
+    _m_redis: Redis
+    _m_worker: str
+    _m_interval: float
+    _m_stale: float
+    _m_delta: dict[tuple[str, str], float]
+    # the channels recorded, stamped & pruned by every flush
+    _m_channels: set[str]
+    _m_pruned: float
+
+    __slots__ = ['logger', '_m_redis', '_m_worker', '_m_interval', '_m_stale', '_m_delta', '_m_channels', '_m_pruned']
+
+    def __init__(self, redis: Redis, worker: str, logger: ILogger, interval: float = 5, stale: float = 3600) -> None:
+        self.logger = logger
+        self._m_redis = redis
+        self._m_worker = worker
+        self._m_interval = interval
+        self._m_stale = max(stale, 10 * interval)
+        self._m_delta = {}
+        self._m_channels = set()
+        self._m_pruned = time.monotonic()
+
+    def __repr__(self) -> str:
+        return f'Metrics({self._m_worker}, pending={len(self._m_delta)})'
+
+    def incr(self, channel: str, name: str, value: float = 1):
+        key = (channel, f'{self._m_worker}|{name}')
+        self._m_delta[key] = self._m_delta.get(key, 0) + value
+
+    def observe(self, channel: str, name: str, seconds: float):
+        prefix = f'{self._m_worker}|{name}|'
+        delta = self._m_delta
+        for key, value in (((channel, prefix + _BUCKET_LABELS[bisect_left(LATENCY_BUCKETS, seconds)]), 1),
+                           ((channel, prefix + 'sum'), seconds), ((channel, prefix + 'count'), 1)):
+            delta[key] = delta.get(key, 0) + value
+
+    async def flush(self):
+        delta, self._m_delta = self._m_delta, {}
+        self._m_channels.update(channel for channel, _ in delta)
+        if not self._m_channels:
+            return
+        now = time.time()
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for (channel, field), value in delta.items():
+                if isinstance(value, int):
+                    pipe.hincrby(KEY_STATS.format(channel), field, value)
+                else:
+                    pipe.hincrbyfloat(KEY_STATS.format(channel), field, value)
+            for channel in self._m_channels:
+                pipe.hset(KEY_STATS.format(channel), f'{self._m_worker}|{_SEEN}', now)
+            await pipe.execute()
+        if time.monotonic() - self._m_pruned >= self._m_stale / 10:
+            self._m_pruned = time.monotonic()
+            await self.prune(now - self._m_stale)
+
+    async def prune(self, seen: float):
+        """remove the fields of the workers not seen since `seen` (epoch seconds) from the channels of this one"""
+        for channel in self._m_channels:
+            key = KEY_STATS.format(channel)
+            fields = [x.decode() if isinstance(x, bytes) else x for x in await self._m_redis.hkeys(key)]
+            workers = [x.split('|', 1)[0] for x in fields if x.endswith(f'|{_SEEN}')]
+            stamps = await self._m_redis.hmget(key, [f'{x}|{_SEEN}' for x in workers])
+            if not (gone := {x for x, ts in zip(workers, stamps) if ts is not None and float(ts) < seen}):
+                continue
+            await self._m_redis.hdel(key, *(x for x in fields if x.split('|', 1)[0] in gone))
+            self.logger.info('stats of %s, the fields of %d worker(s) gone removed', channel, len(gone))
+
+    async def run(self) -> NoReturn:
+        while True:
+            await asyncio.sleep(self._m_interval)
+            try:
+                await self.flush()
+            except Exception as excp:
+                self.logger.warning('unable to flush the metrics: %r', excp)
+
+async def read_stats(redis: Redis) -> dict[str, dict[str, dict[str, Any]]]:
+    """
+    Returns: `{channel: {worker: {counter: value, histogram: {'buckets': {le: count}, 'sum': .., 'count': ..}}}}`,
+    bucket counts are per bucket (not cumulative).
+    """
+    rtn: dict[str, dict[str, dict[str, Any]]] = {}
+    prefix = KEY_STATS.format('')
+    async for key in redis.scan_iter(match=prefix + '*', count=100):
+        key = key.decode() if isinstance(key, bytes) else key
+        channel = key[len(prefix):]
+        for field, raw in (await redis.hgetall(key)).items():
+            parts = (field.decode() if isinstance(field, bytes) else field).split('|')
+            value = float(raw)
+            worker = rtn.setdefault(channel, {}).setdefault(parts[0], {})
+            if parts[1:] == [_SEEN]:
+                continue
+            if len(parts) == 2:
+                worker[parts[1]] = value
+            else:
+                hist = worker.setdefault(parts[1], {'buckets': {}, 'sum': 0.0, 'count': 0.0})
+                if parts[2] in ('sum', 'count'):
+                    hist[parts[2]] = value
+                else:
+                    hist['buckets'][parts[2]] = value
+    return rtn
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus(stats: dict[str, dict[str, dict[str, Any]]], prefix: str = 'email') -> str:
+    """render `read_stats` output in the Prometheus text exposition format."""
+    counters: dict[str, list[str]] = {}
+    histograms: dict[str, list[str]] = {}
+    for channel, workers in sorted(stats.items()):
+        for worker, metrics in sorted(workers.items()):
+            labels = f'channel="{_label(channel)}",worker="{_label(worker)}"'
+            for name, value in sorted(metrics.items()):
+                if isinstance(value, dict):
+                    lines = histograms.setdefault(name, [])
+                    cumulative = 0.0
+                    for le in _BUCKET_LABELS:
+                        cumulative += value['buckets'].get(le, 0)
+                        lines.append(f'{prefix}_{name}_bucket{{{labels},le="{le}"}} {cumulative:g}')
+                    lines.append(f'{prefix}_{name}_sum{{{labels}}} {value["sum"]:g}')
+                    lines.append(f'{prefix}_{name}_count{{{labels}}} {value["count"]:g}')
+                else:
+                    # `refused:451` -> email_refused_total{..., code="451"}, `relay:<host:port>` -> relay="<host:port>"
+                    name, _, code = name.partition(':')
+                    extra = f',{_COUNTER_LABELS.get(name, "code")}="{_label(code)}"' if code else ''
+                    counters.setdefault(name, []).append(f'{prefix}_{name}_total{{{labels}{extra}}} {value:g}')
+    out = []
+    for name, lines in counters.items():
+        out.append(f'# TYPE {prefix}_{name}_total counter')
+        out.extend(lines)
+    for name, lines in histograms.items():
+        out.append(f'# TYPE {prefix}_{name} histogram')
+        out.extend(lines)
+    return '\n'.join(out) + '\n'
+
+def mount_metrics(app: Any, memdb_host: str, path: str = '/metrics'):
+    """serve the metrics of all the workers as a Prometheus text page on the NiceGUI (FastAPI) `app`."""
+    from starlette.responses import PlainTextResponse # pylint: disable=import-outside-toplevel
+
+    redis = Redis(host=memdb_host)
+
+    @app.get(path, include_in_schema=False)
+    async def _metrics():
+        return PlainTextResponse(render_prometheus(await read_stats(redis)),
+                                 media_type='text/plain; version=0.0.4')
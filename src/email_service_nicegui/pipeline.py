@@ -0,0 +1,147 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import os
+import time
+from concurrent.futures import BrokenExecutor, Executor, ThreadPoolExecutor
+from email.message import EmailMessage
+from typing import Awaitable, Callable, Mapping, NamedTuple, Optional
+
+from .config import ConfigSMTP
+from .utils import ILogger
+
+
+class ConvertJob(NamedTuple):
+    channel: str
+    data: bytes | bytearray
+    # stream entry id, when the request came in via `ETransport.STREAM`
+    msg_id: Optional[bytes] = None
+    # number of delivery attempts made before this one
+    attempt: int = 0
+    # when the request was enqueued by the producer (epoch seconds)
+    enqueued: float = 0
+    # member of the retry queue leased to this worker, when the request came back from there
+    leased: Optional[bytes] = None
+
+class ConvertStage():
+    """
+    conversion stage of the receive → convert → send pipeline of a worker.
+    - the receiving side (subscription, stream reader & retry poller of a channel) only `submit`s the raw request, it
+      waits only while the queue of that very channel holds `ConfigSMTP.convert_queue_size` requests, so a slow
+      converter never blocks receiving on the other channels.
+    - `ConfigSMTP.convert_workers` tasks per channel run the converters on a `thread` or `process` pool
+      (`ConfigSMTP.convert_executor`), so the CPU bound conversion overlaps with the network I/O of the event loop.
+      the pool has room for all the tasks of every channel (processes, up to the number of CPUs), so the conversions
+      of one channel never wait for a free worker behind a slow converter of an other one. `inline` runs them right on
+      the event loop.
+    - each job ends up either in `on_converted` along with its eMail & conversion time, or in `on_failed` with the
+      error (called from within the `except` block, so that it may log the traceback). both may wait, e.g. for room in
+      the delivery queue, the requests then pile up here and at last throttle the receiving side.
+    - `process` pool, the converters & their errors must be picklable (module level functions). a pool broken by a
+      process that died (e.g. killed for its memory) is replaced, the jobs it failed are resubmitted to the new one
+      once. broken again, they go to `on_failed` with the `BrokenExecutor` error.
+    """
+
+    logger: ILogger
+    _m_config: ConfigSMTP
+    _m_converters: Mapping[str, Callable[[bytes | bytearray], EmailMessage]]
+    _m_queues: dict[str, asyncio.Queue[ConvertJob]]
+    _m_tasks: list[asyncio.Task[None]]
+    _m_executor: Optional[Executor]
+    _m_on_converted: Callable[[ConvertJob, EmailMessage, float], Awaitable[None]]
+    _m_on_failed: Callable[[ConvertJob, Exception], Awaitable[None]]
+
+    __slots__ = ['logger', '_m_config', '_m_converters', '_m_queues', '_m_tasks', '_m_executor', '_m_on_converted',
+                 '_m_on_failed']
+
+    def __init__(self, config: ConfigSMTP, logger: ILogger,
+                 converters: Mapping[str, Callable[[bytes | bytearray], EmailMessage]],
+                 on_converted: Callable[[ConvertJob, EmailMessage, float], Awaitable[None]],
+                 on_failed: Callable[[ConvertJob, Exception], Awaitable[None]]) -> None:
+        self.logger = logger
+        self._m_config = config
+        self._m_converters = converters
+        self._m_queues = {}
+        self._m_tasks = []
+        self._m_executor = None
+        self._m_on_converted = on_converted
+        self._m_on_failed = on_failed
+
+    def __repr__(self) -> str:
+        queued = {ch: que.qsize() for ch, que in self._m_queues.items()}
+        return f'ConvertStage({self._m_config.convert_executor} x{self._m_config.convert_workers}, queued={queued})'
+
+    def _new_executor(self) -> Optional[Executor]:
+        workers = max(1, self._m_config.convert_workers) * max(1, len(self._m_converters))
+        if self._m_config.convert_executor == 'process':
+            # loads the multiprocessing machinery, only when asked for
+            from concurrent.futures import ProcessPoolExecutor # pylint: disable=import-outside-toplevel
+            return ProcessPoolExecutor(min(workers, os.cpu_count() or 1))
+        if self._m_config.convert_executor == 'thread':
+            return ThreadPoolExecutor(workers, thread_name_prefix='email-convert')
+        return None
+
+    async def start(self):
+        self._m_executor = self._new_executor()
+        for ch_name in self._m_converters:
+            que = self._m_queues[ch_name] = asyncio.Queue(self._m_config.convert_queue_size)
+            self._m_tasks += [asyncio.create_task(self._converter(que))
+                              for _ in range(max(1, self._m_config.convert_workers))]
+
+    def qsize(self, channel: str) -> int:
+        return self._m_queues[channel].qsize() if channel in self._m_queues else 0
+
+    async def submit(self, job: ConvertJob):
+        # waits while the queue of the channel is full, this throttles the receiving side of that channel only
+        await self._m_queues[job.channel].put(job)
+
+    async def stop(self, timeout: float = 20):
+        if not self._m_tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(que.join() for que in self._m_queues.values())), timeout)
+        except (asyncio.TimeoutError, RuntimeError):
+            self.logger.warning('%d request(s) not converted before shutdown',
+                                sum(que.qsize() for que in self._m_queues.values()))
+        for task in self._m_tasks: task.cancel()
+        await asyncio.gather(*self._m_tasks, return_exceptions=True)
+        self._m_tasks = []
+        if self._m_executor is not None:
+            self._m_executor.shutdown(wait=False, cancel_futures=True)
+            self._m_executor = None
+
+    async def _convert(self, job: ConvertJob) -> tuple[EmailMessage, float]:
+        converter = self._m_converters[job.channel]
+        started = time.perf_counter()
+        if (executor := self._m_executor) is None:
+            email = converter(job.data)
+        else:
+            try:
+                email = await asyncio.get_running_loop().run_in_executor(executor, converter, job.data)
+            except BrokenExecutor:
+                # a pool process died, not necessarily converting this very request. the jobs get a fresh pool
+                if executor is self._m_executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._m_executor = self._new_executor()
+                if (executor := self._m_executor) is None:
+                    raise
+                self.logger.warning('conversion pool broken, a request of %s is resubmitted', job.channel)
+                email = await asyncio.get_running_loop().run_in_executor(executor, converter, job.data)
+        return email, time.perf_counter() - started
+
+    async def _converter(self, que: asyncio.Queue[ConvertJob]):
+        while True:
+            job = await que.get()
+            try:
+                try:
+                    email, elapsed = await self._convert(job)
+                except Exception as excp:
+                    await self._m_on_failed(job, excp)
+                else:
+                    await self._m_on_converted(job, email, elapsed)
+            except Exception as excp:
+                self.logger.exception(repr(excp))
+            finally:
+                que.task_done()
@@ -0,0 +1,146 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import time
+from typing import Iterable, Mapping
+
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+
+from .config import ConfigSMTP
+from .utils import ILogger
+
+# SMTP replies providers use to tell us to slow down
+THROTTLE_CODES = frozenset((421, 451, 452))
+
+# takes tokens from every bucket in KEYS, all or none. returns 0 once taken, else the seconds to wait for them.
+# ARGV[1] additive increase (eMails/sec per second) & ARGV[2] hold time after a cut, then per key its max rate, burst &
+# the tokens to take (the recipients of the eMail behind it)
+_LUA_TAKE = '''
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1e6
+local increase, hold = tonumber(ARGV[1]), tonumber(ARGV[2])
+local wait = 0
+local state = {}
+for i, key in ipairs(KEYS) do
+    local max_rate, burst, cost = tonumber(ARGV[3 * i]), tonumber(ARGV[1 + 3 * i]), tonumber(ARGV[2 + 3 * i])
+    local b = redis.call('HMGET', key, 'tokens', 'ts', 'rate', 'cut')
+    local rate = math.min(max_rate, tonumber(b[3]) or max_rate)
+    local ts = tonumber(b[2]) or now
+    local dt = math.max(0, now - ts)
+    if now - (tonumber(b[4]) or 0) > hold then rate = math.min(max_rate, rate + increase * dt) end
+    -- the burst shrinks along with the rate, a cut relay does not get the full burst at once
+    local cap = math.max(cost, burst * rate / max_rate)
+    local tokens = math.min(cap, (tonumber(b[1]) or cap) + rate * dt)
+    if tokens < cost then wait = math.max(wait, (cost - tokens) / rate) end
+    state[i] = {tokens, rate, cost}
+end
+for i, key in ipairs(KEYS) do
+    local tokens = state[i][1]
+    if wait == 0 then tokens = tokens - state[i][3] end
+    redis.call('HSET', key, 'tokens', tokens, 'ts', now, 'rate', state[i][2])
+    redis.call('EXPIRE', key, 3600)
+end
+return tostring(wait)
+'''
+
+# multiplicative decrease of the rate of every bucket in KEYS by ARGV[1] (not below ARGV[2]), at most once per ARGV[3]
+# seconds, so that the replies of the eMails already in flight do not cut it again. then per key its max rate.
+_LUA_CUT = '''
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1e6
+local factor, floor, hold = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local cut = 0
+for i, key in ipairs(KEYS) do
+    local b = redis.call('HMGET', key, 'rate', 'cut')
+    if now - (tonumber(b[2]) or 0) > hold then
+        local rate = math.max(floor, (tonumber(b[1]) or tonumber(ARGV[3 + i])) * factor)
+        redis.call('HSET', key, 'rate', rate, 'cut', now, 'tokens', 0, 'ts', now)
+        redis.call('EXPIRE', key, 3600)
+        cut = cut + 1
+    end
+end
+return cut
+'''
+
+class RateLimiter():
+    """
+    token bucket send rate limits per SMTP relay & per recipient domain, shared by all the worker processes (of every
+    host) through Redis, so the total rate stays under the provider quota however many `SrvcEmail` processes run.
+    - `ConfigSMTP.rate_limit` is the relay limit, `ConfigSMTP.rate_limit_domains` the per domain ones (`*` for the
+      domains not listed), in eMails/sec, 0 or missing means no limit. an eMail takes a token per recipient, of the
+      relay & of the domain of each one, e.g. a fan-out transaction to 50 recipients takes 50 relay tokens.
+    - AIMD, a throttle reply (`THROTTLE_CODES`) cuts the rate by `rate_decrease`, once per `rate_hold` seconds, after
+      that it grows back by `rate_increase` eMails/sec every second up to the configured limit
+    - a bucket is a Redis hash `email:rate:relay:<host:port>` / `email:rate:domain:<domain>`, tokens are taken from the
+      relay & all the recipient domains of an eMail at once by a Lua script, so no token is spent on a blocked eMail
+    """
+
+    logger: ILogger
+    _m_config: ConfigSMTP
+    _m_take: AsyncScript
+    _m_cut: AsyncScript
+
+    __slots__ = ['logger', '_m_config', '_m_take', '_m_cut']
+
+    KEY_RELAY = 'email:rate:relay:{}'
+    KEY_DOMAIN = 'email:rate:domain:{}'
+
+    def __init__(self, redis: Redis, config: ConfigSMTP, logger: ILogger) -> None:
+        self.logger = logger
+        self._m_config = config
+        self._m_take = redis.register_script(_LUA_TAKE)
+        self._m_cut = redis.register_script(_LUA_CUT)
+
+    def __repr__(self) -> str:
+        return f'RateLimiter({self._m_config.rate_limit}/s, domains={self._m_config.rate_limit_domains})'
+
+    def _buckets(self, relay: str, domains: Mapping[str, int]) -> list[tuple[str, float, int]]:
+        # key, rate & tokens to take of the buckets of the `relay` & of the recipient `domains` (recipients per domain)
+        rtn = []
+        if relay and self._m_config.rate_limit > 0:
+            rtn.append((self.KEY_RELAY.format(relay), self._m_config.rate_limit, max(1, sum(domains.values()))))
+        limits = self._m_config.rate_limit_domains
+        for domain in sorted(domains):
+            if (rate := limits.get(domain, limits.get('*', 0))) > 0:
+                rtn.append((self.KEY_DOMAIN.format(domain), rate, domains[domain]))
+        return rtn
+
+    def max_cost(self) -> int:
+        """the most recipients an eMail may have to be sent at once, the smallest burst of the limits (0, no limit)"""
+        rates = [x for x in (self._m_config.rate_limit, *self._m_config.rate_limit_domains.values()) if x > 0]
+        if not rates:
+            return 0
+        return max(1, int(min(self._m_config.rate_burst or x for x in rates)))
+
+    async def acquire(self, relay: str, domains: Mapping[str, int]) -> float:
+        """
+        wait for the tokens of the `relay` and of every recipient domain, `domains` are the recipients per domain.
+        Returns: 0 once taken, else the seconds still to wait, when that is beyond `ConfigSMTP.rate_max_wait`.
+        """
+        buckets = self._buckets(relay, domains)
+        if not buckets:
+            return 0
+        args: list[float] = [self._m_config.rate_increase, self._m_config.rate_hold]
+        for _, rate, cost in buckets:
+            args += [rate, self._m_config.rate_burst or rate, cost]
+        deadline = time.monotonic() + self._m_config.rate_max_wait
+        while True:
+            wait = float(await self._m_take(keys=[key for key, _, _ in buckets], args=args))
+            if wait <= 0:
+                return 0
+            if time.monotonic() + wait > deadline:
+                return wait
+            await asyncio.sleep(wait)
+
+    async def throttled(self, relay: str = '', domains: Iterable[str] = ()):
+        """the `relay` (if given) or the recipient `domains` replied with a throttle code, slow them down"""
+        buckets = self._buckets(relay, {}) if relay else self._buckets('', dict.fromkeys(domains, 1))
+        if not buckets:
+            return
+        cut = await self._m_cut(keys=[key for key, _, _ in buckets], args=[
+            self._m_config.rate_decrease, self._m_config.rate_floor, self._m_config.rate_hold, *(x for _, x, _ in buckets)])
+        if cut:
+            self.logger.warning('throttled by %s, send rate cut by %g', relay or list(domains), self._m_config.rate_decrease)
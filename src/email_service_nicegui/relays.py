@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import random
+import time
+from enum import Enum
+from typing import Collection, Optional
+
+from .config import ConfigRelay, ConfigSMTP
+from .smtp_pool import SmtpPool
+from .utils import ILogger
+
+
+class EBreaker(str, Enum):
+    # in rotation
+    CLOSED = 'closed'
+    # out of rotation, until `ConfigSMTP.relay_breaker_cooldown` seconds are over
+    OPEN = 'open'
+    # cooled down, one probe eMail is on its way, its outcome closes or opens the breaker again
+    HALF_OPEN = 'half-open'
+
+class SmtpRelay():
+    config: ConfigRelay
+    name: str
+    pool: SmtpPool
+    # moving averages of the SMTP transaction time (None, until the first eMail) & of the failure rate
+    latency: Optional[float]
+    error_rate: float
+    # failures in a row
+    failures: int
+    breaker: EBreaker
+    # when the breaker was opened (or the probe sent), monotonic
+    opened: float
+    in_flight: int
+
+    __slots__ = ['config', 'name', 'pool', 'latency', 'error_rate', 'failures', 'breaker', 'opened', 'in_flight']
+
+    def __init__(self, config: ConfigRelay, pool: SmtpPool) -> None:
+        self.config = config
+        self.name = config.name
+        self.pool = pool
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.breaker = EBreaker.CLOSED
+        self.opened = 0.0
+        self.in_flight = 0
+
+    def __repr__(self) -> str:
+        latency = 'n/a' if self.latency is None else f'{self.latency * 1000:.0f}ms'
+        return f'{self.name}({self.breaker.value}, {latency}, err={self.error_rate:.2f}, in_flight={self.in_flight})'
+
+class RelayBalancer():
+    """
+    picks the SMTP relay of every eMail among `ConfigSMTP.relay_list()`, each relay has a `SmtpPool` of its own.
+    - the relays in rotation are picked at random, in proportion to `weight × success rate / (latency × (1 + eMails in
+      flight))`, so the fast & healthy relays get most of the traffic while the others get enough to keep their
+      averages up to date. a relay without any latency yet is taken as fast as the fastest one.
+    - circuit breaker, a relay failing `ConfigSMTP.relay_breaker_failures` times in a row is out of rotation for
+      `ConfigSMTP.relay_breaker_cooldown` seconds, then one eMail probes it, its success puts the relay back.
+    - the caller reports the outcome of every eMail it sent through a relay (`report`), recipients refused by the
+      relay are no failure of the relay.
+    """
+
+    logger: ILogger
+    _m_config: ConfigSMTP
+    _m_relays: list[SmtpRelay]
+    _m_random: random.Random
+
+    __slots__ = ['logger', '_m_config', '_m_relays', '_m_random']
+
+    def __init__(self, config: ConfigSMTP, logger: ILogger) -> None:
+        self.logger = logger
+        self._m_config = config
+        self._m_relays = [SmtpRelay(relay, SmtpPool(config, logger, relay)) for relay in config.relay_list()]
+        self._m_random = random.Random()
+
+    def __repr__(self) -> str:
+        return f'RelayBalancer({self._m_relays})'
+
+    @property
+    def relays(self) -> list[SmtpRelay]:
+        return self._m_relays
+
+    async def start(self):
+        """open the pools, so that configuration/credential errors surface at startup, unless some relay works"""
+        rslt = await asyncio.gather(*(relay.pool.start() for relay in self._m_relays), return_exceptions=True)
+        failed = [(relay, excp) for relay, excp in zip(self._m_relays, rslt) if isinstance(excp, BaseException)]
+        if len(failed) == len(self._m_relays):
+            raise failed[0][1]
+        for relay, excp in failed:
+            self.logger.warning('SMTP relay %s not available: %r', relay.name, excp)
+            relay.failures += 1
+            self._open(relay)
+
+    async def close(self):
+        await asyncio.gather(*(relay.pool.close() for relay in self._m_relays))
+
+    def pick(self, exclude: Collection[SmtpRelay] = ()) -> Optional[SmtpRelay]:
+        """
+        the relay of the next eMail, a cooled down relay is probed right away.
+        Returns: None, when all the relays (but the `exclude`d ones) are out of rotation.
+        """
+        now = time.monotonic()
+        candidates: list[SmtpRelay] = []
+        for relay in self._m_relays:
+            if relay in exclude:
+                continue
+            if relay.breaker != EBreaker.CLOSED:
+                # a probe that never reported back (e.g. deferred by the rate limits) is sent again after a cool down
+                if now - relay.opened < self._m_config.relay_breaker_cooldown:
+                    continue
+                relay.breaker = EBreaker.HALF_OPEN
+                relay.opened = now
+                self.logger.info('probing SMTP relay %s', relay.name)
+                return relay
+            candidates.append(relay)
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+        fastest = min((x.latency for x in candidates if x.latency is not None), default=1.0)
+        scores = [x.config.weight * max(0.01, 1 - x.error_rate) /
+                  (max(0.001, fastest if x.latency is None else x.latency) * (1 + x.in_flight)) for x in candidates]
+        return self._m_random.choices(candidates, scores)[0]
+
+    def retry_in(self) -> float:
+        """seconds until the next relay out of rotation is due for its probe"""
+        now = time.monotonic()
+        return max(0.0, min((x.opened + self._m_config.relay_breaker_cooldown - now for x in self._m_relays
+                             if x.breaker != EBreaker.CLOSED), default=0.0))
+
+    def report(self, relay: SmtpRelay, ok: bool, elapsed: float = 0):
+        alpha = self._m_config.relay_ewma_alpha
+        relay.error_rate += alpha * ((0.0 if ok else 1.0) - relay.error_rate)
+        if ok:
+            if elapsed:
+                relay.latency = elapsed if relay.latency is None else relay.latency + alpha * (elapsed - relay.latency)
+            relay.failures = 0
+            if relay.breaker != EBreaker.CLOSED:
+                relay.breaker = EBreaker.CLOSED
+                self.logger.info('SMTP relay %s is back in rotation', relay.name)
+            return
+        relay.failures += 1
+        # the failures of the eMails in flight while the breaker opened do not count
+        if (relay.breaker == EBreaker.HALF_OPEN or
+            (relay.breaker == EBreaker.CLOSED and relay.failures >= self._m_config.relay_breaker_failures)):
+            self._open(relay)
+
+    def _open(self, relay: SmtpRelay):
+        relay.breaker = EBreaker.OPEN
+        relay.opened = time.monotonic()
+        self.logger.warning('SMTP relay %s out of rotation for %gs after %d failure(s) in a row', relay.name,
+                            self._m_config.relay_breaker_cooldown, relay.failures)
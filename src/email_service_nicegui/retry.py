@@ -0,0 +1,186 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+
+from .utils import ILogger
+
+# leases up to ARGV[2] members whose due time (score) is <= ARGV[1], they are due again at ARGV[3] (the end of the
+# lease) unless removed before. atomically so that no two workers get the same one
+_LUA_LEASE_DUE = '''
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(items) do redis.call('ZADD', KEYS[1], 'XX', ARGV[3], item) end
+return items
+'''
+
+class RetryEntry(NamedTuple):
+    channel: str
+    data: bytes | bytearray
+    attempt: int
+    error: Optional[str] = None
+    # when the request was originally enqueued by the producer (epoch seconds)
+    enqueued: float = 0
+
+    def encode(self) -> bytes:
+        # the nonce keeps identical requests apart in the sorted set, the request itself is stored as is after a newline
+        hdr = {'channel': self.channel, 'attempt': self.attempt, 'error': self.error, 'ts': time.time(),
+               'enqueued': self.enqueued, 'nonce': os.urandom(6).hex()}
+        return json.dumps(hdr).encode() + b'\n' + bytes(self.data)
+
+    @classmethod
+    def decode(cls, raw: bytes) -> 'RetryEntry':
+        hdr, _, data = raw.partition(b'\n')
+        hdr = json.loads(hdr)
+        return cls(hdr['channel'], data, hdr['attempt'], hdr['error'], hdr.get('enqueued', 0))
+
+class RetryQueue():
+    """
+    Redis sorted set based delay queue for the eMails to be retried, the score is the due time.
+    - every channel has its own set `email:retry:<channel>`, any worker serving the channel may pick the retry up
+    - the delay grows exponentially with the attempt, `base_delay * 2**attempt` capped at `max_delay`, with jitter
+    - once `max_attempts` is reached (or SMTP rejects for good), the request along with the final error is pushed to
+      the dead-letter list `email:dead:<channel>` (latest first, trimmed to `dead_letter_max` entries)
+    - a poller per channel (`run`) drains its due entries in batches, one waiting for room in the queues of its
+      channel holds up no other channel. an SMTP outage costs Redis memory only, no coroutine nor connection per failed
+      eMail.
+    - a due entry is leased, not removed. it stays in its set (due again at the end of the lease) until `done` once
+      SMTP, the dead-letter list, the spool or a later retry took it over, so a worker crashing meanwhile loses none.
+      the leases of the entries in flight are renewed every `lease / 3` seconds, `release` gives one up.
+    """
+
+    logger: ILogger
+    _m_redis: Redis
+    _m_channels: list[str]
+    # called with the entry & its member in the set, to be `done` with
+    _m_handler: Callable[[RetryEntry, bytes], Awaitable[None]]
+    _m_base_delay: float
+    _m_max_delay: float
+    _m_poll_interval: float
+    _m_batch: int
+    _m_dead_letter_max: int
+    _m_lease: float
+    # members leased & not done with yet, per channel
+    _m_leased: dict[str, set[bytes]]
+    _m_lease_due: AsyncScript
+
+    __slots__ = ['logger', '_m_redis', '_m_channels', '_m_handler', '_m_base_delay', '_m_max_delay', '_m_poll_interval',
+                 '_m_batch', '_m_dead_letter_max', '_m_lease', '_m_leased', '_m_lease_due']
+
+    KEY_RETRY = 'email:retry:{}'
+    KEY_DEAD = 'email:dead:{}'
+
+    def __init__(self, redis: Redis, channels: list[str], handler: Callable[[RetryEntry, bytes], Awaitable[None]],
+                 logger: ILogger, base_delay: float = 5, max_delay: float = 900, poll_interval: float = 1,
+                 batch: int = 64, dead_letter_max: int = 10000, lease: float = 300) -> None:
+        self.logger = logger
+        self._m_redis = redis
+        self._m_channels = channels
+        self._m_handler = handler
+        self._m_base_delay = base_delay
+        self._m_max_delay = max_delay
+        self._m_poll_interval = poll_interval
+        self._m_batch = batch
+        self._m_dead_letter_max = dead_letter_max
+        self._m_lease = lease
+        self._m_leased = {ch_name: set() for ch_name in channels}
+        self._m_lease_due = redis.register_script(_LUA_LEASE_DUE)
+
+    def __repr__(self) -> str:
+        return f'RetryQueue({self._m_channels}, delay={self._m_base_delay}..{self._m_max_delay}s)'
+
+    def backoff(self, attempt: int) -> float:
+        # "equal jitter", at least half of the exponential delay, so that the retries of an outage do not flock together
+        delay = min(self._m_max_delay, self._m_base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def schedule(self, entry: RetryEntry, delay: float = -1):
+        delay = self.backoff(entry.attempt - 1) if delay < 0 else delay
+        await self._m_redis.zadd(self.KEY_RETRY.format(entry.channel), {entry.encode(): time.time() + delay})
+        self.logger.debug('retry #%d on %s in %.1fs', entry.attempt, entry.channel, delay)
+
+    async def dead_letter(self, entry: RetryEntry):
+        key = self.KEY_DEAD.format(entry.channel)
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(key, entry.encode())
+            pipe.ltrim(key, 0, self._m_dead_letter_max - 1)
+            await pipe.execute()
+        self.logger.error('gave up on a request of %s after %d attempt(s): %s', entry.channel, entry.attempt, entry.error)
+
+    async def done(self, channel: str, member: bytes):
+        """the leased entry `member` is off our hands, it is removed from its set"""
+        self._m_leased.get(channel, set()).discard(member)
+        try:
+            await self._m_redis.zrem(self.KEY_RETRY.format(channel), member)
+        except Exception as excp:
+            # it is due again once its lease is over, `dedup` channels spare its recipients a second copy
+            self.logger.warning('unable to remove a retry of %s: %r', channel, excp)
+
+    def release(self, channel: str, member: bytes):
+        """give up the lease of `member` without being done with it, it is due again once the lease is over"""
+        self._m_leased.get(channel, set()).discard(member)
+
+    async def run(self):
+        keepalive = asyncio.ensure_future(self._keepalive())
+        try:
+            await asyncio.gather(*(self._drain([ch_name]) for ch_name in self._m_channels))
+        finally:
+            keepalive.cancel()
+
+    async def _drain(self, channels: list[str]):
+        while True:
+            try:
+                drained = await self._poll(channels)
+            except Exception as excp:
+                self.logger.exception(repr(excp))
+                drained = 0
+            # a full batch means there is more due already
+            if drained < self._m_batch:
+                await asyncio.sleep(self._m_poll_interval)
+
+    async def _keepalive(self):
+        # on a task of its own, the pollers wait for room in the queues for as long as it takes
+        while True:
+            await asyncio.sleep(self._m_lease / 3)
+            try:
+                await self._renew()
+            except Exception as excp:
+                self.logger.warning('unable to renew the leases of the retries in flight: %r', excp)
+
+    async def _renew(self):
+        due = time.time() + self._m_lease
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for ch_name, members in self._m_leased.items():
+                if members:
+                    # XX, the ones done with meanwhile are not added again
+                    pipe.zadd(self.KEY_RETRY.format(ch_name), dict.fromkeys(members, due), xx=True)
+            await pipe.execute()
+
+    async def _poll(self, channels: Optional[list[str]] = None) -> int:
+        channels = channels or self._m_channels
+        now = time.time()
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for ch_name in channels:
+                await self._m_lease_due(keys=[self.KEY_RETRY.format(ch_name)],
+                                        args=[now, self._m_batch, now + self._m_lease], client=pipe)
+            rslt = await pipe.execute()
+        leased = [(ch_name, raw) for ch_name, items in zip(channels, rslt) for raw in items]
+        for ch_name, raw in leased:
+            self._m_leased[ch_name].add(raw)
+        for idx, (ch_name, raw) in enumerate(leased):
+            try:
+                await self._m_handler(RetryEntry.decode(raw), raw)
+            except Exception:
+                # the rest are due again once their lease is over
+                for x in leased[idx:]:
+                    self.release(*x)
+                raise
+        return max((len(x) for x in rslt), default=0)
@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+from collections import deque
+from typing import Generic, Optional, Protocol, TypeVar
+
+
+class IChannelItem(Protocol):
+    @property
+    def channel(self) -> str: ...
+
+TItem = TypeVar('TItem', bound=IChannelItem)
+
+class ChannelQueue(Generic[TItem]):
+    name: str
+    priority: int
+    weight: int
+    items: deque[TItem]
+    # virtual finish time of the last item served, advances by 1/weight per item
+    vtime: float
+
+    __slots__ = ['name', 'priority', 'weight', 'items', 'vtime']
+
+    def __init__(self, name: str, priority: int = 0, weight: int = 1) -> None:
+        self.name = name
+        self.priority = priority
+        self.weight = max(1, weight)
+        self.items = deque()
+        self.vtime = 0.0
+
+    def __repr__(self) -> str:
+        return f'{self.name}(p={self.priority}, w={self.weight}, queued={len(self.items)})'
+
+class ChannelScheduler(Generic[TItem]):
+    """
+    `asyncio.Queue` like buffer of the delivery engine, with a queue per channel.
+    - `get` serves the channels by strict priority (higher first), the channels of the same priority share the senders
+      as per their weight (weighted fair queuing on virtual time, a channel idle for a while gets no credit for it)
+    - `put` waits only while the queue of that very channel holds `maxsize` items, a burst on a bulk channel never
+      fills up the buffer of the other channels
+    - `task_done` & `join` as per `asyncio.Queue`
+    """
+
+    _m_maxsize: int
+    _m_queues: dict[str, ChannelQueue[TItem]]
+    _m_size: int
+    _m_unfinished: int
+    _m_vtime: float
+    _m_cond: asyncio.Condition
+    _m_finished: asyncio.Event
+
+    __slots__ = ['_m_maxsize', '_m_queues', '_m_size', '_m_unfinished', '_m_vtime', '_m_cond', '_m_finished']
+
+    def __init__(self, maxsize: int = 0) -> None:
+        self._m_maxsize = maxsize
+        self._m_queues = {}
+        self._m_size = 0
+        self._m_unfinished = 0
+        self._m_vtime = 0.0
+        self._m_cond = asyncio.Condition()
+        self._m_finished = asyncio.Event()
+        self._m_finished.set()
+
+    def __repr__(self) -> str:
+        return f'ChannelScheduler({list(self._m_queues.values())})'
+
+    def add_channel(self, name: str, priority: int = 0, weight: int = 1):
+        self._m_queues[name] = ChannelQueue(name, priority, weight)
+
+    def qsize(self, name: Optional[str] = None) -> int:
+        """items queued, of the channel `name` only if given"""
+        if name is None:
+            return self._m_size
+        que = self._m_queues.get(name)
+        return len(que.items) if que is not None else 0
+
+    def full(self, name: str) -> bool:
+        """a `put` of the channel `name` would wait"""
+        que = self._m_queues.get(name)
+        return self._m_maxsize > 0 and que is not None and len(que.items) >= self._m_maxsize
+
+    async def put(self, item: TItem):
+        if (que := self._m_queues.get(item.channel)) is None:
+            que = self._m_queues[item.channel] = ChannelQueue(item.channel)
+        async with self._m_cond:
+            if self._m_maxsize > 0:
+                await self._m_cond.wait_for(lambda: len(que.items) < self._m_maxsize)
+            if not que.items:
+                # back from idle, starts at the current virtual time instead of its old (lower) one
+                que.vtime = max(que.vtime, self._m_vtime)
+            que.items.append(item)
+            self._m_size += 1
+            self._m_unfinished += 1
+            self._m_finished.clear()
+            self._m_cond.notify_all()
+
+    async def get(self) -> TItem:
+        async with self._m_cond:
+            await self._m_cond.wait_for(lambda: self._m_size > 0)
+            que = self._pick()
+            self._m_vtime = que.vtime
+            que.vtime += 1 / que.weight
+            self._m_size -= 1
+            item = que.items.popleft()
+            self._m_cond.notify_all()
+            return item
+
+    def _pick(self) -> ChannelQueue[TItem]:
+        best = None
+        for que in self._m_queues.values():
+            if que.items and (best is None or (-que.priority, que.vtime) < (-best.priority, best.vtime)):
+                best = que
+        assert best is not None
+        return best
+
+    def task_done(self):
+        if self._m_unfinished <= 0:
+            raise ValueError('task_done() called too many times')
+        self._m_unfinished -= 1
+        if self._m_unfinished == 0:
+            self._m_finished.set()
+
+    async def join(self):
+        if self._m_unfinished > 0:
+            await self._m_finished.wait()
@@ -0,0 +1,160 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import smtplib
+import time
+from typing import NoReturn
+
+from .config import ConfigRelay, ConfigSMTP
+from .utils import ILogger
+
+
+class PooledSmtp():
+    smtp: smtplib.SMTP
+    sent: int
+    last_used: float
+    healthy: bool
+
+    __slots__ = ['smtp', 'sent', 'last_used', 'healthy']
+
+    def __init__(self, smtp: smtplib.SMTP) -> None:
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+        self.healthy = True
+
+class SmtpPool():
+    """
+    per process pool of authenticated (and STARTTLS'ed if configured) SMTP sessions to one `relay`.
+    - at most `ConfigSMTP.pool_max` sessions are handed out, `acquire` waits for a free one beyond that.
+    - a session is closed once it sent `ConfigSMTP.pool_max_messages` eMails, many relays drop us after N messages anyway.
+    - `health_check` runs every `ConfigSMTP.keep_alive_interval` seconds, it `NOOP`s the idle sessions, evicts the ones
+      idle for more than `ConfigSMTP.pool_idle_timeout` seconds and tops the pool up to `ConfigSMTP.pool_min` sessions.
+    """
+
+    logger: ILogger
+    _m_config: ConfigSMTP
+    _m_relay: ConfigRelay
+    _m_idle: list[PooledSmtp]
+    _m_slots: asyncio.Semaphore
+    _m_total: int
+
+    __slots__ = ['logger', '_m_config', '_m_relay', '_m_idle', '_m_slots', '_m_total']
+
+    def __init__(self, config: ConfigSMTP, logger: ILogger, relay: ConfigRelay) -> None:
+        self.logger = logger
+        self._m_config = config
+        self._m_relay = relay
+        self._m_idle = []
+        self._m_slots = asyncio.Semaphore(max(1, config.pool_max))
+        self._m_total = 0
+
+    def __repr__(self) -> str:
+        return (f'SmtpPool({self._m_relay.name}, total={self._m_total}, idle={len(self._m_idle)}, '
+                f'max={self._m_config.pool_max})')
+
+    async def start(self):
+        # the first session is opened on its own, so that configuration/credential errors surface at startup
+        self._m_idle.append(await self._open())
+        await self._top_up()
+
+    async def acquire(self) -> PooledSmtp:
+        await self._m_slots.acquire()
+        try:
+            # LIFO, recently used sessions are the least likely to be dropped by the server
+            if self._m_idle:
+                return self._m_idle.pop()
+            return await self._open()
+        except BaseException:
+            self._m_slots.release()
+            raise
+
+    def release(self, conn: PooledSmtp):
+        self._m_slots.release()
+        conn.last_used = time.monotonic()
+        if (not conn.healthy or conn.sent >= self._m_config.pool_max_messages or
+            self._m_total > self._m_config.pool_max):
+            self._discard(conn)
+        else:
+            self._m_idle.append(conn)
+
+    async def health_check(self) -> NoReturn:
+        while True:
+            await asyncio.sleep(self._m_config.keep_alive_interval)
+            try:
+                await self._check_idle()
+                await self._top_up()
+            except Exception as excp:
+                self.logger.exception(repr(excp))
+
+    async def close(self):
+        conns, self._m_idle = self._m_idle, []
+        await asyncio.gather(*(asyncio.to_thread(self._quit, conn) for conn in conns))
+        self._m_total -= len(conns)
+
+    async def _open(self) -> PooledSmtp:
+        conn = PooledSmtp(await asyncio.to_thread(self._connect))
+        self._m_total += 1
+        self.logger.debug('SMTP session opened, %r', self)
+        return conn
+
+    def _connect(self) -> smtplib.SMTP:
+        # runs on a worker thread, no logging in here (picologging handlers may deadlock when called from a thread)
+        relay = self._m_relay
+        smtp_class = smtplib.SMTP_SSL if relay.ssl else smtplib.SMTP
+        smtp = smtp_class(relay.host, relay.port, timeout=30)
+        smtp.set_debuglevel(1 if self._m_config.debug else 0)
+        if relay.starttls and not relay.ssl:
+            smtp.starttls()
+        if relay.username:
+            smtp.login(relay.username, relay.password)
+        return smtp
+
+    def _discard(self, conn: PooledSmtp):
+        self._m_total -= 1
+        # QUIT may wait on a dead server, do not hold the caller for it
+        asyncio.get_running_loop().run_in_executor(None, self._quit, conn)
+
+    async def _check_idle(self):
+        now = time.monotonic()
+        conns, self._m_idle = self._m_idle, []
+        checked: list[PooledSmtp] = []
+        for conn in conns:
+            if now - conn.last_used > self._m_config.pool_idle_timeout and self._m_total > self._m_config.pool_min:
+                self._discard(conn)
+            else:
+                checked.append(conn)
+
+        # sessions under check are out of the idle list, so no sender picks them up in between
+        await asyncio.gather(*(asyncio.to_thread(self._noop, conn) for conn in checked))
+        for conn in checked:
+            if conn.healthy:
+                self._m_idle.insert(0, conn)
+            else:
+                self._discard(conn)
+
+    async def _top_up(self):
+        missing = self._m_config.pool_min - self._m_total
+        if missing <= 0:
+            return
+        rslt = await asyncio.gather(*(self._open() for _ in range(missing)), return_exceptions=True)
+        for conn in rslt:
+            if isinstance(conn, PooledSmtp):
+                self._m_idle.append(conn)
+            else:
+                self.logger.warning('SMTP pool of %s unable to open a session: %r', self._m_relay.name, conn)
+
+    def _noop(self, conn: PooledSmtp):
+        try:
+            conn.smtp.noop()
+        except (smtplib.SMTPException, OSError):
+            conn.healthy = False
+
+    @staticmethod
+    def _quit(conn: PooledSmtp):
+        try:
+            conn.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.smtp.close()
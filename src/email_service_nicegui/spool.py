@@ -0,0 +1,414 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections import deque
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.policy import default as default_policy
+from typing import Awaitable, Callable, Collection, NamedTuple, NoReturn, Optional
+
+from .config import ConfigSMTP
+from .utils import ILogger
+
+if sys.platform != 'win32':
+    import fcntl
+
+# frame of a spool record: crc32 (of the rest) | body length | kind | sequence number | body
+_HEADER = struct.Struct('<IIBQ')
+_PUT = 1
+_DONE = 2
+
+class SpoolEntry(NamedTuple):
+    channel: str
+    data: bytes
+    # the converted eMail, as serialized by `EmailMessage.as_bytes`
+    email: bytes
+    # number of delivery attempts made before this one
+    attempt: int = 0
+    # when the request was enqueued by the producer (epoch seconds)
+    enqueued: float = 0
+    # idempotency key, None when the channel does not suppress duplicates
+    key: Optional[str] = None
+
+    def encode(self) -> bytes:
+        # the request & the eMail are stored as is after a newline, the header tells where the one ends
+        hdr = {'channel': self.channel, 'attempt': self.attempt, 'enqueued': self.enqueued, 'key': self.key,
+               'data': len(self.data)}
+        return json.dumps(hdr).encode() + b'\n' + bytes(self.data) + self.email
+
+    @classmethod
+    def decode(cls, raw: bytes) -> 'SpoolEntry':
+        hdr, _, rest = raw.partition(b'\n')
+        hdr = json.loads(hdr)
+        size = hdr['data']
+        return cls(hdr['channel'], rest[:size], rest[size:], hdr['attempt'], hdr['enqueued'], hdr['key'])
+
+    def message(self) -> EmailMessage:
+        rtn = message_from_bytes(self.email, _class=EmailMessage, policy=default_policy)
+        assert isinstance(rtn, EmailMessage)
+        return rtn
+
+class _Record(NamedTuple):
+    segment: int
+    offset: int
+    # frame size, header included
+    size: int
+    channel: str
+
+class WriteAheadSpool():
+    """
+    on-disk write-ahead spool of a worker, for the converted eMails that exist nowhere else (pub/sub & retry requests,
+    a stream request stays pending in its stream until acknowledged anyway).
+    - records are appended to segment files `<path>/<n>.seg` of up to `ConfigSMTP.spool_segment_size` bytes, an eMail
+      is `append`ed before its SMTP transaction and marked `done` once SMTP (or the retry queue) took it over.
+    - only the index of the live records (segment, offset & channel) is kept in memory, an eMail whose channel queue
+      of the delivery engine is full is `park`ed on disk, `feed` reads it back (memory mapped) once there is room. so
+      the subscription keeps on reading during a long outage, at the cost of disk space instead of memory.
+    - `open` replays the live records of the previous run (crash, SIGTERM with a full queue, ...) of the same worker
+      name, they are parked for their channels in the order they were appended. the process holds an exclusive lock
+      (`flock`) of the spool directory until `close`, a second one opening it fails. `adopt` takes over the spools of
+      the workers gone for good (e.g. a standalone one named after its pid), the sibling directories nobody holds.
+    - `run` compacts every `ConfigSMTP.spool_compact_interval` seconds, a sealed segment without live records is
+      deleted, one less than half live has its live records copied to the active segment first. a segment holding
+      done marks of records in an older segment is kept as long as that one is, else they would be live again.
+    - `ConfigSMTP.spool_fsync`, an `append` returns only once the record is on disk (one fsync per batch of concurrent
+      appends), else a crash of the process loses nothing but a crash of the host may. `done` is never synced, a mark
+      lost in a crash resends the eMail (use `dedup` channels against that).
+    """
+
+    logger: ILogger
+    _m_path: str
+    _m_config: ConfigSMTP
+    _m_index: dict[int, _Record]
+    # bytes of the live records per segment
+    _m_live: dict[int, int]
+    _m_sizes: dict[int, int]
+    # the older segments whose records are marked done in a segment
+    _m_refs: dict[int, set[int]]
+    _m_maps: dict[int, mmap.mmap]
+    _m_segment: int
+    _m_fd: int
+    _m_seq: int
+    _m_parked: dict[str, deque[int]]
+    _m_wakeup: dict[str, asyncio.Event]
+    _m_written: int
+    _m_synced: int
+    _m_syncing: Optional[asyncio.Future[None]]
+    # the directory, locked while open
+    _m_lock: int
+
+    __slots__ = ['logger', '_m_path', '_m_config', '_m_index', '_m_live', '_m_sizes', '_m_refs', '_m_maps', '_m_segment',
+                 '_m_fd', '_m_seq', '_m_parked', '_m_wakeup', '_m_written', '_m_synced', '_m_syncing', '_m_lock']
+
+    def __init__(self, path: str, config: ConfigSMTP, logger: ILogger) -> None:
+        self.logger = logger
+        self._m_path = path
+        self._m_config = config
+        self._m_index = {}
+        self._m_live = {}
+        self._m_sizes = {}
+        self._m_refs = {}
+        self._m_maps = {}
+        self._m_segment = 0
+        self._m_fd = -1
+        self._m_seq = 0
+        self._m_parked = {}
+        self._m_wakeup = {}
+        self._m_written = 0
+        self._m_synced = 0
+        self._m_syncing = None
+        self._m_lock = -1
+
+    def __repr__(self) -> str:
+        parked = {ch: len(que) for ch, que in self._m_parked.items() if que}
+        return (f'WriteAheadSpool({self._m_path}, segments={len(self._m_sizes)}, live={len(self._m_index)}, '
+                f'parked={parked})')
+
+    def _file(self, segment: int) -> str:
+        return os.path.join(self._m_path, f'{segment:08d}.seg')
+
+    def open(self) -> int:
+        """
+        scan the segments left over, the live records are parked for their channels. a torn record at the end of a
+        segment (crash while writing) and everything after it is ignored.
+        Returns: the number of eMails replayed.
+        """
+        os.makedirs(self._m_path, exist_ok=True)
+        if not self._lock():
+            raise RuntimeError(f'spool {self._m_path} is in use by an other process, every worker needs a name of its own')
+        segments = self._load()
+        self._m_segment = (segments[-1] if segments else 0)
+        self._roll()
+        for seq in sorted(self._m_index):
+            self.park(self._m_index[seq].channel, seq)
+        if self._m_index:
+            self.logger.info('spool %s, replaying %d eMail(s): %s', self._m_path, len(self._m_index),
+                             {ch: len(que) for ch, que in self._m_parked.items()})
+        return len(self._m_index)
+
+    def _lock(self) -> bool:
+        """True, this process holds the spool directory now. False, an other one does"""
+        self._m_lock = os.open(self._m_path, os.O_RDONLY)
+        if sys.platform != 'win32':
+            try:
+                fcntl.flock(self._m_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(self._m_lock)
+                self._m_lock = -1
+                return False
+        return True
+
+    def _load(self) -> list[int]:
+        segments = sorted(int(x[:-4]) for x in os.listdir(self._m_path) if x.endswith('.seg') and x[:-4].isdigit())
+        for segment in segments:
+            self._scan(segment)
+        return segments
+
+    async def adopt(self, channels: Collection[str]) -> int:
+        """
+        take over the spools left behind next to this one, the directories no process holds. their live records are
+        appended to this spool & parked, the directory is removed. one with eMails of other channels than `channels` is
+        left to a worker serving them. a crash before the removal sends the eMails taken over once more.
+        Returns: the number of eMails taken over.
+        """
+        parent, rtn = os.path.dirname(self._m_path), 0
+        for name in sorted(os.listdir(parent)):
+            path = os.path.join(parent, name)
+            if path == self._m_path or not os.path.isdir(path):
+                continue
+            orphan = WriteAheadSpool(path, self._m_config, self.logger)
+            try:
+                if not orphan._lock():
+                    continue
+                segments = orphan._load()
+                if others := {x.channel for x in orphan._m_index.values()} - set(channels):
+                    self.logger.info('spool %s left to the workers of %s', path, sorted(others))
+                    continue
+                for seq in sorted(orphan._m_index):
+                    self.park(orphan._m_index[seq].channel, self._put(orphan.read(seq)))
+                if orphan._m_index and self._m_config.spool_fsync:
+                    await self._commit()
+                for segment in segments:
+                    os.remove(orphan._file(segment))
+                os.rmdir(path)
+                if orphan._m_index:
+                    self.logger.info('spool %s taken over, replaying %d eMail(s)', path, len(orphan._m_index))
+                rtn += len(orphan._m_index)
+            except Exception as excp:
+                # e.g. taken over by an other worker meanwhile or not a spool at all
+                self.logger.warning('unable to take over the spool %s: %r', path, excp)
+            finally:
+                await orphan.close()
+        return rtn
+
+    def _scan(self, segment: int):
+        size = os.path.getsize(self._file(segment))
+        self._m_sizes[segment] = size
+        self._m_live.setdefault(segment, 0)
+        if size == 0:
+            return
+        buf = self._map(segment, size)
+        offset = 0
+        while offset < size:
+            crc, length, kind, seq = _HEADER.unpack_from(buf, offset) if offset + _HEADER.size <= size else (0, 0, 0, 0)
+            end = offset + _HEADER.size + length
+            if end > size or zlib.crc32(buf[offset + 4:end]) != crc:
+                self.logger.warning('spool %s, torn record at %d, %d byte(s) ignored', self._file(segment), offset,
+                                    size - offset)
+                break
+            self._m_seq = max(self._m_seq, seq)
+            if kind == _PUT:
+                # a record copied by the compaction is found twice, the later copy wins
+                self._forget(seq)
+                start = offset + _HEADER.size
+                hdr = json.loads(buf[start:buf.find(b'\n', start, end)])
+                self._index(seq, _Record(segment, offset, end - offset, hdr['channel']))
+            elif kind == _DONE:
+                self._marked(segment, self._forget(seq))
+            offset = end
+
+    def _index(self, seq: int, record: _Record):
+        self._m_index[seq] = record
+        self._m_live[record.segment] = self._m_live.get(record.segment, 0) + record.size
+
+    def _forget(self, seq: int) -> Optional[_Record]:
+        if (record := self._m_index.pop(seq, None)) is not None:
+            self._m_live[record.segment] -= record.size
+        return record
+
+    def _marked(self, segment: int, record: Optional[_Record]):
+        # the done mark of `record` is in `segment`
+        if record is not None and record.segment != segment:
+            self._m_refs.setdefault(segment, set()).add(record.segment)
+
+    def _map(self, segment: int, size: int) -> mmap.mmap:
+        # the active segment grows, its map is renewed once a record beyond its end is read
+        if (buf := self._m_maps.get(segment)) is None or len(buf) < size:
+            if buf is not None:
+                buf.close()
+            with open(self._file(segment), 'rb') as fp:
+                buf = self._m_maps[segment] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return buf
+
+    def _roll(self):
+        # a new active segment, the previous one is sealed (the segments of the last run are never appended to)
+        if self._m_fd >= 0:
+            if self._m_config.spool_fsync:
+                os.fsync(self._m_fd)
+            os.close(self._m_fd)
+        self._m_segment += 1
+        self._m_fd = os.open(self._file(self._m_segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._m_sizes[self._m_segment] = 0
+        self._m_live[self._m_segment] = 0
+
+    def _write(self, frame: bytes) -> tuple[int, int]:
+        size = self._m_sizes[self._m_segment]
+        if size and size + len(frame) > self._m_config.spool_segment_size:
+            self._roll()
+        offset = self._m_sizes[self._m_segment]
+        os.write(self._m_fd, frame)
+        self._m_sizes[self._m_segment] += len(frame)
+        self._m_written += 1
+        return self._m_segment, offset
+
+    @staticmethod
+    def _frame(kind: int, seq: int, body: bytes = b'') -> bytes:
+        rest = _HEADER.pack(0, len(body), kind, seq)[4:] + body
+        return struct.pack('<I', zlib.crc32(rest)) + rest
+
+    async def append(self, entry: SpoolEntry) -> int:
+        """journal an eMail, Returns: its sequence number, to `done`/`park`/`read` it by"""
+        seq = self._put(entry)
+        if self._m_config.spool_fsync:
+            await self._commit()
+        return seq
+
+    def _put(self, entry: SpoolEntry) -> int:
+        self._m_seq += 1
+        seq = self._m_seq
+        frame = self._frame(_PUT, seq, entry.encode())
+        segment, offset = self._write(frame)
+        self._index(seq, _Record(segment, offset, len(frame), entry.channel))
+        return seq
+
+    async def _commit(self):
+        # group commit, one fsync covers all the records written before it started
+        target = self._m_written
+        while self._m_synced < target:
+            if self._m_syncing is None:
+                self._m_syncing = asyncio.ensure_future(self._fsync())
+            await asyncio.shield(self._m_syncing)
+
+    async def _fsync(self):
+        written = self._m_written
+        # a duplicate, the active segment may roll over meanwhile
+        fd = os.dup(self._m_fd)
+        try:
+            await asyncio.to_thread(os.fsync, fd)
+            self._m_synced = written
+        finally:
+            os.close(fd)
+            self._m_syncing = None
+
+    def done(self, seq: int):
+        """the eMail is off our hands (accepted, rejected for good or in the retry queue)"""
+        if (record := self._forget(seq)) is not None:
+            segment, _ = self._write(self._frame(_DONE, seq))
+            self._marked(segment, record)
+
+    def read(self, seq: int) -> SpoolEntry:
+        record = self._m_index[seq]
+        buf = self._map(record.segment, record.offset + record.size)
+        return SpoolEntry.decode(buf[record.offset + _HEADER.size:record.offset + record.size])
+
+    def park(self, channel: str, seq: int):
+        """leave the journaled eMail on disk only, `feed` hands it over once its channel has room"""
+        self._m_parked.setdefault(channel, deque()).append(seq)
+        self._m_wakeup.setdefault(channel, asyncio.Event()).set()
+
+    def parked(self, channel: str) -> int:
+        return len(self._m_parked.get(channel, ()))
+
+    async def feed(self, channel: str, submit: Callable[[int, SpoolEntry], Awaitable[None]]) -> NoReturn:
+        """
+        hands the eMails parked for `channel` over to `submit` in order, one at a time, `submit` may wait for room.
+        an eMail stays parked (the first in line) until `submit` returned, new ones of the channel line up behind it.
+        """
+        parked = self._m_parked.setdefault(channel, deque())
+        wakeup = self._m_wakeup.setdefault(channel, asyncio.Event())
+        while True:
+            while not parked:
+                wakeup.clear()
+                await wakeup.wait()
+            seq = parked[0]
+            if seq in self._m_index:
+                try:
+                    await submit(seq, self.read(seq))
+                except Exception as excp:
+                    # e.g. unreadable, dropped from memory but left on disk for the next start
+                    self.logger.exception('spool record %d of %s: %r', seq, channel, excp)
+            parked.popleft()
+
+    async def compact(self):
+        drop: list[int] = []
+        # the oldest first, the segments a done mark refers to are older than the one holding it
+        for segment in sorted(x for x in self._m_sizes if x != self._m_segment):
+            live = self._m_live.get(segment, 0)
+            if live * 2 >= self._m_sizes[segment]:
+                continue
+            if any(x in self._m_sizes and x not in drop for x in self._m_refs.get(segment, ())):
+                # its done marks are needed as long as the records they mark are on disk
+                continue
+            if live:
+                buf = self._map(segment, self._m_sizes[segment])
+                moved = [(seq, x) for seq, x in self._m_index.items() if x.segment == segment]
+                for seq, record in moved:
+                    # copied as is, the sequence number stays the same
+                    frame = bytes(buf[record.offset:record.offset + record.size])
+                    self._forget(seq)
+                    dest, offset = self._write(frame)
+                    self._index(seq, _Record(dest, offset, record.size, record.channel))
+                self.logger.debug('spool %s, %d record(s) of segment %d copied', self._m_path, len(moved), segment)
+            drop.append(segment)
+        if drop and self._m_config.spool_fsync:
+            # the copies are on disk before their origin is gone
+            await self._commit()
+        for segment in drop:
+            # in order, a crash in between never leaves the done marks of a record gone before the record
+            if (buf := self._m_maps.pop(segment, None)) is not None:
+                buf.close()
+            os.remove(self._file(segment))
+            del self._m_sizes[segment]
+            self._m_live.pop(segment, None)
+            self._m_refs.pop(segment, None)
+
+    async def run(self) -> NoReturn:
+        while True:
+            await asyncio.sleep(self._m_config.spool_compact_interval)
+            try:
+                await self.compact()
+            except Exception as excp:
+                self.logger.warning('unable to compact the spool %s: %r', self._m_path, excp)
+
+    async def close(self):
+        for buf in self._m_maps.values():
+            buf.close()
+        self._m_maps = {}
+        if self._m_fd >= 0:
+            await asyncio.to_thread(os.fsync, self._m_fd)
+            os.close(self._m_fd)
+            self._m_fd = -1
+            if self._m_index:
+                self.logger.info('spool %s, %d eMail(s) left for the next start', self._m_path, len(self._m_index))
+        if self._m_lock >= 0:
+            # the lock goes with it
+            os.close(self._m_lock)
+            self._m_lock = -1
@@ -0,0 +1,217 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import os
+import socket
+from enum import Enum
+from typing import Awaitable, Callable, Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+from .utils import ILogger
+
+
+class ETransport(str, Enum):
+    # fire & forget, every subscribed worker gets (and sends) its own copy
+    PUBSUB = 'pubsub'
+    # Redis Streams consumer group, each request goes to exactly one worker and survives worker restarts
+    STREAM = 'stream'
+
+class StreamConsumer():
+    """
+    Redis Streams consumer group reader for the channels registered with `ETransport.STREAM`.
+    - the stream key is the channel name itself, a request is added by `XADD <channel> * data <payload>`
+    - every worker process joins the same consumer group, so a request is handed out to exactly one of them
+    - requests are read in batches (`XREADGROUP COUNT .. BLOCK ..`) and acknowledged (`XACK` + `XDEL`) only once
+      `ack` is called, i.e. after the SMTP server accepted the eMail (or we gave up on it)
+    - every stream is read by a loop of its own (on a connection of its own), a handler waiting for room in the queues
+      of its channel holds up the reads of that stream only
+    - requests pending on a crashed/stopped worker for more than `claim_idle_ms` are taken over via `XAUTOCLAIM`.
+      the ones handed to the handler & not acknowledged yet (queued, in a slow SMTP transaction, ...) are in flight,
+      their idle time is reset (`XCLAIM .. JUSTID`) every `claim_idle_ms / 2` so that nobody takes them over, and
+      they are never handed out twice. `release` gives one up, it is claimed (by any worker) once idle.
+    - a failing read (e.g. Redis restarting) is logged and retried with a growing delay, the group is created again
+      if it is gone.
+    """
+
+    logger: ILogger
+    _m_redis: Redis
+    _m_channels: list[str]
+    _m_handler: Callable[[str, bytes, bytes], Awaitable[None]]
+    _m_group: str
+    _m_consumer: str
+    _m_count: int
+    _m_block_ms: int
+    _m_claim_idle_ms: int
+    _m_acks: dict[str, list[bytes]]
+    # handed to the handler, not acknowledged (flushed) yet
+    _m_inflight: dict[str, set[bytes]]
+    _m_running: bool
+
+    __slots__ = ['logger', '_m_redis', '_m_channels', '_m_handler', '_m_group', '_m_consumer', '_m_count',
+                 '_m_block_ms', '_m_claim_idle_ms', '_m_acks', '_m_inflight', '_m_running']
+
+    # seconds between the attempts to read once Redis fails, doubled up to the maximum
+    RETRY_DELAY = 0.5
+    RETRY_DELAY_MAX = 30
+
+    def __init__(self, redis: Redis, channels: list[str], handler: Callable[[str, bytes, bytes], Awaitable[None]],
+                 logger: ILogger, group: str = 'email-service', consumer: Optional[str] = None, count: int = 64,
+                 block_ms: int = 1000, claim_idle_ms: int = 60000) -> None:
+        self.logger = logger
+        self._m_redis = redis
+        self._m_channels = channels
+        self._m_handler = handler
+        self._m_group = group
+        self._m_consumer = consumer or f'{socket.gethostname()}:{os.getpid()}'
+        self._m_count = count
+        self._m_block_ms = block_ms
+        self._m_claim_idle_ms = claim_idle_ms
+        self._m_acks = {}
+        self._m_inflight = {ch_name: set() for ch_name in channels}
+        self._m_running = True
+
+    def __repr__(self) -> str:
+        inflight = sum(len(x) for x in self._m_inflight.values())
+        return f'StreamConsumer({self._m_group}/{self._m_consumer}, {self._m_channels}, inflight={inflight})'
+
+    async def start(self):
+        for ch_name in self._m_channels:
+            await self._create(ch_name)
+
+    async def _create(self, ch_name: str):
+        try:
+            await self._m_redis.xgroup_create(ch_name, self._m_group, id='0', mkstream=True)
+        except ResponseError as excp:
+            # BUSYGROUP, some other worker created the group already
+            if 'BUSYGROUP' not in str(excp): raise
+
+    def ack(self, ch_name: str, msg_id: bytes):
+        # acknowledgements are batched and flushed before the next read
+        self._m_acks.setdefault(ch_name, []).append(msg_id)
+
+    def release(self, ch_name: str, msg_id: bytes):
+        """give up a request without acknowledging it, it stays pending until claimed once idle"""
+        self._m_inflight.get(ch_name, set()).discard(msg_id)
+
+    async def flush(self):
+        if not self._m_acks:
+            return
+        acks, self._m_acks = self._m_acks, {}
+        try:
+            async with self._m_redis.pipeline(transaction=False) as pipe:
+                for ch_name, msg_ids in acks.items():
+                    pipe.xack(ch_name, self._m_group, *msg_ids)
+                    pipe.xdel(ch_name, *msg_ids)
+                await pipe.execute()
+        except Exception:
+            # again with the next flush, the requests stay in flight meanwhile
+            for ch_name, msg_ids in acks.items():
+                self._m_acks.setdefault(ch_name, []).extend(msg_ids)
+            raise
+        for ch_name, msg_ids in acks.items():
+            self._m_inflight.get(ch_name, set()).difference_update(msg_ids)
+
+    async def run(self):
+        keepalive = asyncio.ensure_future(self._keepalive())
+        try:
+            # a reader per stream, the one waiting for room in the queues of its channel does not hold up the others
+            await asyncio.gather(*(self._read(ch_name) for ch_name in self._m_channels))
+        finally:
+            keepalive.cancel()
+
+    async def _read(self, ch_name: str):
+        loop = asyncio.get_running_loop()
+        claim_due = 0.0
+        recover, failures = True, 0
+        while self._m_running:
+            try:
+                if recover:
+                    # the group is created again if Redis lost it (restarted without its data), the requests still
+                    # pending on this consumer name are handled first
+                    await self._create(ch_name)
+                    await self._pending(ch_name)
+                    recover, failures = False, 0
+                await self.flush()
+                if loop.time() >= claim_due:
+                    claim_due = loop.time() + self._m_claim_idle_ms / 2000
+                    await self._claim(ch_name)
+                await self._dispatch(ch_name, self._entries(await self._m_redis.xreadgroup(
+                    self._m_group, self._m_consumer, {ch_name: '>'}, count=self._m_count, block=self._m_block_ms)))
+            except Exception as excp:
+                recover, failures = True, failures + 1
+                delay = min(self.RETRY_DELAY_MAX, self.RETRY_DELAY * 2 ** (failures - 1))
+                self.logger.warning('unable to read the stream %s (%d time(s) in a row), again in %.1fs: %r', ch_name,
+                                    failures, delay, excp)
+                await asyncio.sleep(delay)
+
+    async def _keepalive(self):
+        # on a task of its own, the reader waits for room in the queues for as long as it takes
+        while True:
+            await asyncio.sleep(self._m_claim_idle_ms / 2000)
+            try:
+                await self._refresh()
+            except Exception as excp:
+                self.logger.warning('unable to refresh the requests in flight: %r', excp)
+
+    def stop(self):
+        # `run` returns after the read in progress (`block_ms` at most). redis-py 8 may swallow the cancellation of a
+        # blocking XREADGROUP, the reader would then go on after the closure flushed the acknowledgements.
+        self._m_running = False
+
+    async def _pending(self, ch_name: str):
+        # the history of this consumer name, page by page
+        last: str | bytes = '0'
+        while True:
+            entries = self._entries(await self._m_redis.xreadgroup(
+                self._m_group, self._m_consumer, {ch_name: last}, count=self._m_count))
+            if not entries:
+                break
+            await self._dispatch(ch_name, entries)
+            last = entries[-1][0]
+
+    @staticmethod
+    def _entries(rslt) -> list:
+        # XREADGROUP of one stream replies [[stream, entries]], nothing once BLOCK timed out
+        return rslt[0][1] if rslt else []
+
+    async def _refresh(self):
+        # the requests in flight are not idle, whatever time they wait in our queues
+        async with self._m_redis.pipeline(transaction=False) as pipe:
+            for ch_name, msg_ids in self._m_inflight.items():
+                if msg_ids:
+                    pipe.xclaim(ch_name, self._m_group, self._m_consumer, 0, list(msg_ids), justid=True)
+            await pipe.execute()
+
+    async def _claim(self, ch_name: str):
+        start, claimed = '0-0', 0
+        while True:
+            rslt = await self._m_redis.xautoclaim(
+                ch_name, self._m_group, self._m_consumer, self._m_claim_idle_ms, start, count=self._m_count)
+            messages = [x for x in rslt[1] if x[0] not in self._m_inflight[ch_name]]
+            claimed += len(messages)
+            await self._dispatch(ch_name, messages)
+            # the cursor is 0-0 once the whole pending entries list was scanned
+            if (start := rslt[0]) in (b'0-0', '0-0'):
+                break
+        if claimed:
+            self.logger.info('claimed %d pending request(s) on %s', claimed, ch_name)
+
+    async def _dispatch(self, ch_name: str, messages):
+        inflight = self._m_inflight[ch_name]
+        for msg_id, fields in messages:
+            if msg_id in inflight:
+                continue
+            inflight.add(msg_id)
+            if not fields:
+                # deleted from the stream while pending, nothing left to send
+                self.ack(ch_name, msg_id)
+                continue
+            try:
+                await self._m_handler(ch_name, fields[b'data'], msg_id)
+            except Exception:
+                self.release(ch_name, msg_id)
+                raise
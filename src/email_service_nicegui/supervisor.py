@@ -0,0 +1,138 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import multiprocessing
+import time
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, NoReturn, Optional
+
+from .utils import ILogger
+
+
+class WorkerProcess():
+    name: str
+    target: Callable[..., Any]
+    args: tuple
+    process: Optional[BaseProcess]
+    started: float
+    crashes: int
+    restart_at: float
+
+    __slots__ = ['name', 'target', 'args', 'process', 'started', 'crashes', 'restart_at']
+
+    def __init__(self, name: str, target: Callable[..., Any], args: tuple) -> None:
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.started = 0.0
+        self.crashes = 0
+        self.restart_at = 0.0
+
+    def __repr__(self) -> str:
+        pid = self.process.pid if self.process else None
+        return f'{self.name}(pid={pid}, crashes={self.crashes})'
+
+class WorkerSupervisor():
+    """
+    runs the eMail worker processes on its own, apart from the web app's CPU bound process pool.
+    - a worker exiting with a non-zero exit code (crash, killed, SMTP relay or Redis unreachable, ...) is restarted
+      after `restart_base_delay * 2**crashes` seconds (capped at `restart_max_delay`), the crash count is reset once a
+      worker ran for `stable_after` seconds
+    - a worker exiting cleanly (e.g. SIGINT/SIGTERM or a critical configuration error) is not restarted
+    - `stop` sends SIGTERM to every worker, waits up to `timeout` seconds for them to close down and then kills the rest
+    """
+
+    logger: ILogger
+    _m_ctx: Any
+    _m_workers: list[WorkerProcess]
+    _m_stopping: bool
+    _m_restart_base_delay: float
+    _m_restart_max_delay: float
+    _m_stable_after: float
+
+    __slots__ = ['logger', '_m_ctx', '_m_workers', '_m_stopping', '_m_restart_base_delay', '_m_restart_max_delay',
+                 '_m_stable_after']
+
+    def __init__(self, logger: ILogger, start_method: Optional[str] = None, restart_base_delay: float = 1,
+                 restart_max_delay: float = 60, stable_after: float = 30) -> None:
+        self.logger = logger
+        self._m_ctx = multiprocessing.get_context(start_method)
+        self._m_workers = []
+        self._m_stopping = False
+        self._m_restart_base_delay = restart_base_delay
+        self._m_restart_max_delay = restart_max_delay
+        self._m_stable_after = stable_after
+
+    def __repr__(self) -> str:
+        return f'WorkerSupervisor({self._m_workers})'
+
+    @property
+    def context(self):
+        return self._m_ctx
+
+    def add(self, name: str, target: Callable[..., Any], *args):
+        self._m_workers.append(WorkerProcess(name, target, args))
+
+    def pids(self) -> list[int]:
+        return [w.process.pid for w in self._m_workers if w.process and w.process.pid and w.process.is_alive()]
+
+    def start(self):
+        for worker in self._m_workers:
+            self._spawn(worker)
+
+    async def watch(self, interval: float = 1) -> NoReturn:
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for worker in self._m_workers:
+                if self._m_stopping or worker.process is None:
+                    continue
+                try:
+                    self._check(worker, now)
+                except Exception as excp:
+                    self.logger.exception(repr(excp))
+
+    def _check(self, worker: WorkerProcess, now: float):
+        assert worker.process is not None
+        if worker.process.is_alive():
+            if worker.crashes and now - worker.started > self._m_stable_after:
+                worker.crashes = 0
+            return
+        if worker.restart_at:
+            if now >= worker.restart_at:
+                self._spawn(worker)
+            return
+        if (exitcode := worker.process.exitcode) == 0:
+            self.logger.info('%r exited, not restarting it', worker)
+            worker.process = None
+            return
+        delay = min(self._m_restart_max_delay, self._m_restart_base_delay * 2 ** worker.crashes)
+        worker.crashes += 1
+        worker.restart_at = now + delay
+        self.logger.warning('%r died with exit code %s, restarting in %.1fs', worker, exitcode, delay)
+
+    async def stop(self, timeout: float = 30):
+        self._m_stopping = True
+        procs = [w.process for w in self._m_workers if w.process and w.process.is_alive()]
+        for proc in procs: proc.terminate()
+
+        def join_all():
+            deadline = time.monotonic() + timeout
+            for proc in procs:
+                proc.join(max(0, deadline - time.monotonic()))
+            for proc in procs:
+                if proc.is_alive(): proc.kill()
+
+        await asyncio.to_thread(join_all)
+        for worker in self._m_workers: worker.process = None
+        self.logger.debug('workers stopped: %d', len(procs))
+
+    def _spawn(self, worker: WorkerProcess):
+        worker.process = self._m_ctx.Process(target=worker.target, args=worker.args, name=worker.name)
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = 0.0
+        self.logger.debug('started %r', worker)
@@ -0,0 +1,269 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+import html
+import json
+import threading
+from collections import OrderedDict
+from email.headerregistry import BaseHeader
+from email.message import EmailMessage, MIMEPart
+from email.policy import default as default_policy
+from email.utils import formatdate
+from string import Formatter
+from typing import TYPE_CHECKING, Any, Iterable, Mapping, NamedTuple, Optional
+
+from .codec import decode_model
+
+if TYPE_CHECKING:
+    from pydantic import BaseModel
+
+_FORMATTER = Formatter()
+_MIME_VERSION = default_policy.header_factory('MIME-Version', '1.0')
+_ALTERNATIVE = default_policy.header_factory('Content-Type', 'multipart/alternative')
+
+class _Trusted(NamedTuple):
+    # value of a trusted field, rendered into HTML as it is
+    value: Any
+
+class _HtmlFormatter(Formatter):
+    """`str.format` of an HTML part, the values of the fields are escaped but the `trusted` ones"""
+
+    def __init__(self, trusted: frozenset[str]) -> None:
+        self.trusted = trusted
+
+    def get_field(self, field_name, args, kwargs):
+        obj, first = super().get_field(field_name, args, kwargs)
+        return (_Trusted(obj) if first in self.trusted else obj), first
+
+    def convert_field(self, value, conversion):
+        if isinstance(value, _Trusted):
+            return _Trusted(super().convert_field(value.value, conversion))
+        return super().convert_field(value, conversion)
+
+    def format_field(self, value, format_spec):
+        if isinstance(value, _Trusted):
+            return format(value.value, format_spec)
+        return html.escape(format(value, format_spec))
+
+def _fields(text: str) -> tuple[str, ...]:
+    # the (top level) fields of the `{field}` placeholders of a `str.format` template, parsing it validates it as well
+    return tuple(sorted({name.partition('.')[0].partition('[')[0] for _, name, _, _ in _FORMATTER.parse(text)
+                         if name is not None}))
+
+class _Part(NamedTuple):
+    """a text part ready to be attached, its headers parsed & its payload transfer encoded (shared, never altered)"""
+    headers: tuple[tuple[str, BaseHeader], ...]
+    payload: str
+
+    @classmethod
+    def build(cls, content: str, subtype: str) -> '_Part':
+        part = MIMEPart(policy=default_policy)
+        part.set_content(content, subtype=subtype)
+        # a text part, its payload is the transfer encoded text
+        return cls(tuple(part.items()), str(part.get_payload()))
+
+    def apply(self, msg: MIMEPart):
+        # header objects of the policy are set as they are, no parsing
+        for name, value in self.headers:
+            msg[name] = value
+        msg.set_payload(self.payload)
+
+class _Component(NamedTuple):
+    # header name, or `plain`/`html` of a part
+    name: str
+    is_header: bool
+    source: str
+    fields: tuple[str, ...]
+    # the rendering of a component without fields, built once
+    static: 'Optional[BaseHeader | _Part]'
+    # fields rendered into the `html` part as they are
+    trusted: frozenset[str] = frozenset()
+
+    @classmethod
+    def compile(cls, name: str, is_header: bool, source: str, trusted: frozenset[str] = frozenset()) -> '_Component':
+        rtn = cls(name, is_header, source, _fields(source), None, trusted)
+        return rtn if rtn.fields else rtn._replace(static=rtn.render({}))
+
+    def render(self, values: Mapping[str, Any]) -> 'BaseHeader | _Part':
+        """Raises: ValueError, a header value with a line break (e.g. a field smuggling a header of its own in)"""
+        if self.is_header:
+            value = self.source.format_map(values)
+            # `EmailMessage` does not validate the header objects set as they are, the check of
+            # `EmailPolicy.header_store_parse` for a value given as str
+            if '\r' in value or '\n' in value:
+                raise ValueError(f'{self.name} header value may not contain linefeed or carriage return characters')
+            return default_policy.header_factory(self.name, value)
+        if self.name == 'html':
+            return _Part.build(_HtmlFormatter(self.trusted).vformat(self.source, (), values), self.name)
+        return _Part.build(self.source.format_map(values), self.name)
+
+def _message(headers: list[BaseHeader], parts: list[_Part]) -> EmailMessage:
+    rtn = EmailMessage()
+    for value in headers:
+        rtn[value.name] = value
+    rtn['Date'] = formatdate(localtime=True)
+    rtn['MIME-Version'] = _MIME_VERSION
+    if len(parts) == 1:
+        parts[0].apply(rtn)
+        return rtn
+    rtn['Content-Type'] = _ALTERNATIVE
+    for part in parts:
+        sub = EmailMessage(policy=default_policy)
+        part.apply(sub)
+        rtn.attach(sub)
+    return rtn
+
+class MailTemplate():
+    """
+    eMail template, compiled once per process.
+    - `subject`, `text`, `html` & the values of `headers` (From, Reply-To, ...) are `str.format` templates, `{full_name}`
+      is a field of the model (or mapping) rendered, `defaults` fill in the fields it does not have.
+    - the values of the fields are HTML escaped in `html`, but the `trusted` ones (markup of your own, never user
+      input). a header value with a line break is rejected (`ValueError`), as `EmailMessage` does.
+    - whatever has no `{field}` is built right here, the static headers parsed & the static parts transfer encoded.
+      the others are rendered by `TemplateRegistry.render`, each one out of the fields it has only.
+    - the eMail is `text` alone, or `multipart/alternative` of `text` & `html`. it is dated when rendered.
+    """
+
+    subject: str
+    text: str
+    html: Optional[str]
+    headers: dict[str, str]
+    defaults: dict[str, Any]
+    trusted: frozenset[str]
+    components: tuple[_Component, ...]
+
+    __slots__ = ['subject', 'text', 'html', 'headers', 'defaults', 'trusted', 'components']
+
+    def __init__(self, subject: str, text: str, html: Optional[str] = None, headers: Optional[Mapping[str, str]] = None,
+                 defaults: Optional[Mapping[str, Any]] = None, trusted: Iterable[str] = ()) -> None:
+        self.subject = subject
+        self.text = text
+        self.html = html
+        self.headers = dict(headers or {})
+        self.defaults = dict(defaults or {})
+        self.trusted = frozenset(trusted)
+        self.components = (
+            *(_Component.compile(name, True, value) for name, value in {'Subject': subject, **self.headers}.items()),
+            *(_Component.compile(subtype, False, content, self.trusted)
+              for content, subtype in ((text, 'plain'), (html, 'html')) if content is not None))
+
+    def __repr__(self) -> str:
+        return f'MailTemplate({self.subject!r}, html={self.html is not None}, headers={list(self.headers)})'
+
+class TemplateRegistry():
+    """
+    named `MailTemplate`s of a process along with an LRU cache of their renderings, see `TemplateConverter`.
+    - every header & part of a template is rendered once per distinct values of the fields it has, as long as it is
+      among the `maxsize` latest ones used. e.g. the body of a notification is rendered once per user, whatever the
+      To or the fields of the other headers. an eMail is a message of its own (fresh `Date`) out of the cached ones.
+    - `register` of a name in use reloads it, its cached renderings are dropped. thread safe, the converters run on
+      the thread pool of the conversion stage. a `process` pool has a registry per process, the templates are to be
+      registered at import of the converter module then.
+    """
+
+    maxsize: int
+    hits: int
+    misses: int
+    _m_templates: dict[str, MailTemplate]
+    _m_cache: 'OrderedDict[tuple[str, int, str], BaseHeader | _Part]'
+    _m_lock: threading.Lock
+
+    __slots__ = ['maxsize', 'hits', 'misses', '_m_templates', '_m_cache', '_m_lock']
+
+    def __init__(self, maxsize: int = 4096) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._m_templates = {}
+        self._m_cache = OrderedDict()
+        self._m_lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return (f'TemplateRegistry({list(self._m_templates)}, cached={len(self._m_cache)}/{self.maxsize}, '
+                f'hits={self.hits}, misses={self.misses})')
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._m_templates
+
+    def register(self, name: str, template: MailTemplate):
+        with self._m_lock:
+            self._m_templates[name] = template
+            self._invalidate(name)
+
+    def invalidate(self, name: Optional[str] = None):
+        """drop the cached renderings of the template `name`, of all of them if None"""
+        with self._m_lock:
+            self._invalidate(name)
+
+    def _invalidate(self, name: Optional[str]):
+        if name is None:
+            self._m_cache.clear()
+            return
+        for key in [x for x in self._m_cache if x[0] == name]:
+            del self._m_cache[key]
+
+    def _component(self, name: str, template: MailTemplate, idx: int, values: Mapping[str, Any]) -> 'BaseHeader | _Part':
+        component = template.components[idx]
+        if component.static is not None:
+            return component.static
+        key = (name, idx, json.dumps([values.get(x) for x in component.fields], default=str))
+        with self._m_lock:
+            if (rtn := self._m_cache.get(key)) is not None:
+                self._m_cache.move_to_end(key)
+                self.hits += 1
+                return rtn
+        rtn = component.render(values)
+        with self._m_lock:
+            self.misses += 1
+            # not cached if the template got reloaded meanwhile
+            if self.maxsize > 0 and self._m_templates.get(name) is template:
+                self._m_cache[key] = rtn
+                if len(self._m_cache) > self.maxsize:
+                    self._m_cache.popitem(last=False)
+        return rtn
+
+    def render(self, name: str, values: 'BaseModel | Mapping[str, Any]', **extra: Any) -> EmailMessage:
+        """
+        the eMail of the template `name` out of a pydantic model (its fields) or a mapping, `extra` fields on top.
+        Raises: KeyError, no such template or a field missing. ValueError, a header value with a line break
+        """
+        template = self._m_templates[name]
+        if hasattr(values, 'model_dump'):
+            values = values.model_dump()
+        values = {**template.defaults, **values, **extra}
+        headers: list[BaseHeader] = []
+        parts: list[_Part] = []
+        for idx in range(len(template.components)):
+            rendered = self._component(name, template, idx, values)
+            if isinstance(rendered, _Part):
+                parts.append(rendered)
+            else:
+                headers.append(rendered)
+        return _message(headers, parts)
+
+# templates of this process
+template_registry = TemplateRegistry()
+
+class TemplateConverter():
+    """
+    channel converter rendering the template `template` of `template_registry` out of the request validated into
+    the pydantic `model`, e.g. `register_email_channel('email.notify.welcome', TemplateConverter('welcome', Welcome))`.
+    picklable, as long as `model` is a module level class.
+    """
+
+    template: str
+    model: type['BaseModel']
+
+    __slots__ = ['template', 'model']
+
+    def __init__(self, template: str, model: type['BaseModel']) -> None:
+        self.template = template
+        self.model = model
+
+    def __repr__(self) -> str:
+        return f'TemplateConverter({self.template!r}, {self.model.__name__})'
+
+    def __call__(self, data: bytes | bytearray) -> EmailMessage:
+        return template_registry.render(self.template, decode_model(self.model, data))
@@ -3,7 +3,9 @@
 # SPDX-License-Identifier: MIT
 
 import queue
-from typing import Optional
+import threading
+import time
+from typing import Any, Optional
 
 import picologging as logging
 from picologging.handlers import QueueHandler, QueueListener
@@ -12,8 +14,78 @@ from picologging.handlers import QueueHandler, QueueListener
 # import logging
 # from logging.handlers import QueueHandler, QueueListener
 
+# batches of log records the worker processes may have on the way to the parent, see `BatchQueueHandler`
+LOG_QUEUE_SIZE = 1024
+
+class BatchQueueHandler(QueueHandler):
+    """
+    worker side of the log transport, instead of a pickled `LogRecord` per record (over a Manager proxy).
+    - records are formatted right here (below the logger level they are not even created), only
+      `(levelno, name, message)` tuples cross the process boundary, in batches of up to `batch` records
+    - a batch is sent once full, at WARNING & above or `interval` seconds after its first record
+    - the queue is bounded (a `multiprocessing.Queue`), a batch that does not fit is dropped instead of blocking
+      the worker, the next batch reports the number of records dropped
+    """
+
+    def __init__(self, que: Any, batch: int = 64, interval: float = 0.2) -> None:
+        super().__init__(que)
+        self.dropped = 0
+        self._m_batch = batch
+        self._m_interval = interval
+        self._m_pending: list[tuple[int, str, str]] = []
+        self._m_lock = threading.Lock()
+        self._m_wakeup = threading.Event()
+        # NOTE: the flusher never calls into picologging, it only hands the pending batch over to the queue
+        threading.Thread(target=self._flusher, name='log-flusher', daemon=True).start()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            item = (record.levelno, record.name, self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        with self._m_lock:
+            self._m_pending.append(item)
+            if len(self._m_pending) >= self._m_batch or record.levelno >= logging.WARNING:
+                self._flush()
+            else:
+                self._m_wakeup.set()
+
+    def flush(self):
+        with self._m_lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._m_pending:
+            return
+        batch, self._m_pending = self._m_pending, []
+        note = [(logging.WARNING, __name__, f'{self.dropped} log record(s) dropped, log queue full')] if self.dropped else []
+        try:
+            self.queue.put_nowait(note + batch)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += len(batch)
+
+    def _flusher(self):
+        while True:
+            self._m_wakeup.wait()
+            self._m_wakeup.clear()
+            time.sleep(self._m_interval)
+            self.flush()
+
+class BatchQueueListener(QueueListener):
+    """parent side of the log transport, hands the records of the `BatchQueueHandler` batches over to the handlers."""
+
+    def handle(self, record: Any):
+        for levelno, name, message in record:
+            super().handle(logging.LogRecord(name, levelno, '', 0, message, (), None))
+
+    def enqueue_sentinel(self):
+        # the queue is bounded, wait for the room
+        self.queue.put(self._sentinel, timeout=5)
+
 ILogger = logging.Logger
-IQueueListener = QueueListener
+IQueueListener = BatchQueueListener
 
 class ColorFormatter(logging.Formatter):
     def format(self, record:logging.LogRecord) -> str:
@@ -37,8 +109,10 @@ def utils_get_logger(name:str, que:Optional[queue.Queue]=None, level:int=logging
         # print('Logger already configured:', name, logger.handlers)
         return logger
 
+    _h: logging.Handler
     if que := que:
-        _h = QueueHandler(que)
+        _h = BatchQueueHandler(que)
+        _h.setLevel(level)
     else:
         _h = logging.StreamHandler()
     # https://docs.python.org/3.13/library/logging.html#logrecord-attributes
@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+headless eMail worker, serves the channels of one `SrvcEmail` without the web app, e.g. as a container or systemd unit
+scaled apart from it. the SMTP settings come from the usual `SMTP_*` environment variables.
+
+    email-service-worker --redis cache.local:6379 \\
+        --channel email.notify.welcome=myapp.mails:gen_email_welcome \\
+        --channel 'email.notify.login_access=myapp.mails:gen_email_login_access?priority=1' \\
+        --channel 'email.file.upload=myapp.mails:gen_email_file_upload?transport=stream&dedup=1'
+
+- `--channel NAME=MODULE:CONVERTER[?OPTIONS]`, the options are the ones of `SrvcEmail.register_email_channel`
+  (`transport`, `max_attempts`, `priority`, `weight`, `dedup`, `fanout`) as a URL query string
+- `--workers 1` (default) runs the worker right in this process, so that it starts with one import of the service &
+  the converter modules and nothing else (no supervisor, no log queue). more run under a `WorkerSupervisor`.
+"""
+
+import argparse
+import importlib
+import os
+import socket
+import sys
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl
+
+# pylint: disable=import-outside-toplevel
+# the service (confz, pydantic, redis, ...) is imported once the arguments are fine, `--help` & usage errors stay quick
+
+_LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+def load_converter(spec: str) -> Callable[..., Any]:
+    """`package.module:function` (or `:Class.method`) to the converter it names"""
+    module, _, qualname = spec.partition(':')
+    if not module or not qualname:
+        raise ValueError(f'{spec!r} is not a MODULE:CONVERTER reference')
+    rtn: Any = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        rtn = getattr(rtn, attr)
+    if not callable(rtn):
+        raise ValueError(f'{spec!r} is not callable')
+    return rtn
+
+def parse_channel(value: str) -> tuple[str, str, dict[str, str]]:
+    """`NAME=MODULE:CONVERTER[?OPTIONS]` to its name, converter reference & `register_email_channel` options"""
+    name, sep, rest = value.partition('=')
+    if not sep or not name or not rest:
+        raise argparse.ArgumentTypeError(f'{value!r} is not NAME=MODULE:CONVERTER[?OPTIONS]')
+    spec, _, query = rest.partition('?')
+    options = dict(parse_qsl(query, strict_parsing=bool(query)))
+    unknown = set(options) - {'transport', 'max_attempts', 'priority', 'weight', 'dedup', 'fanout'}
+    if unknown:
+        raise argparse.ArgumentTypeError(f'unknown channel option(s) {sorted(unknown)} of {name!r}')
+    return name, spec, options
+
+def _channel_kwargs(options: dict[str, str]) -> dict[str, Any]:
+    from .streams import ETransport
+
+    rtn: dict[str, Any] = {}
+    if 'transport' in options:
+        rtn['transport'] = ETransport(options['transport'].lower())
+    for key in ('max_attempts', 'priority', 'weight'):
+        if key in options:
+            rtn[key] = int(options[key])
+    for key in ('dedup', 'fanout'):
+        if key in options:
+            rtn[key] = options[key].lower() in ('1', 'true', 'yes', 'on')
+    return rtn
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='email-service-worker', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis', default=os.getenv('EMAIL_SERVICE_REDIS', 'localhost:6379'),
+                        help='host[:port] of the Redis/Dragonfly server '
+                             '(default: $EMAIL_SERVICE_REDIS or localhost:6379)')
+    parser.add_argument('--channel', dest='channels', type=parse_channel, action='append', required=True,
+                        metavar='NAME=MODULE:CONVERTER[?OPTIONS]', help='channel to serve, repeat for more')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes (default: 1, in this process)')
+    parser.add_argument('--name', default=None,
+                        help='name of the worker (Redis Streams consumer, metrics & spool directory) of --workers 1, '
+                             'keep it stable over restarts (default: <hostname>:<pid>, its spool is taken over by the '
+                             'next worker starting)')
+    parser.add_argument('--log-level', default='INFO', type=str.upper, choices=_LOG_LEVELS)
+    parser.add_argument('--start-method', default=None, help='multiprocessing start method of --workers > 1')
+    return parser
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    # converters of the current directory, as with `python -m`
+    if '' not in sys.path and os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+
+    from .email_service import SrvcEmail
+    from .utils import logging
+
+    host, _, port = args.redis.partition(':')
+    obj = SrvcEmail(host, workers=max(1, args.workers), memdb_port=int(port or 6379))
+    try:
+        for name, spec, options in args.channels:
+            obj.register_email_channel(name, load_converter(spec), **_channel_kwargs(options))
+    except (ImportError, AttributeError, ValueError) as excp:
+        print(f'email-service-worker: error: {excp}', file=sys.stderr)
+        return 2
+
+    log_level = getattr(logging, args.log_level)
+    if args.workers <= 1:
+        # returns once SIGINT/SIGTERM closed the worker down (in-flight eMails drained)
+        obj.entry(None, log_level, args.name or f'{socket.gethostname()}:{os.getpid()}')
+        return 0
+
+    import asyncio
+    import signal
+
+    async def supervise():
+        await SrvcEmail.run(log_level, args.start_method)
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        await stop.wait()
+        await SrvcEmail.stop()
+
+    asyncio.run(supervise())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# the nicegui demo app serves at import, it is run by hand (`python tests/test_email_nicegui.py`)
+collect_ignore = ['test_email_nicegui.py']
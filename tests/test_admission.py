@@ -0,0 +1,104 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+import json
+import time
+
+import pytest
+
+from email_service_nicegui.admission import AdmissionPolicy, AdmissionRejected, EAdmission
+from email_service_nicegui.backlog import KEY_BACKLOG, Backlog
+from email_service_nicegui.client import EmailClient
+from email_service_nicegui.retry import RetryEntry, RetryQueue
+
+
+def test_decide_within_the_limits():
+    policy = AdmissionPolicy(max_depth=100, max_wait=60)
+    for backlog in (Backlog(), Backlog(99, 10, 1), Backlog(99, 0, 1)):
+        assert policy.decide('bulk', backlog).action == EAdmission.ACCEPT
+    # no limit at all
+    assert AdmissionPolicy().decide('bulk', Backlog(10 ** 6, 1, 1)).action == EAdmission.ACCEPT
+
+def test_decide_over_depth_or_wait():
+    policy = AdmissionPolicy(max_depth=100, max_wait=60)
+    # 60s to drain, short of 100 requests
+    for backlog in (Backlog(100, 0, 1), Backlog(60, 1, 1)):
+        rtn = policy.decide('bulk', backlog)
+        assert (rtn.action, rtn.channel, rtn.delay, rtn.backlog) == (EAdmission.REJECT, 'bulk', 0, backlog)
+
+def test_decide_defer_delay():
+    policy = AdmissionPolicy(max_depth=10, action=EAdmission.DEFER, max_defer=300)
+    assert policy.decide('bulk', Backlog(100, 2, 1)).delay == 50
+    # capped, at least a second, the longest while the rate is not known
+    assert policy.decide('bulk', Backlog(10000, 2, 1)).delay == 300
+    assert policy.decide('bulk', Backlog(10, 100, 1)).delay == 1
+    assert policy.decide('bulk', Backlog(10, 0, 1)).delay == 300
+
+def test_decide_downgrade():
+    backlog = Backlog(10, 1, 1)
+    rtn = AdmissionPolicy(max_depth=10, action=EAdmission.DOWNGRADE, downgrade_to='digest').decide('bulk', backlog)
+    assert (rtn.action, rtn.channel) == (EAdmission.DOWNGRADE, 'digest')
+    # nowhere to downgrade to
+    assert AdmissionPolicy(max_depth=10, action=EAdmission.DOWNGRADE).decide('bulk', backlog).action == EAdmission.REJECT
+
+async def _report(redis, channel: str, depth: int, rate: float):
+    await redis.hset(KEY_BACKLOG.format(channel), 'w1', json.dumps({'depth': depth, 'rate': rate, 'ts': time.time(),
+                                                                   'interval': 1}))
+
+def _client(redis, policy: AdmissionPolicy) -> EmailClient:
+    return EmailClient(redis=redis, streams=['bulk', 'digest'], admission={'bulk': policy}, admission_ttl=60)
+
+def test_client_rejects_once_over():
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        client = _client(redis, AdmissionPolicy(max_depth=5))
+        await _report(redis, 'bulk', 2, 10)
+        # at least the entries of the stream, then the ones sent since the backlog was read
+        for _ in range(4):
+            await redis.xadd('bulk', {'data': b'queued'})
+        assert isinstance(await client.send('bulk', {'to': 'a@test.com'}), bytes)
+        with pytest.raises(AdmissionRejected) as excp:
+            await client.send('bulk', {'to': 'b@test.com'})
+        assert excp.value.channel == 'bulk' and excp.value.backlog.depth == 5
+        rtn = await client.send_many([('bulk', {'to': 'c@test.com'}), ('digest', {'to': 'd@test.com'})])
+        assert isinstance(rtn[0], AdmissionRejected) and isinstance(rtn[1], bytes)
+        assert (await redis.xlen('bulk'), await redis.xlen('digest')) == (5, 1)
+
+    asyncio.run(main())
+
+def test_client_defers_to_the_retry_queue():
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        client = _client(redis, AdmissionPolicy(max_depth=10, action=EAdmission.DEFER))
+        await _report(redis, 'bulk', 40, 2)
+        started = time.time()
+        assert await client.send('bulk', {'to': 'a@test.com'}) == 0
+        assert await redis.xlen('bulk') == 0
+        ((raw, due),) = await redis.zrange(RetryQueue.KEY_RETRY.format('bulk'), 0, -1, withscores=True)
+        entry = RetryEntry.decode(raw)
+        # not an attempt, due once the 40 requests are sent at 2/s
+        assert (entry.channel, entry.attempt) == ('bulk', 0) and b'a@test.com' in entry.data
+        assert started + 20 <= due <= time.time() + 20
+
+    asyncio.run(main())
+
+def test_client_downgrades():
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        client = _client(redis, AdmissionPolicy(max_wait=30, action=EAdmission.DOWNGRADE, downgrade_to='digest'))
+        await _report(redis, 'bulk', 100, 1)
+        assert isinstance(await client.send('bulk', {'to': 'a@test.com'}), bytes)
+        assert (await redis.xlen('bulk'), await redis.xlen('digest')) == (0, 1)
+        assert (await client.admit('digest')).action == EAdmission.ACCEPT
+
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+
+import pytest
+from pydantic import BaseModel
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from email_service_nicegui.client import EmailClient  # pylint: disable=wrong-import-position
+from email_service_nicegui.codec import BINARY_MAGIC, decode_model, decode_payload  # pylint: disable=wrong-import-position
+
+
+class Welcome(BaseModel):
+    to: str
+    name: str
+
+def test_send_many_in_one_round_trip():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        client = EmailClient(redis=redis, streams=['email.upload'], stream_maxlen=1000)
+        subscription = redis.pubsub()
+        await subscription.subscribe('email.welcome')
+        await subscription.get_message(timeout=1)
+        executed = []
+        pipeline = redis.pipeline
+
+        def spy(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+            async def counted(*args, **kwargs):
+                executed.append(len(pipe.command_stack))
+                return await execute(*args, **kwargs)
+            pipe.execute = counted
+            return pipe
+
+        redis.pipeline = spy
+        rtn = await client.send_many([('email.welcome', Welcome(to='a@test.com', name='A')),
+                                      ('email.upload', {'to': 'b@test.com'}), ('email.welcome', b'raw')])
+        assert executed == [3]
+        # subscribers of the published ones, the entry id of the stream one
+        assert rtn[0] == rtn[2] == 1 and isinstance(rtn[1], bytes)
+        ((_, fields),) = await redis.xrange('email.upload')
+        assert decode_payload(fields[b'data']) == {'to': 'b@test.com'}
+        first = await subscription.get_message(timeout=1)
+        assert decode_model(Welcome, first['data']) == Welcome(to='a@test.com', name='A')
+        assert (await subscription.get_message(timeout=1))['data'] == b'raw'
+        await subscription.aclose()
+        await client.aclose()
+
+    asyncio.run(main())
+
+def test_binary_payload():
+    pytest.importorskip('msgpack')
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        client = EmailClient(redis=redis, streams=['email.upload'], binary=True)
+        await client.send('email.upload', Welcome(to='a@test.com', name='A'))
+        ((_, fields),) = await redis.xrange('email.upload')
+        assert fields[b'data'][:1] == BINARY_MAGIC
+        assert decode_model(Welcome, fields[b'data']) == Welcome(to='a@test.com', name='A')
+        # sent as is
+        await client.send('email.upload', '{"to": "b@test.com"}')
+        assert (await redis.xrange('email.upload'))[1][1][b'data'] == b'{"to": "b@test.com"}'
+
+    asyncio.run(main())
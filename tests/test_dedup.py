@@ -0,0 +1,63 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from email_service_nicegui.config import ConfigSMTP  # pylint: disable=wrong-import-position
+from email_service_nicegui.dedup import IdempotencyGuard  # pylint: disable=wrong-import-position
+from email_service_nicegui.utils import logging  # pylint: disable=wrong-import-position
+
+
+def _guard(redis) -> IdempotencyGuard:
+    config = ConfigSMTP(host='localhost', from_email='hello@test.com', username='', password='',
+                        dedup_bloom_bits=1 << 16)
+    return IdempotencyGuard(redis, config, logging.getLogger('test_dedup'))
+
+def _mirrored(guard: IdempotencyGuard, key: str) -> bool:
+    gen = guard._generation()  # pylint: disable=protected-access
+    return key in guard._bloom('ch', gen)  # pylint: disable=protected-access
+
+def test_sync_fetches_the_new_keys_only():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        sender, other = _guard(redis), _guard(redis)
+        sender.record('ch', 'a')
+        await sender.flush()
+        await other.sync(['ch'])
+        assert _mirrored(other, 'a') and not _mirrored(other, 'b')
+        # the bitmap is not fetched again, the keys recorded since come from the list
+        await redis.delete(IdempotencyGuard.KEY_BLOOM.format('ch', other._generation()))  # pylint: disable=protected-access
+        sender.record('ch', 'b')
+        await sender.flush()
+        await other.sync(['ch'])
+        assert _mirrored(other, 'a') and _mirrored(other, 'b')
+        assert await other.seen('ch', 'b') and not await other.seen('ch', 'c')
+
+    asyncio.run(main())
+
+def test_sync_again_once_the_list_is_gone():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        sender, other = _guard(redis), _guard(redis)
+        gen = sender._generation()  # pylint: disable=protected-access
+        for key in ('a', 'b'):
+            sender.record('ch', key)
+        await sender.flush()
+        await other.sync(['ch'])
+        await redis.delete(IdempotencyGuard.KEY_LOG.format('ch', gen))
+        sender.record('ch', 'c')
+        await sender.flush()
+        # shorter than synced, the whole bitmap is fetched by the next sync
+        await other.sync(['ch'])
+        assert not _mirrored(other, 'c')
+        await other.sync(['ch'])
+        assert all(_mirrored(other, x) for x in 'abc')
+
+    asyncio.run(main())
@@ -6,7 +6,6 @@
 
 import nicegui.events
 from nicegui import app, ui
-from redis.asyncio import Redis
 
 # import test_email_redis_common
 from test_email_redis_common import (
@@ -19,9 +18,10 @@ from test_email_redis_common import (
     gen_email_welcome,
 )
 
-from email_service_nicegui import SrvcEmail
+from email_service_nicegui import EmailClient, SrvcEmail
 
 REDIS_HOST = 'cache.local'
+email_client = EmailClient(REDIS_HOST)
 
 with SrvcEmail(REDIS_HOST) as obj_tmp:
     obj_tmp.register_email_channel(EEmailChannel.WELCOME, gen_email_welcome)
@@ -31,32 +31,37 @@ with SrvcEmail(REDIS_HOST) as obj_tmp:
 
 app.on_startup(SrvcEmail.run)
 app.on_shutdown(SrvcEmail.stop)
+app.on_shutdown(email_client.aclose)
 
 inpEmail = ui.input('Email:', value='someone@test.co').props('type="email"')
 inpFullName = ui.input('Full Name:', value='Crazy Doe')
 
 async def on_click_welcome():
-    rconn = Redis(host=REDIS_HOST)
-    msg = EmailWelcome(to=inpEmail.value, full_name=inpFullName.value, password='olQHWVrH$8').model_dump_json()
-    rslt = await rconn.publish(EEmailChannel.WELCOME, msg)
+    msg = EmailWelcome(to=inpEmail.value, full_name=inpFullName.value, password='olQHWVrH$8')
+    rslt = await email_client.send(EEmailChannel.WELCOME, msg)
     print('email sent:', rslt)
 
 async def on_click_login(e: nicegui.events.ClickEventArguments):
-    rconn = Redis(host=REDIS_HOST)
     ip = e.client.ip or 'unknown-ip'
-    msg = EmailLoginAccess(to=inpEmail.value, full_name=inpFullName.value, ip_address=ip, is_access_granted=True).model_dump_json()
-    rslt = await rconn.publish(EEmailChannel.LOGIN_ACCESS, msg)
+    msg = EmailLoginAccess(to=inpEmail.value, full_name=inpFullName.value, ip_address=ip, is_access_granted=True)
+    rslt = await email_client.send(EEmailChannel.LOGIN_ACCESS, msg)
     print('email sent:', rslt)
 
 async def on_click_removal():
-    rconn = Redis(host=REDIS_HOST)
-    msg = EmailAccountRemoval(to=inpEmail.value, full_name=inpFullName.value).model_dump_json()
-    rslt = await rconn.publish(EEmailChannel.ACCOUNT_REMOVAL, msg)
+    msg = EmailAccountRemoval(to=inpEmail.value, full_name=inpFullName.value)
+    rslt = await email_client.send(EEmailChannel.ACCOUNT_REMOVAL, msg)
     print('email sent:', rslt)
 
+async def on_click_bulk():
+    msgs = [(EEmailChannel.WELCOME, EmailWelcome(to=f'user{x}@test.co', full_name=f'User {x}', password='olQHWVrH$8'))
+            for x in range(100)]
+    rslt = await email_client.send_many(msgs)
+    print('emails sent:', len(rslt))
+
 with ui.grid(rows=2, columns=4):
     ui.button('Welcome e-Mail', on_click=on_click_welcome)
     ui.button('Login e-Mail', on_click=on_click_login)
     ui.button('Account Removal e-Mail', on_click=on_click_removal)
+    ui.button('100 Welcome e-Mails', on_click=on_click_bulk)
 
 ui.run(host='localhost', show=False, uvicorn_logging_level='info')
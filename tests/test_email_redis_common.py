@@ -3,7 +3,6 @@
 # SPDX-License-Identifier: MIT
 
 import os
-import time
 
 # pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
 from email.message import EmailMessage
@@ -12,6 +11,8 @@ from typing import List
 
 from pydantic import BaseModel
 
+from email_service_nicegui import MailTemplate, TemplateConverter, decode_model, template_registry
+
 
 class EmailWelcome(BaseModel):
     to: str
@@ -35,48 +36,38 @@ class EEmailChannel(StrEnum):
 
 FROM_EMAIL = os.getenv('SMTP_FROM_EMAIL', 'hello@test.com')
 SERVICE_NAME = os.getenv('SERVICE_NAME', 'FileServer')
-EMAIL_FOOTER = f'\n\n~~ {SERVICE_NAME} Admin ~~\nAn auto-generated email @ {time.strftime('%Y-%m-%d %H:%M:%S +%Z')}\nplease do not reply.'
+# the time of sending is in the Date header of every eMail, the footer stays the same so the bodies can be cached
+EMAIL_FOOTER = '\n\n~~ {service_name} Admin ~~\nAn auto-generated email, please do not reply.'
+EMAIL_HEADERS = {'From': FROM_EMAIL, 'To': '{to}'}
+EMAIL_DEFAULTS = {'service_name': SERVICE_NAME}
 
-def gen_email_welcome(val: bytes | bytearray) -> EmailMessage:
-    msg = EmailWelcome.model_validate_json(val)
-    rtn = EmailMessage()
-    rtn['Subject'] = f'Welcome to {SERVICE_NAME}! [do not reply]'
-    rtn['From'] = FROM_EMAIL
-    rtn['To'] = msg.to
-    rtn.set_content(f'''\
-Hi {msg.full_name},
+template_registry.register('welcome', MailTemplate('Welcome to {service_name}! [do not reply]', '''\
+Hi {full_name},
 
-Welcome to FileServer!
+Welcome to {service_name}!
 
-We are pleased to have you as a member of our FileServer, A file sharing/collaboration platform
+We are pleased to have you as a member of our {service_name}, A file sharing/collaboration platform
 
 your initial login password set as below, please change it after login:
 
-{msg.password}''' + EMAIL_FOOTER)
-    return rtn
+{password}''' + EMAIL_FOOTER, headers=EMAIL_HEADERS, defaults=EMAIL_DEFAULTS))
+
+template_registry.register('login_access', MailTemplate('{service_name} Login Access Notification [do not reply]', '''\
+Hi {full_name},
+
+IP Address: {ip_address}
+
+Your recent login attempt {outcome}.''' + EMAIL_FOOTER, headers=EMAIL_HEADERS, defaults=EMAIL_DEFAULTS))
+
+template_registry.register('account_removal', MailTemplate('{service_name} Account Removal Notification [do not reply]', '''\
+Hi {full_name},
+
+Your account has been removed from {service_name} by Admin, for further details please contact Administrator.''' + EMAIL_FOOTER,
+    headers=EMAIL_HEADERS, defaults=EMAIL_DEFAULTS))
+
+gen_email_welcome = TemplateConverter('welcome', EmailWelcome)
+gen_email_account_removal = TemplateConverter('account_removal', EmailAccountRemoval)
 
 def gen_email_login_access(val: bytes | bytearray) -> EmailMessage:
-    msg = EmailLoginAccess.model_validate_json(val)
-    rtn = EmailMessage()
-    rtn['Subject'] = f'{SERVICE_NAME} Login Access Notification [do not reply]'
-    rtn['From'] = FROM_EMAIL
-    rtn['To'] = msg.to
-    rtn.set_content(f'''\
-Hi {msg.full_name},
-
-IP Address: {msg.ip_address}
-
-Your recent login attempt {'was successful' if msg.is_access_granted else 'failed'}.''' + EMAIL_FOOTER)
-    return rtn
-
-def gen_email_account_removal(val: bytes | bytearray) -> EmailMessage:
-    msg = EmailAccountRemoval.model_validate_json(val)
-    rtn = EmailMessage()
-    rtn['Subject'] = f'{SERVICE_NAME} Account Removal Notification [do not reply]'
-    rtn['From'] = FROM_EMAIL
-    rtn['To'] = msg.to
-    rtn.set_content(f'''\
-Hi {msg.full_name},
-
-Your account has been removed from {SERVICE_NAME} by Admin, for further details please contact Administrator.''' + EMAIL_FOOTER)
-    return rtn
+    msg = decode_model(EmailLoginAccess, val)
+    return template_registry.render('login_access', msg, outcome='was successful' if msg.is_access_granted else 'failed')
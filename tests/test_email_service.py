@@ -0,0 +1,215 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+import logging
+import signal
+import socket
+import time
+from email.message import EmailMessage
+
+import pytest
+
+from email_service_nicegui.config import ConfigSMTP
+from email_service_nicegui.email_service import CLOSURE_GRACE, SrvcEmail, stop_timeout
+from email_service_nicegui.streams import ETransport
+from email_service_nicegui.utils import utils_get_logger
+
+
+def _closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _conv(data: bytes | bytearray) -> EmailMessage:
+    rtn = EmailMessage()
+    rtn['To'] = data.decode()
+    return rtn
+
+def _sink(delay: float = 0) -> tuple[object, list[str]]:
+    # SMTP server on a thread of its own, the recipients of the eMails it accepted
+    controller = pytest.importorskip('aiosmtpd.controller')
+    received: list[str] = []
+
+    class Handler:
+        async def handle_DATA(self, server, session, envelope):
+            await asyncio.sleep(delay)
+            received.extend(envelope.rcpt_tos)
+            return '250 OK'
+
+    sink = controller.Controller(Handler(), hostname='127.0.0.1', port=_closed_port())
+    sink.start()
+    return sink, received
+
+def _worker(monkeypatch, redis, port: int, **config) -> SrvcEmail:
+    # `entry` without the process around it, on the loop of the test
+    monkeypatch.setattr(SrvcEmail, 'logger', utils_get_logger('test_email_service'), raising=False)
+    obj = SrvcEmail('127.0.0.1')
+    obj._m_config = ConfigSMTP(host='127.0.0.1', port=port, from_email='hello@test.com', username='', password='',
+                               drain_timeout=1, **config)
+    obj.m_worker = 'w1'
+    obj.m_redis = redis
+    obj.m_subscriptions = {}
+    return obj
+
+async def _publish(redis, transport: ETransport, ch_name: str, *requests: str):
+    # in one transaction, a stream reader gets them in one batch
+    async with redis.pipeline() as pipe:
+        for data in requests:
+            if transport == ETransport.STREAM:
+                pipe.xadd(ch_name, {'data': data})
+            else:
+                pipe.publish(ch_name, data)
+        await pipe.execute()
+
+async def _until(predicate, timeout: float) -> float:
+    started = time.monotonic()
+    while not predicate():
+        assert time.monotonic() - started < timeout
+        await asyncio.sleep(0.01)
+    return time.monotonic() - started
+
+@pytest.fixture(autouse=True)
+def _signals():
+    # `entry` maps SIGINT & SIGTERM to sys.exit once done
+    handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+    yield
+    for sig, handler in handlers.items():
+        signal.signal(sig, handler)
+
+def test_entry_exits_non_zero_when_unreachable(monkeypatch):
+    for name, value in {'HOST': '127.0.0.1', 'PORT': str(_closed_port()), 'FROM_EMAIL': 'hello@test.com', 'USERNAME': '',
+                        'PASSWORD': ''}.items():
+        monkeypatch.setenv(f'SMTP_{name}', value)
+    obj = SrvcEmail('127.0.0.1', memdb_port=_closed_port())
+    obj.register_email_channel('email.test', _conv)
+    with pytest.raises(SystemExit) as excp:
+        obj.entry(None, logging.CRITICAL, 'w1')
+    # restarted by the supervisor
+    assert excp.value.code == 1
+
+def test_entry_returns_on_invalid_settings(monkeypatch):
+    monkeypatch.delenv('SMTP_HOST', raising=False)
+    obj = SrvcEmail('127.0.0.1', memdb_port=_closed_port())
+    obj.register_email_channel('email.test', _conv)
+    # not restarted, a restart does not fix the settings
+    obj.entry(None, logging.CRITICAL, 'w1')
+
+def test_closure_closes_the_redis_connections():
+    fakeredis = pytest.importorskip('fakeredis')
+    closed = []
+
+    async def main():
+        obj = SrvcEmail('127.0.0.1', memdb_port=_closed_port())
+        obj._m_config = ConfigSMTP(host='localhost', from_email='hello@test.com', username='', password='')
+        obj.m_redis = fakeredis.FakeAsyncRedis()
+        obj.m_subscriptions = {ch_name: obj.m_redis.pubsub() for ch_name in ('email.a', 'email.b')}
+        for ch_name, subscription in obj.m_subscriptions.items():
+            await subscription.subscribe(ch_name)
+        for client in (*obj.m_subscriptions.values(), obj.m_redis):
+            aclose = client.aclose
+            async def spy(aclose=aclose, client=client):
+                closed.append(client)
+                await aclose()
+            client.aclose = spy
+        await obj.do_force_closure()
+        assert closed == [*obj.m_subscriptions.values(), obj.m_redis]
+        assert all(x.connection is None for x in obj.m_subscriptions.values())
+
+    asyncio.run(main())
+
+def test_stop_timeout_covers_the_drain(monkeypatch):
+    for name, value in {'HOST': '127.0.0.1', 'FROM_EMAIL': 'hello@test.com', 'USERNAME': '', 'PASSWORD': '',
+                        'DRAIN_TIMEOUT': '45'}.items():
+        monkeypatch.setenv(f'SMTP_{name}', value)
+    assert stop_timeout() == 45 + CLOSURE_GRACE
+    monkeypatch.delenv('SMTP_HOST')
+    assert stop_timeout() == ConfigSMTP.model_fields['drain_timeout'].default + CLOSURE_GRACE
+
+def test_closure_drains_within_the_drain_timeout():
+    timeouts = []
+
+    class Stage:
+        def __init__(self, took: float) -> None:
+            self.took = took
+
+        async def stop(self, timeout: float):
+            timeouts.append(timeout)
+            await asyncio.sleep(min(self.took, timeout))
+
+    async def main():
+        obj = SrvcEmail('127.0.0.1', memdb_port=_closed_port())
+        obj._m_config = ConfigSMTP(host='localhost', from_email='hello@test.com', username='', password='', drain_timeout=0.5)
+        obj.m_convert, obj.m_delivery = Stage(0.3), Stage(1)
+        started = time.monotonic()
+        await obj.do_force_closure()
+        assert time.monotonic() - started < 0.7
+        assert timeouts[0] == 0.5 and timeouts[1] < 0.25
+
+    asyncio.run(main())
+
+@pytest.mark.parametrize('transport', [ETransport.PUBSUB, ETransport.STREAM])
+def test_priority_request_passes_a_saturated_channel(monkeypatch, transport):
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    sink, received = _sink(delay=0.05)
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        obj = _worker(monkeypatch, redis, sink.port, concurrency=1, pool_max=1, queue_size=2, convert_queue_size=2,
+                      convert_executor='inline', stream_block_ms=50)
+        obj.register_email_channel('bulk', _conv, transport)
+        obj.register_email_channel('login', _conv, transport, priority=1)
+        work = asyncio.ensure_future(obj._do_work())
+        try:
+            await asyncio.sleep(0.3)
+            await _publish(redis, transport, 'bulk', *(f'bulk{x}@test.com' for x in range(60)))
+            # the bulk channel is full up to its reader
+            await _until(lambda: obj.m_convert.qsize('bulk') == 2, 5)
+            await _publish(redis, transport, 'login', 'login@test.com')
+            await _until(lambda: 'login@test.com' in received, 1)
+            assert len(received) < 30
+        finally:
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+
+    try:
+        asyncio.run(main())
+    finally:
+        sink.stop()
+
+def test_slow_converter_holds_up_its_own_channel_only(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    sink, received = _sink()
+
+    def slow(data: bytes | bytearray) -> EmailMessage:
+        time.sleep(0.2)
+        return _conv(data)
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        obj = _worker(monkeypatch, redis, sink.port, convert_queue_size=2, convert_workers=1, convert_executor='thread')
+        obj.register_email_channel('slow', slow)
+        obj.register_email_channel('fast', _conv)
+        work = asyncio.ensure_future(obj._do_work())
+        try:
+            await asyncio.sleep(0.3)
+            for x in range(20):
+                await redis.publish('slow', f'slow{x}@test.com')
+            await _until(lambda: obj.m_convert.qsize('slow') == 2, 5)
+            for x in range(5):
+                await redis.publish('fast', f'fast{x}@test.com')
+            await _until(lambda: sum(x.startswith('fast') for x in received) == 5, 1)
+            assert sum(x.startswith('slow') for x in received) < 10
+        finally:
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+
+    try:
+        asyncio.run(main())
+    finally:
+        sink.stop()
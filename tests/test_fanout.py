@@ -0,0 +1,122 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+from email.message import EmailMessage
+
+import pytest
+
+from email_service_nicegui import fanout
+from email_service_nicegui.config import ConfigSMTP
+from email_service_nicegui.email_service import SrvcEmail
+from email_service_nicegui.fanout import FanoutRecipient, FanoutRenderer, FanoutRequest
+from email_service_nicegui.metrics import Metrics
+from email_service_nicegui.pipeline import ConvertJob
+from email_service_nicegui.retry import RetryEntry, RetryQueue
+from email_service_nicegui.utils import logging
+
+
+def _email() -> EmailMessage:
+    rtn = EmailMessage()
+    rtn['Subject'] = 'News for $name'
+    rtn['To'] = 'someone@test.com'
+    rtn.set_content('Hi $name\n$footer\n')
+    rtn.add_alternative('<p>Hi $name</p>$footer\n', subtype='html')
+    return rtn
+
+def test_personal_html_escaped_but_trusted():
+    renderer = FanoutRenderer(_email(), trusted=('footer',))
+    rcpt = FanoutRecipient('pat@test.com', {'name': '<a href="https://evil.example">Pat</a>', 'footer': '<i>bye</i>'})
+    email = renderer.personal(rcpt)
+    text, html = (x.get_content() for x in email.iter_parts())
+    assert email['To'] == 'pat@test.com'
+    assert email['Subject'] == 'News for <a href="https://evil.example">Pat</a>'
+    assert text == 'Hi <a href="https://evil.example">Pat</a>\n<i>bye</i>\n'
+    assert html == '<p>Hi &lt;a href=&quot;https://evil.example&quot;&gt;Pat&lt;/a&gt;</p><i>bye</i>\n'
+    # the shared copy is left as is
+    assert renderer.shared['To'] == 'undisclosed-recipients:;'
+    assert '$name' in renderer.shared.get_body(('html',)).get_content()
+
+def test_request_roundtrip():
+    request = FanoutRequest(b'{"x": 1}\n', (FanoutRecipient('a@test.com'), FanoutRecipient('b@test.com', {'name': 'B'})),
+                            'newsletter:subscribers', ('footer',))
+    assert FanoutRequest.decode(request.encode()) == request
+    assert FanoutRequest.decode(FanoutRequest(b'', (FanoutRecipient('a@test.com'),)).encode()).trusted == ()
+
+class _Delivery:
+    def __init__(self) -> None:
+        self.jobs: list = []
+
+    def max_rcpts(self) -> int:
+        return 0
+
+    async def submit(self, job):
+        self.jobs.append(job)
+
+class _Backlog:
+    def done(self, channel: str):
+        pass
+
+def _service(monkeypatch, redis):
+    monkeypatch.setattr(SrvcEmail, 'logger', logging.getLogger('test_fanout'), raising=False)
+    obj = SrvcEmail('127.0.0.1')
+    obj.register_email_channel('fan', lambda data: _email(), fanout=True)
+    obj._m_config = ConfigSMTP(host='localhost', from_email='hello@test.com', username='', password='', fanout_batch=2)
+    obj.m_redis = redis
+    obj.m_metrics = Metrics(redis, 'w1', SrvcEmail.logger)
+    obj.m_backlog = _Backlog()
+    obj.m_retry = RetryQueue(redis, ['fan'], None, SrvcEmail.logger)
+    obj.m_delivery = _Delivery()
+    return obj
+
+def _sent(obj):
+    return [x for job in obj.m_delivery.jobs for x in job.rcpts]
+
+def test_fan_out_dead_letters_the_recipient_that_fails_only(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        obj = _service(monkeypatch, redis)
+        request = FanoutRequest(b'', (FanoutRecipient('a@test.com'), FanoutRecipient('b@test.com', headers={'X-Tag': 'x\r\nBcc: evil@test.com'}),
+                                      FanoutRecipient('c@test.com', {'name': 'C'}), FanoutRecipient('d@test.com'), FanoutRecipient('e@test.com')))
+        await obj._fan_out(ConvertJob('fan', request.encode()), _email())
+        assert sorted(_sent(obj)) == ['a@test.com', 'c@test.com', 'd@test.com', 'e@test.com']
+        # not retried, dead-lettered on its own
+        assert await redis.zcard(RetryQueue.KEY_RETRY.format('fan')) == 0
+        (dead,) = [RetryEntry.decode(x) for x in await redis.lrange(RetryQueue.KEY_DEAD.format('fan'), 0, -1)]
+        assert FanoutRequest.decode(dead.data).addresses() == ('b@test.com',)
+
+    asyncio.run(main())
+
+def test_fan_out_retries_the_recipients_not_read(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    monkeypatch.setattr(fanout, '_SCAN_COUNT', 3)
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        obj = _service(monkeypatch, redis)
+        await redis.rpush('list', *[f'u{x}@test.com' for x in range(8)])
+        lrange, calls = redis.lrange, []
+
+        async def flaky(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise ConnectionError('Redis gone')
+            return await lrange(*args)
+
+        redis.lrange = flaky
+        request = FanoutRequest(b'', (FanoutRecipient('a@test.com'),), 'list')
+        await obj._fan_out(ConvertJob('fan', request.encode()), _email())
+        assert sorted(_sent(obj)) == ['a@test.com', 'u0@test.com', 'u1@test.com', 'u2@test.com']
+        # the retry goes on from the first recipient not read
+        (raw,) = await redis.zrange(RetryQueue.KEY_RETRY.format('fan'), 0, -1)
+        retry = RetryEntry.decode(raw)
+        assert FanoutRequest.decode(retry.data).offset == 3
+        await obj._fan_out(ConvertJob('fan', retry.data, None, retry.attempt), _email())
+        assert sorted(_sent(obj)) == ['a@test.com'] + [f'u{x}@test.com' for x in range(8)]
+
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except, protected-access
+
+import asyncio
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from email_service_nicegui import metrics as metrics_module  # pylint: disable=wrong-import-position
+from email_service_nicegui.metrics import KEY_STATS, Metrics, mount_metrics, read_stats, render_prometheus  # pylint: disable=wrong-import-position
+from email_service_nicegui.utils import logging  # pylint: disable=wrong-import-position
+
+LOGGER = logging.getLogger('test_metrics')
+
+
+def _record(metrics: Metrics):
+    metrics.incr('ch', 'sent')
+    metrics.incr('ch', 'sent')
+    metrics.incr('ch', 'refused:451')
+    metrics.incr('ch', 'relay:smtp.test:25')
+    for seconds in (0.003, 0.2, 0.2, 1000):
+        metrics.observe('ch', 'smtp_seconds', seconds)
+
+def test_flush_into_the_stats_hash():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        metrics = Metrics(redis, 'w1', LOGGER)
+        _record(metrics)
+        await metrics.flush()
+        # deltas, added up over the flushes
+        metrics.incr('ch', 'sent')
+        await metrics.flush()
+        await metrics.flush()
+        stats = await read_stats(redis)
+        assert list(stats) == ['ch'] and list(stats['ch']) == ['w1']
+        worker = stats['ch']['w1']
+        assert (worker['sent'], worker['refused:451'], worker['relay:smtp.test:25']) == (3, 1, 1)
+        hist = worker['smtp_seconds']
+        assert hist['buckets'] == {'0.005': 1, '0.25': 2, '+Inf': 1}
+        assert (hist['count'], round(hist['sum'], 3)) == (4, 1000.403)
+        # the stamp of the last flush is no metric
+        assert 'seen' not in worker
+        assert time.time() - float(await redis.hget(KEY_STATS.format('ch'), 'w1|seen')) < 5
+
+    asyncio.run(main())
+
+def test_render_prometheus():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        metrics = Metrics(redis, 'w"1', LOGGER)
+        _record(metrics)
+        await metrics.flush()
+        return render_prometheus(await read_stats(redis))
+
+    lines = asyncio.run(main()).splitlines()
+    labels = 'channel="ch",worker="w\\"1"'
+    assert '# TYPE email_sent_total counter' in lines
+    assert f'email_sent_total{{{labels}}} 2' in lines
+    assert f'email_refused_total{{{labels},code="451"}} 1' in lines
+    assert f'email_relay_total{{{labels},relay="smtp.test:25"}} 1' in lines
+    assert '# TYPE email_smtp_seconds histogram' in lines
+    # cumulative buckets, +Inf is the count
+    assert f'email_smtp_seconds_bucket{{{labels},le="0.005"}} 1' in lines
+    assert f'email_smtp_seconds_bucket{{{labels},le="0.1"}} 1' in lines
+    assert f'email_smtp_seconds_bucket{{{labels},le="0.25"}} 3' in lines
+    assert f'email_smtp_seconds_bucket{{{labels},le="+Inf"}} 4' in lines
+    assert f'email_smtp_seconds_count{{{labels}}} 4' in lines
+
+def test_fields_of_workers_gone_pruned():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        gone, alive = Metrics(redis, 'host:1234', LOGGER), Metrics(redis, 'host:2345', LOGGER, stale=60)
+        for metrics in (gone, alive):
+            metrics.incr('ch', 'sent')
+            await metrics.flush()
+        # not seen for longer than the ones alive wait
+        await redis.hset(KEY_STATS.format('ch'), 'host:1234|seen', time.time() - 61)
+        alive._m_pruned -= 6
+        await alive.flush()
+        assert list((await read_stats(redis))['ch']) == ['host:2345']
+
+    asyncio.run(main())
+
+def test_mount_metrics(monkeypatch):
+    testclient = pytest.importorskip('fastapi.testclient')
+    fastapi = pytest.importorskip('fastapi')
+    # the app reads on a loop of its own
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(metrics_module, 'Redis', lambda host: fakeredis.FakeAsyncRedis(server=server))
+    metrics = Metrics(fakeredis.FakeAsyncRedis(server=server), 'w1', LOGGER)
+    _record(metrics)
+    asyncio.run(metrics.flush())
+    app = fastapi.FastAPI()
+    mount_metrics(app, 'localhost')
+    rsp = testclient.TestClient(app).get('/metrics')
+    assert rsp.status_code == 200 and rsp.headers['content-type'].startswith('text/plain; version=0.0.4')
+    assert 'email_sent_total{channel="ch",worker="w1"} 2' in rsp.text.splitlines()
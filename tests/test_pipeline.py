@@ -0,0 +1,53 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+import os
+from email.message import EmailMessage
+
+from email_service_nicegui.config import ConfigSMTP
+from email_service_nicegui.pipeline import ConvertJob, ConvertStage
+from email_service_nicegui.utils import logging
+
+
+def convert_or_die(data: bytes) -> EmailMessage:
+    # the first call with a flag file kills its pool process, as the OOM killer would
+    path = data.decode()
+    if os.path.exists(path):
+        os.remove(path)
+        os._exit(1)  # pylint: disable=protected-access
+    email = EmailMessage()
+    email['Subject'] = os.path.basename(path)
+    return email
+
+def test_broken_pool_resubmits(tmp_path):
+    async def main():
+        converted, failed = [], []
+
+        async def on_converted(job, email, elapsed):
+            converted.append(email['Subject'])
+
+        async def on_failed(job, excp):
+            failed.append(excp)
+
+        config = ConfigSMTP(host='localhost', from_email='hello@test.com', username='', password='',
+                            convert_executor='process', convert_workers=1)
+        stage = ConvertStage(config, logging.getLogger('test_pipeline'), {'ch': convert_or_die}, on_converted,
+                             on_failed)
+        await stage.start()
+        flag = tmp_path / 'crash'
+        flag.write_bytes(b'')
+        try:
+            await stage.submit(ConvertJob('ch', str(flag).encode()))
+            await stage.submit(ConvertJob('ch', str(tmp_path / 'next').encode()))
+            await asyncio.wait_for(stage._m_queues['ch'].join(), 60)  # pylint: disable=protected-access
+        finally:
+            await stage.stop()
+        # converted on the fresh pool, none dead-lettered
+        assert failed == []
+        assert converted == ['crash', 'next']
+
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+
+from email_service_nicegui.config import ConfigSMTP  # pylint: disable=wrong-import-position
+from email_service_nicegui.ratelimit import RateLimiter  # pylint: disable=wrong-import-position
+from email_service_nicegui.utils import logging  # pylint: disable=wrong-import-position
+
+
+def _limiter(redis, **kwargs) -> RateLimiter:
+    config = ConfigSMTP(host='localhost', from_email='hello@test.com', username='', password='', rate_max_wait=0,
+                        **kwargs)
+    return RateLimiter(redis, config, logging.getLogger('test_ratelimit'))
+
+def test_token_per_recipient():
+    async def main():
+        limiter = _limiter(fakeredis.FakeAsyncRedis(), rate_limit_domains={'gmail.com': 20})
+        assert limiter.max_cost() == 20
+        # the whole burst in one transaction, the next recipient waits for its token (1/20 s)
+        assert await limiter.acquire('relay:25', {'gmail.com': 20, 'test.com': 5}) == 0
+        assert await limiter.acquire('relay:25', {'gmail.com': 1}) > 0
+        # other domains are not held up
+        assert await limiter.acquire('relay:25', {'yahoo.com': 50}) == 0
+
+    asyncio.run(main())
+
+def test_relay_takes_all_recipients():
+    async def main():
+        limiter = _limiter(fakeredis.FakeAsyncRedis(), rate_limit=10, rate_burst=30,
+                           rate_limit_domains={'gmail.com': 20})
+        assert limiter.max_cost() == 30
+        assert await limiter.acquire('relay:25', {'a.com': 15, 'b.com': 15}) == 0
+        wait = await limiter.acquire('relay:25', {'a.com': 5})
+        assert 0.4 < wait <= 0.5
+
+    asyncio.run(main())
+
+def test_no_limits():
+    async def main():
+        limiter = _limiter(fakeredis.FakeAsyncRedis())
+        assert limiter.max_cost() == 0
+        assert await limiter.acquire('relay:25', {'gmail.com': 1000}) == 0
+
+    asyncio.run(main())
@@ -0,0 +1,157 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+
+from email_service_nicegui.retry import RetryEntry, RetryQueue  # pylint: disable=wrong-import-position
+from email_service_nicegui.utils import logging  # pylint: disable=wrong-import-position
+
+LOGGER = logging.getLogger('test_retry')
+
+
+def test_backoff():
+    queue = RetryQueue(fakeredis.FakeAsyncRedis(), ['ch'], None, LOGGER, base_delay=5, max_delay=60)
+    for attempt, delay in ((0, 5), (1, 10), (2, 20), (3, 40), (4, 60), (10, 60)):
+        for _ in range(20):
+            assert delay / 2 <= queue.backoff(attempt) <= delay
+
+def test_dead_letter_trimmed():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        queue = RetryQueue(redis, ['ch'], None, LOGGER, dead_letter_max=3)
+        for x in range(5):
+            await queue.dead_letter(RetryEntry('ch', f'req{x}'.encode(), 5, f'550 #{x}'))
+        dead = [RetryEntry.decode(x) for x in await redis.lrange(RetryQueue.KEY_DEAD.format('ch'), 0, -1)]
+        # latest first
+        assert [(x.data, x.error) for x in dead] == [(b'req4', '550 #4'), (b'req3', '550 #3'), (b'req2', '550 #2')]
+
+    asyncio.run(main())
+
+def test_scheduled_when_due():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        handled = []
+
+        async def handler(entry, member):
+            handled.append(entry.data)
+            await queue.done(entry.channel, member)
+
+        queue = RetryQueue(redis, ['ch'], handler, LOGGER)
+        await queue.schedule(RetryEntry('ch', b'now', 1), 0)
+        await queue.schedule(RetryEntry('ch', b'later', 1), 60)
+        assert await queue._poll() == 1  # pylint: disable=protected-access
+        assert handled == [b'now']
+        # done with, only the one not due yet is left
+        assert [RetryEntry.decode(x).data for x in await redis.zrange(RetryQueue.KEY_RETRY.format('ch'), 0, -1)] == [b'later']
+
+    asyncio.run(main())
+
+def test_lease_survives_crash():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        key = RetryQueue.KEY_RETRY.format('ch')
+        handled = []
+
+        async def lost(entry, member):
+            # the worker is gone before SMTP has the eMail
+            handled.append(('lost', entry.data))
+
+        async def handler(entry, member):
+            handled.append(('sent', entry.data))
+            await other.done(entry.channel, member)
+
+        crashed = RetryQueue(redis, ['ch'], lost, LOGGER, lease=30)
+        other = RetryQueue(redis, ['ch'], handler, LOGGER, lease=30)
+        await crashed.schedule(RetryEntry('ch', b'req', 1), 0)
+        started = time.time()
+        await crashed._poll()  # pylint: disable=protected-access
+        # still there, leased & not due before the lease is over
+        ((_, due),) = await redis.zrange(key, 0, -1, withscores=True)
+        assert started + 30 <= due <= time.time() + 30
+        await other._poll()  # pylint: disable=protected-access
+        assert handled == [('lost', b'req')]
+        # the lease is over, the other worker gets it
+        await redis.zadd(key, {(await redis.zrange(key, 0, -1))[0]: started}, xx=True)
+        await other._poll()  # pylint: disable=protected-access
+        assert handled == [('lost', b'req'), ('sent', b'req')]
+        assert await redis.zcard(key) == 0
+
+    asyncio.run(main())
+
+def test_lease_renewed_while_in_flight():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        key = RetryQueue.KEY_RETRY.format('ch')
+        members = []
+
+        async def handler(entry, member):
+            members.append(member)
+
+        queue = RetryQueue(redis, ['ch'], handler, LOGGER, lease=0.3)
+        await queue.schedule(RetryEntry('ch', b'a', 1), 0)
+        await queue.schedule(RetryEntry('ch', b'b', 1), 0)
+        run = asyncio.ensure_future(queue.run())
+        await asyncio.sleep(0.05)
+        assert len(members) == 2
+        await queue.done('ch', members[0])
+        # renewed past its first lease, never handed out twice
+        await asyncio.sleep(0.6)
+        run.cancel()
+        assert len(members) == 2
+        assert await redis.zrange(key, 0, -1) == [members[1]]
+        assert (await redis.zscore(key, members[1])) > time.time()
+
+    asyncio.run(main())
+
+def test_failed_handler_releases_the_rest():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+
+        async def handler(entry, member):
+            raise RuntimeError('queue closed')
+
+        queue = RetryQueue(redis, ['ch'], handler, LOGGER)
+        await queue.schedule(RetryEntry('ch', b'a', 1), 0)
+        await queue.schedule(RetryEntry('ch', b'b', 1), 0)
+        with pytest.raises(RuntimeError):
+            await queue._poll()  # pylint: disable=protected-access
+        # not renewed, due again once the lease is over
+        assert not any(queue._m_leased.values())  # pylint: disable=protected-access
+        assert await redis.zcard(RetryQueue.KEY_RETRY.format('ch')) == 2
+
+    asyncio.run(main())
+
+def test_blocked_channel_holds_up_no_other():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        handled, blocked = [], asyncio.Event()
+
+        async def handler(entry, member):
+            if entry.channel == 'bulk':
+                # waits for room in the queues of its channel
+                await blocked.wait()
+            handled.append(entry.data)
+            await queue.done(entry.channel, member)
+
+        queue = RetryQueue(redis, ['bulk', 'login'], handler, LOGGER, poll_interval=0.05)
+        await queue.schedule(RetryEntry('bulk', b'bulk', 1), 0)
+        run = asyncio.ensure_future(queue.run())
+        await asyncio.sleep(0.1)
+        await queue.schedule(RetryEntry('login', b'login', 1), 0)
+        await asyncio.sleep(0.2)
+        assert handled == [b'login']
+        blocked.set()
+        await asyncio.sleep(0.05)
+        run.cancel()
+        assert handled == [b'login', b'bulk']
+
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+from collections import Counter
+from typing import NamedTuple
+
+from email_service_nicegui.scheduler import ChannelScheduler
+
+
+class Item(NamedTuple):
+    channel: str
+    seq: int = 0
+
+async def _drain(sched: ChannelScheduler[Item], count: int) -> list[Item]:
+    rtn = []
+    for _ in range(count):
+        rtn.append(await sched.get())
+        sched.task_done()
+    return rtn
+
+def test_strict_priority():
+    async def main():
+        sched: ChannelScheduler[Item] = ChannelScheduler()
+        sched.add_channel('bulk', priority=0, weight=10)
+        sched.add_channel('login', priority=1)
+        for x in range(5):
+            await sched.put(Item('bulk', x))
+        for x in range(2):
+            await sched.put(Item('login', x))
+        assert [x.channel for x in await _drain(sched, 7)] == ['login'] * 2 + ['bulk'] * 5
+
+    asyncio.run(main())
+
+def test_weighted_share_in_order():
+    async def main():
+        sched: ChannelScheduler[Item] = ChannelScheduler()
+        sched.add_channel('a', weight=2)
+        sched.add_channel('b', weight=1)
+        for x in range(30):
+            await sched.put(Item('a', x))
+            await sched.put(Item('b', x))
+        served = await _drain(sched, 30)
+        assert Counter(x.channel for x in served) == {'a': 20, 'b': 10}
+        # FIFO within a channel
+        for ch in ('a', 'b'):
+            seqs = [x.seq for x in served if x.channel == ch]
+            assert seqs == sorted(seqs)
+        await _drain(sched, 30)
+        await asyncio.wait_for(sched.join(), 1)
+
+    asyncio.run(main())
+
+def test_idle_channel_gets_no_credit():
+    async def main():
+        sched: ChannelScheduler[Item] = ChannelScheduler()
+        sched.add_channel('a')
+        sched.add_channel('b')
+        for x in range(10):
+            await sched.put(Item('a', x))
+        await _drain(sched, 10)
+        # b was idle meanwhile, it shares from now on instead of catching up
+        for x in range(4):
+            await sched.put(Item('a', x))
+            await sched.put(Item('b', x))
+        assert Counter(x.channel for x in await _drain(sched, 4)) == {'a': 2, 'b': 2}
+
+    asyncio.run(main())
+
+def test_full_channel_blocks_only_itself():
+    async def main():
+        sched: ChannelScheduler[Item] = ChannelScheduler(maxsize=2)
+        for x in range(2):
+            await sched.put(Item('bulk', x))
+        assert sched.full('bulk') and not sched.full('login')
+        blocked = asyncio.ensure_future(sched.put(Item('bulk', 2)))
+        await asyncio.wait_for(sched.put(Item('login')), 1)
+        await asyncio.sleep(0)
+        assert not blocked.done()
+        await sched.get()
+        await asyncio.wait_for(blocked, 1)
+        assert sched.qsize('bulk') == 2 and sched.qsize() == 3
+
+    asyncio.run(main())
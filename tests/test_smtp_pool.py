@@ -0,0 +1,96 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except, protected-access
+
+import asyncio
+import socket
+
+import pytest
+
+controller = pytest.importorskip('aiosmtpd.controller')
+
+from email_service_nicegui.config import ConfigSMTP  # pylint: disable=wrong-import-position
+from email_service_nicegui.smtp_pool import SmtpPool  # pylint: disable=wrong-import-position
+from email_service_nicegui.utils import logging  # pylint: disable=wrong-import-position
+
+
+class Sink:
+    def __init__(self) -> None:
+        # SMTP sessions the eMails came in, by their peer
+        self.sessions: list[tuple[str, int]] = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.append(session.peer)
+        return '250 OK'
+
+@pytest.fixture(name='sink')
+def _sink():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    rtn = controller.Controller(Sink(), hostname='127.0.0.1', port=port)
+    rtn.start()
+    yield rtn
+    rtn.stop()
+
+def _pool(sink, **options) -> SmtpPool:
+    config = ConfigSMTP(host='127.0.0.1', port=sink.port, from_email='hello@test.com', username='', password='', **options)
+    return SmtpPool(config, logging.getLogger('test_smtp_pool'), config.relay_list()[0])
+
+async def _send(pool: SmtpPool):
+    conn = await pool.acquire()
+    try:
+        await asyncio.to_thread(conn.smtp.sendmail, 'hello@test.com', ['a@test.com'], b'Subject: hi\r\n\r\nbody\r\n')
+        conn.sent += 1
+    finally:
+        pool.release(conn)
+
+def test_session_reused(sink):
+    async def main():
+        pool = _pool(sink, pool_min=1, pool_max=2)
+        await pool.start()
+        for _ in range(5):
+            await _send(pool)
+        assert pool._m_total == 1
+        await pool.close()
+
+    asyncio.run(main())
+    # all of them over the session opened at the start
+    assert len(sink.handler.sessions) == 5 and len(set(sink.handler.sessions)) == 1
+
+def test_session_rotated_after_max_messages(sink):
+    async def main():
+        pool = _pool(sink, pool_min=1, pool_max=2, pool_max_messages=2)
+        await pool.start()
+        for _ in range(5):
+            await _send(pool)
+        await pool.close()
+
+    asyncio.run(main())
+    sessions = sink.handler.sessions
+    assert [sessions.count(x) for x in dict.fromkeys(sessions)] == [2, 2, 1]
+
+def test_idle_sessions_reaped_down_to_min(sink):
+    async def main():
+        pool = _pool(sink, pool_min=1, pool_max=3, pool_idle_timeout=60)
+        await pool.start()
+        conns = [await pool.acquire() for _ in range(3)]
+        for conn in conns:
+            pool.release(conn)
+        assert pool._m_total == 3
+        # two of them idle for longer than the timeout
+        for conn in conns[:2]:
+            conn.last_used -= 61
+        await pool._check_idle()
+        assert pool._m_total == 1 and pool._m_idle == [conns[2]]
+        # the session left dropped by the server, it fails its NOOP & the pool is topped up with a new one
+        conns[2].smtp.sock.shutdown(socket.SHUT_RDWR)
+        await pool._check_idle()
+        assert pool._m_total == 0 and pool._m_idle == []
+        await pool._top_up()
+        assert pool._m_total == 1 and len(pool._m_idle) == 1 and pool._m_idle[0] not in conns
+        await pool.close()
+
+    asyncio.run(main())
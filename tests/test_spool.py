@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except, protected-access
+
+import asyncio
+import os
+
+import pytest
+
+from email_service_nicegui.config import ConfigSMTP
+from email_service_nicegui.spool import _HEADER, SpoolEntry, WriteAheadSpool
+from email_service_nicegui.utils import logging
+
+ENTRY = SpoolEntry('ch', b'request', b'Subject: hi\r\n\r\nbody\r\n')
+# three eMails per segment
+SEGMENT_SIZE = 3 * (_HEADER.size + len(ENTRY.encode()))
+
+def _spool(path) -> WriteAheadSpool:
+    config = ConfigSMTP(host='localhost', from_email='hello@test.com', username='', password='',
+                        spool_segment_size=SEGMENT_SIZE)
+    return WriteAheadSpool(str(path), config, logging.getLogger('test_spool'))
+
+def _segments(path) -> list[str]:
+    return sorted(os.listdir(path))
+
+def _reopen(path) -> set[int]:
+    spool = _spool(path)
+    spool.open()
+    rtn = set(spool._m_index)
+    asyncio.run(spool.close())
+    return rtn
+
+def test_replay(tmp_path):
+    async def main():
+        spool = _spool(tmp_path)
+        assert spool.open() == 0
+        seqs = [await spool.append(ENTRY._replace(attempt=x)) for x in range(5)]
+        spool.done(seqs[1])
+        await spool.close()
+        return seqs
+
+    seqs = asyncio.run(main())
+    spool = _spool(tmp_path)
+    assert spool.open() == 4
+    assert spool.parked('ch') == 4
+    assert [spool.read(x).attempt for x in sorted(spool._m_index)] == [0, 2, 3, 4]
+    assert set(spool._m_index) == set(seqs) - {seqs[1]}
+    asyncio.run(spool.close())
+
+def test_compact_keeps_done_marks_of_surviving_segment(tmp_path):
+    async def main():
+        spool = _spool(tmp_path)
+        spool.open()
+        # PUT 1-3 in the 1st segment
+        put = [await spool.append(ENTRY) for _ in range(3)]
+        # PUT 4, DONE 1 & DONE 4 in the 2nd one
+        put.append(await spool.append(ENTRY))
+        spool.done(put[0])
+        spool.done(put[3])
+        # PUT 5 & 6 fill it up, 6 rolls over to the 3rd one
+        put += [await spool.append(ENTRY) for _ in range(2)]
+        spool.done(put[4])
+        spool.done(put[5])
+        # the 1st segment is 2/3 live and kept, the 2nd one has no live record but the done mark of PUT 1
+        await spool.compact()
+        assert len(_segments(tmp_path)) == 3
+        await spool.close()
+        return put
+
+    put = asyncio.run(main())
+    assert _reopen(tmp_path) == {put[1], put[2]}
+
+def test_compact_drops_done_marks_with_their_records(tmp_path):
+    async def main():
+        spool = _spool(tmp_path)
+        spool.open()
+        put = [await spool.append(ENTRY) for _ in range(4)]
+        for seq in put:
+            spool.done(seq)
+        put += [await spool.append(ENTRY) for _ in range(3)]
+        # the 1st segment has no live record, the 2nd one holds its done marks & is less than half live (PUT 5)
+        await spool.compact()
+        assert len(_segments(tmp_path)) == 1
+        await spool.close()
+        return put
+
+    put = asyncio.run(main())
+    assert _reopen(tmp_path) == set(put[4:])
+
+def test_spool_locked_while_open(tmp_path):
+    spool = _spool(tmp_path)
+    spool.open()
+    with pytest.raises(RuntimeError):
+        _spool(tmp_path).open()
+    asyncio.run(spool.close())
+    assert _reopen(tmp_path) == set()
+
+def test_adopt_the_spools_left_behind(tmp_path):
+    async def main():
+        # a worker named after its pid, gone for good
+        gone = _spool(tmp_path / 'host_1234')
+        gone.open()
+        seqs = [await gone.append(ENTRY._replace(attempt=x)) for x in range(4)]
+        gone.done(seqs[0])
+        await gone.close()
+        # one of an other channel & one in use
+        other = _spool(tmp_path / 'host_2345')
+        other.open()
+        await other.append(ENTRY._replace(channel='other'))
+        await other.close()
+        busy = _spool(tmp_path / 'host_3456')
+        busy.open()
+        await busy.append(ENTRY)
+        spool = _spool(tmp_path / 'host_4567')
+        spool.open()
+        assert await spool.adopt(['ch']) == 3
+        assert spool.parked('ch') == 3
+        assert [spool.read(x).attempt for x in sorted(spool._m_index)] == [1, 2, 3]
+        assert sorted(os.listdir(tmp_path)) == ['host_2345', 'host_3456', 'host_4567']
+        await busy.close()
+        await spool.close()
+
+    asyncio.run(main())
+    # journaled in its own spool now
+    assert len(_reopen(tmp_path / 'host_4567')) == 3
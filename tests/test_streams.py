@@ -0,0 +1,135 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import asyncio
+import collections
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from email_service_nicegui.streams import StreamConsumer  # pylint: disable=wrong-import-position
+from email_service_nicegui.utils import logging  # pylint: disable=wrong-import-position
+
+CHANNEL = 'email.test'
+GROUP = 'email-service'
+
+class Handler():
+    def __init__(self) -> None:
+        self.calls: collections.Counter[bytes] = collections.Counter()
+        self.data: dict[bytes, bytes] = {}
+
+    async def __call__(self, ch_name: str, data: bytes, msg_id: bytes):
+        assert ch_name == CHANNEL
+        self.calls[msg_id] += 1
+        self.data[msg_id] = data
+
+def _consumer(redis, handler, name: str = 'w1', **kwargs) -> StreamConsumer:
+    kwargs = {'count': 2, 'block_ms': 20, 'claim_idle_ms': 200, **kwargs}
+    return StreamConsumer(redis, [CHANNEL], handler, logging.getLogger('test_streams'), GROUP, name, **kwargs)
+
+async def _run(consumer: StreamConsumer, seconds: float):
+    task = asyncio.ensure_future(consumer.run())
+    await asyncio.sleep(seconds)
+    consumer.stop()
+    await asyncio.wait_for(task, 1)
+
+async def _pending(redis, consumer: str = '') -> int:
+    rslt = await redis.xpending_range(CHANNEL, GROUP, '-', '+', 100, consumername=consumer or None)
+    return len(rslt)
+
+def test_inflight_not_claimed_again():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        handler = Handler()
+        consumer = _consumer(redis, handler)
+        await consumer.start()
+        ids = [await redis.xadd(CHANNEL, {'data': f'r{x}'}) for x in range(5)]
+        # never acknowledged while running (as with a slow SMTP relay), nor claimed by an other worker meanwhile
+        other = Handler()
+        await asyncio.gather(_run(consumer, 1), _run(_consumer(redis, other, 'w2'), 1))
+        assert handler.calls == {x: 1 for x in ids}
+        assert not other.calls
+        for msg_id in ids:
+            consumer.ack(CHANNEL, msg_id)
+        await consumer.flush()
+        assert await _pending(redis) == 0
+        assert await redis.xlen(CHANNEL) == 0
+
+    asyncio.run(main())
+
+def test_claim_from_dead_worker():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        handler = Handler()
+        consumer = _consumer(redis, handler, claim_idle_ms=100)
+        await consumer.start()
+        ids = [await redis.xadd(CHANNEL, {'data': f'r{x}'}) for x in range(5)]
+        # read by a worker gone for good, more of them than a page of XAUTOCLAIM
+        await redis.xreadgroup(GROUP, 'dead', {CHANNEL: '>'}, count=10)
+        await asyncio.sleep(0.15)
+        await _run(consumer, 0.3)
+        assert handler.calls == {x: 1 for x in ids}
+        assert await _pending(redis, 'dead') == 0
+        assert await _pending(redis, 'w1') == 5
+
+    asyncio.run(main())
+
+def test_pending_history_on_restart():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        await _consumer(redis, Handler()).start()
+        ids = [await redis.xadd(CHANNEL, {'data': f'r{x}'}) for x in range(5)]
+        await redis.xreadgroup(GROUP, 'w1', {CHANNEL: '>'}, count=10)
+        # the same name after a restart, all of its history is handed out again, page by page
+        handler = Handler()
+        await _run(_consumer(redis, handler, claim_idle_ms=60000), 0.2)
+        assert handler.calls == {x: 1 for x in ids}
+
+    asyncio.run(main())
+
+def test_released_claimed_once_idle():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        handler = Handler()
+        consumer = _consumer(redis, handler, claim_idle_ms=100)
+        await consumer.start()
+        msg_id = await redis.xadd(CHANNEL, {'data': 'r'})
+        task = asyncio.ensure_future(consumer.run())
+        await asyncio.sleep(0.1)
+        assert handler.calls[msg_id] == 1
+        consumer.release(CHANNEL, msg_id)
+        await asyncio.sleep(0.4)
+        consumer.stop()
+        await asyncio.wait_for(task, 1)
+        assert handler.calls[msg_id] == 2
+
+    asyncio.run(main())
+
+def test_read_failure_recovers(monkeypatch):
+    monkeypatch.setattr(StreamConsumer, 'RETRY_DELAY', 0.01)
+
+    async def main():
+        server = fakeredis.FakeServer()
+        redis = fakeredis.FakeAsyncRedis(server=server)
+        handler = Handler()
+        consumer = _consumer(redis, handler)
+        await consumer.start()
+        task = asyncio.ensure_future(consumer.run())
+        await asyncio.sleep(0.1)
+        # Redis is down for a while & comes back without its data
+        server.connected = False
+        await asyncio.sleep(0.2)
+        assert not task.done()
+        server.connected = True
+        await redis.flushall()
+        msg_id = await redis.xadd(CHANNEL, {'data': 'r'})
+        await asyncio.sleep(0.3)
+        consumer.stop()
+        await asyncio.wait_for(task, 1)
+        assert handler.calls == {msg_id: 1}
+
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import pytest
+
+from email_service_nicegui.templates import MailTemplate, TemplateRegistry
+
+
+@pytest.fixture
+def registry() -> TemplateRegistry:
+    rtn = TemplateRegistry()
+    rtn.register('welcome', MailTemplate('Welcome {full_name}', 'Hi {full_name}', '<p>Hi {full_name}</p>{signature}',
+                                         headers={'From': 'hello@test.com', 'To': '{to}'}, trusted=('signature',)))
+    return rtn
+
+@pytest.mark.parametrize('values', [
+    {'full_name': 'Bob\r\nReply-To: attacker@evil.example', 'to': 'bob@test.com'},
+    {'full_name': 'Bob', 'to': 'bob@test.com\nBcc: attacker@evil.example'},
+])
+def test_header_line_break_rejected(registry: TemplateRegistry, values: dict):
+    with pytest.raises(ValueError):
+        registry.render('welcome', values, signature='')
+
+def test_header_line_break_not_cached(registry: TemplateRegistry):
+    values = {'full_name': 'Bob\nReply-To: attacker@evil.example', 'to': 'bob@test.com', 'signature': ''}
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            registry.render('welcome', values)
+    assert b'Reply-To' not in registry.render('welcome', {**values, 'full_name': 'Bob'}).as_bytes()
+
+def test_html_escaped_but_trusted(registry: TemplateRegistry):
+    email = registry.render('welcome', {'full_name': '<a href="https://evil.example">Bob</a> & co', 'to': 'bob@test.com',
+                                        'signature': '<i>The Team</i>'})
+    text, html = (x.get_content() for x in email.iter_parts())
+    assert text.strip() == 'Hi <a href="https://evil.example">Bob</a> & co'
+    assert html.strip() == '<p>Hi &lt;a href=&quot;https://evil.example&quot;&gt;Bob&lt;/a&gt; &amp; co</p><i>The Team</i>'
+
+def test_cached_components(registry: TemplateRegistry):
+    for to in ('a@test.com', 'b@test.com'):
+        email = registry.render('welcome', {'full_name': 'Bob', 'to': to, 'signature': ''})
+        assert email['To'] == to and email['Subject'] == 'Welcome Bob'
+    # Subject & both parts rendered once, the To header per address
+    assert (registry.hits, registry.misses) == (3, 5)
+    registry.invalidate('welcome')
+    registry.render('welcome', {'full_name': 'Bob', 'to': 'a@test.com', 'signature': ''})
+    assert registry.misses == 9
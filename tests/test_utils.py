@@ -0,0 +1,68 @@
+# SPDX-FileCopyrightText: 2024-present SwK <swk@swkemb.com>
+#
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, line-too-long, broad-except
+
+import queue
+import time
+
+from email_service_nicegui.utils import BatchQueueHandler, BatchQueueListener, logging
+
+
+def _logger(name: str, handler: logging.Handler) -> logging.Logger:
+    rtn = logging.getLogger(name)
+    rtn.setLevel(logging.DEBUG)
+    rtn.addHandler(handler)
+    return rtn
+
+def test_batched_until_full_or_warning():
+    que: queue.Queue = queue.Queue()
+    logger = _logger('test_utils.batch', BatchQueueHandler(que, batch=3, interval=60))
+    logger.info('one')
+    logger.info('two')
+    assert que.empty()
+    logger.info('three')
+    assert [x[2] for x in que.get_nowait()] == ['one', 'two', 'three']
+    # right away at WARNING & above
+    logger.debug('four')
+    logger.warning('five')
+    assert [(x[0], x[2]) for x in que.get_nowait()] == [(logging.DEBUG, 'four'), (logging.WARNING, 'five')]
+
+def test_flushed_after_the_interval():
+    que: queue.Queue = queue.Queue()
+    logger = _logger('test_utils.interval', BatchQueueHandler(que, batch=64, interval=0.05))
+    logger.info('one')
+    assert [x[2] for x in que.get(timeout=5)] == ['one']
+
+def test_dropped_once_full_and_reported():
+    que: queue.Queue = queue.Queue(maxsize=1)
+    handler = BatchQueueHandler(que, batch=2, interval=60)
+    logger = _logger('test_utils.full', handler)
+    for x in range(6):
+        logger.info('%d', x)
+    # the 1st batch fits, the next 2 are dropped instead of blocking
+    assert handler.dropped == 4
+    assert [x[2] for x in que.get_nowait()] == ['0', '1']
+    logger.info('6')
+    handler.flush()
+    (note, record) = que.get_nowait()
+    assert note[:2] == (logging.WARNING, 'email_service_nicegui.utils') and note[2].startswith('4 log record(s) dropped')
+    assert record[2] == '6' and handler.dropped == 0
+
+def test_listener_hands_the_records_over():
+    que: queue.Queue = queue.Queue()
+    handled = []
+
+    class Collect(logging.Handler):
+        def emit(self, record):
+            handled.append((record.levelno, record.name, record.getMessage()))
+
+    listener = BatchQueueListener(que, Collect())
+    listener.start()
+    que.put([(logging.INFO, 'w1', 'one'), (logging.ERROR, 'w2', 'two')])
+    deadline = time.monotonic() + 5
+    while len(handled) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    listener.stop()
+    assert handled == [(logging.INFO, 'w1', 'one'), (logging.ERROR, 'w2', 'two')]